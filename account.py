@@ -31,6 +31,7 @@ KEY_CHANNELS = "channels"
 KEY_LIBRARY_PATH = "library-path"
 
 KEY_CONFLICT_RESOLVE = "conflict-resolve"
+KEY_DOWNLOAD_CONCURRENCY = "download-concurrency"
 KEY_FOLDER_HIERARCHY = "folder-hierarchy"
 KEY_FILENAME_TEMPLATE = "filename-template"
 KEY_PAGE_GROUP = "page-group"
@@ -54,6 +55,12 @@ KEY_PRELOAD_PREV_TRACK = "preload-prev-track"
 KEY_PRELOAD_HIDDEN_TRACK = "preload-hidden-track"
 KEY_PRELOAD_MAX_FILE_SIZE = "preload-max-file-size"
 KEY_PRELOAD_FILE_FORMATS = "preload-file-formats"
+KEY_STREAM_PLAYBACK = "stream-playback"
+
+KEY_TEMP_CACHE_QUOTA = "temp-cache-quota"
+KEY_TEMP_CACHE_MIN_FREE = "temp-cache-min-free"
+
+KEY_AUDIO_ONLY_HISTORY = "audio-only-history"
 
 AUDIO_FORMAT_ALL = 'any'
 
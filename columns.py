@@ -23,7 +23,7 @@ from gi.repository import GLib, Gio, Gtk
 from common import empty_cb, get_entry_location, get_location_audio_id, get_entry_state, get_first_artist, is_telegram_source
 from common import get_tree_view_from_entry_view
 from storage import Audio
-from loader import PinnedLoader, PinnedShortDict
+from loader import PinnedLoader, PinnedShortDict, TEMP_PRIORITY_CLICK
 from typing import Dict, Optional, List
 
 import gettext
@@ -185,7 +185,7 @@ class StateColumn:
                         entry = model.get_value(iter, 0)
                         state = get_entry_state(entry)
                         if state == Audio.STATE_DEFAULT:
-                            self.plugin.loader.add_entry(entry).start()
+                            self.plugin.loader.add_entry(entry, TEMP_PRIORITY_CLICK).start()
         return False
 
     def activate(self):
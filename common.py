@@ -15,7 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import enum
-import math, re
+import math, re, time
 import gi
 gi.require_version('Gio', '2.0')
 from datetime import datetime
@@ -182,11 +182,21 @@ def is_msg_valid(data):
     """ Checks if a message contains all required fields. """
     return message_set <= set(data)
 
+def get_chat_type(chat):
+    """ Returns a short name of the chat type: private, basicgroup, supergroup, channel or secret. """
+    chat_type = chat.get('type') or {}
+    name = chat_type.get('@type', '')
+    if name == 'chatTypeSupergroup' and chat_type.get('is_channel'):
+        return 'channel'
+    return name.replace('chatType', '').lower()
+
 def get_chat_info(chat):
-    """ Extracts the ID and title from a chat object. """
+    """ Extracts the ID, title, type and last message ID from a chat object. """
     return {
         'id': chat['id'],
         'title': chat['title'],
+        'type': get_chat_type(chat),
+        'last_message_id': (chat.get('last_message') or {}).get('id', 0),
     }
 
 def empty_cb(*args): # noqa
@@ -210,15 +220,16 @@ META_TAGS = {
     'album': RB.MetaDataField.ALBUM,
     'album_artist': RB.MetaDataField.ALBUM_ARTIST,
     'track_number': RB.MetaDataField.TRACK_NUMBER,
+    'disc_number': RB.MetaDataField.DISC_NUMBER,
     'date': RB.MetaDataField.DATE,
     'duration': RB.MetaDataField.DURATION,
     'genre': RB.MetaDataField.GENRE,
 }
 
-def get_audio_tags(file_path):
-    """ Retrieves metadata tags from an audio file. """
+def get_audio_tags(file_path, metadata=None):
+    """ Retrieves metadata tags from an audio file, a worker thread passes its own RB.MetaData. """
     tags = {}
-    metadata = RB.MetaData()
+    metadata = metadata or RB.MetaData()
     uri = GLib.filename_to_uri(file_path, None)
 
     try:
@@ -240,6 +251,7 @@ def get_audio_tags(file_path):
         tags['year'] = 0
         tags['duration'] = 0
         tags['track_number'] = 0
+        tags['disc_number'] = 0
 
     return tags
 
@@ -430,6 +442,62 @@ def idle_add_once(func, *args):
         return False
     GLib.idle_add(wrapper, *args)
 
+IDLE_TASK_BUDGET = 0.008  # max time (sec) spent by IdleTask in one main loop iteration
+
+class IdleTask:
+    """
+    Consumes an iterable in idle callbacks, spending at most `budget` seconds per main loop
+    iteration so the UI stays responsive. Can be cancelled and resumed later with start()
+    """
+
+    def __init__(self, iterable, callback, on_tick=None, on_done=None, budget=IDLE_TASK_BUDGET,
+                 priority=GLib.PRIORITY_DEFAULT_IDLE):
+        self.iterator = iter(iterable)
+        self.callback = callback
+        self.on_tick = on_tick
+        self.on_done = on_done
+        self.budget = budget
+        self.priority = priority
+        self.count = 0
+        self.done = False
+        self._source_id = None
+
+    def start(self):
+        """ Start or resume processing """
+        if self._source_id is None and not self.done:
+            self._source_id = GLib.idle_add(self._idle_cb, priority=self.priority)
+
+    def cancel(self):
+        """ Stop processing, the remaining items are kept for start() """
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+    def is_running(self):
+        return self._source_id is not None
+
+    def _idle_cb(self):
+        deadline = time.monotonic() + self.budget
+        try:
+            for item in self.iterator:
+                self.callback(item)
+                self.count += 1
+                if time.monotonic() >= deadline:
+                    if self.on_tick:
+                        self.on_tick(self)
+                    return True
+        except Exception:
+            self._source_id = None
+            self.done = True
+            raise
+        self._source_id = None
+        self.done = True
+        if self.on_tick:
+            self.on_tick(self)
+        if self.on_done:
+            self.on_done(self)
+        return False
+
 def clean_telegram_title(text):
     """ Clean string by removing emojis/symbols from start/end, preserving brackets"""
     pattern = r"^[^\w\s\(\)\[\]]+|[^\w\s\(\)\[\]]+$"
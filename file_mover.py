@@ -0,0 +1,196 @@
+# rhythmbox-telegram
+# Copyright (C) 2023-2026 Andrey Izman <izmanw@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import queue
+import shutil
+import logging
+import threading
+from common import idle_add_once
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024   # Max bytes copied by one copy_file_range or sendfile call
+SYNC_IDLE_DELAY = 2                 # Seconds without jobs after which the moved files are synced
+
+# errors of copy_file_range when the kernel or the filesystems can not copy between the files
+COPY_RANGE_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    """ Copies the file in the kernel, returns the number of copied bytes or None if not supported """
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, size - copied))
+            if n == 0:
+                break
+            copied += n
+    except OSError as e:
+        if copied == 0 and e.errno in COPY_RANGE_UNSUPPORTED:
+            return None
+        raise
+    return copied
+
+
+def _copy_sendfile(src_fd, dst_fd, size):
+    """ sendfile fallback for the kernels without copy_file_range between the filesystems """
+    copied = 0
+    try:
+        while copied < size:
+            n = os.sendfile(dst_fd, src_fd, copied, min(COPY_CHUNK_SIZE, size - copied))
+            if n == 0:
+                break
+            copied += n
+    except OSError as e:
+        if copied == 0 and e.errno in COPY_RANGE_UNSUPPORTED:
+            return None
+        raise
+    return copied
+
+
+def copy_file(src, dst):
+    """ Copies the file with its metadata, the destination appears only once it is complete """
+    tmp = dst + '.part'
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = None
+            if hasattr(os, 'copy_file_range'):
+                copied = _copy_file_range(fsrc.fileno(), fdst.fileno(), size)
+            if copied is None:
+                copied = _copy_sendfile(fsrc.fileno(), fdst.fileno(), size)
+            if copied is None:
+                shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def move_file(src, dst, keep_src=False):
+    """
+    Moves the file by an atomic rename, copies it in the kernel across filesystems. Returns whether it was copied.
+    With keep_src the source of a copied file is left for the caller to delete once the copy is synced
+    """
+    try:
+        os.rename(src, dst)
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_file(src, dst)
+    if not keep_src:
+        os.unlink(src)
+    return True
+
+
+class FileMover:
+    """
+    Runs file operations of the library in a worker thread, one job at a time in the order of submission.
+    Results are delivered to the main loop. Moved files and their directories are synced to disk
+    once per album, or when no more jobs arrive. The sources of the copied files are deleted after the sync,
+    so a crash never loses both
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._album = None
+        self._unsynced_copies = []      # (path, source) of the copied files, sources are deleted after the sync
+        self._unsynced_dirs = set()
+
+    def submit(self, func, args=(), on_done=None, on_error=None, album=None):
+        """
+        Runs func(*args) in the worker thread, then on_done(result) or on_error(exception) in the main loop.
+        Files of the previous album are synced before a job of another album starts
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._jobs.put((func, args, on_done, on_error, album))
+
+    def moved(self, path, src=None):
+        """
+        Called by the jobs in the worker thread, registers the moved file for the batched sync.
+        src is the source of a copied file, it is deleted after the sync
+        """
+        if src is not None:
+            self._unsynced_copies.append((path, src))
+        self._unsynced_dirs.add(os.path.dirname(path))
+
+    def stop(self):
+        """ Finishes the submitted jobs and stops the worker thread """
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                job = self._jobs.get(timeout=SYNC_IDLE_DELAY)
+            except queue.Empty:
+                self._sync()
+                job = self._jobs.get()
+            if job is None:
+                self._sync()
+                return
+            func, args, on_done, on_error, album = job
+            if album != self._album:
+                self._sync()
+                self._album = album
+            try:
+                result = func(*args)
+            except Exception as e:
+                logger.warning('File operation %s failed: %s', getattr(func, '__name__', func), e)
+                if on_error:
+                    idle_add_once(on_error, e)
+                continue
+            if on_done:
+                idle_add_once(on_done, result)
+
+    def _sync(self):
+        """ Flushes the copied files and the directory entries of the moved files, then deletes the sources """
+        copies, self._unsynced_copies = self._unsynced_copies, []
+        dirs, self._unsynced_dirs = self._unsynced_dirs, set()
+        copies = [(path, src) for path, src in copies if self._fsync(path, os.O_RDONLY)]
+        synced_dirs = {path for path in dirs if self._fsync(path, os.O_RDONLY | os.O_DIRECTORY)}
+        for path, src in copies:
+            if os.path.dirname(path) not in synced_dirs:
+                # the source is kept while the copy is not on disk
+                continue
+            try:
+                os.unlink(src)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning('Unable to delete the moved file %s: %s', src, e)
+
+    @staticmethod
+    def _fsync(path, flags) -> bool:
+        try:
+            fd = os.open(path, flags)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug('Unable to sync %s: %s', path, e)
+            return False
+        return True
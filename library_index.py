@@ -0,0 +1,155 @@
+# rhythmbox-telegram
+# Copyright (C) 2023-2026 Andrey Izman <izmanw@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from gi.repository import Gio, GLib
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LIBRARY_INDEX_MAX_DIRS = 512    # Max number of directory listings kept, each one has its own file monitor
+
+
+class DirListing:
+    """ Names of the subdirectories and files of a directory, looked up by the case-folded name """
+
+    def __init__(self, path):
+        self.dirs: Dict[str, str] = {}      # Case-folded name -> name
+        self.files: Dict[str, str] = {}
+        self._names: Dict[str, bool] = {}   # Name -> whether it is a directory
+        with os.scandir(path) as items:
+            for item in items:
+                self.add(item.name, item.is_dir())
+
+    def add(self, name, is_dir):
+        """ Adds the item, the first one of the names which differ only in case is found by the lookups """
+        self._names[name] = is_dir
+        (self.dirs if is_dir else self.files).setdefault(name.casefold(), name)
+
+    def remove(self, name):
+        """ Removes the item, another name which differs only in case takes its place """
+        is_dir = self._names.pop(name, None)
+        if is_dir is None:
+            return
+        names = self.dirs if is_dir else self.files
+        key = name.casefold()
+        if names.get(key) == name:
+            del names[key]
+            other = next((n for n, d in self._names.items() if d == is_dir and n.casefold() == key), None)
+            if other is not None:
+                names[key] = other
+
+
+class LibraryIndex:
+    """
+    Case-insensitive lookups of directories and files in the library tree.
+    A directory is listed on the first lookup, then the listing is kept fresh by a file monitor,
+    so resolving the path of a track takes a dictionary lookup per path component.
+    Lookups may run in the FileMover worker thread, the monitor events are applied by the main loop
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._listings: Dict[str, Tuple[DirListing, Optional[Gio.FileMonitor]]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def find_dir(self, parent, name) -> Optional[str]:
+        """ Get path of the subdirectory whose name matches ignoring case """
+        with self._lock:
+            listing = self._get(parent)
+            found = listing.dirs.get(name.casefold()) if listing else None
+        return os.path.join(parent, found) if found else None
+
+    def find_file(self, parent, name) -> Optional[str]:
+        """ Get path of the file whose name matches ignoring case """
+        with self._lock:
+            listing = self._get(parent)
+            found = listing.files.get(name.casefold()) if listing else None
+        return os.path.join(parent, found) if found else None
+
+    def add(self, path, is_dir):
+        """ Adds a directory or a file created by the plugin, before its monitor event arrives """
+        parent, name = os.path.split(path)
+        with self._lock:
+            item = self._listings.get(parent)
+            if item:
+                item[0].add(name, is_dir)
+
+    def invalidate(self, path):
+        """ Drops the listings of the directory and of its subdirectories """
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._lock:
+            for key in [key for key in self._listings if key == path or key.startswith(prefix)]:
+                self._drop(key)
+
+    def close(self):
+        """ Drops all listings and cancels their monitors """
+        with self._lock:
+            for key in list(self._listings):
+                self._drop(key)
+
+    def _get(self, path) -> Optional[DirListing]:
+        item = self._listings.get(path)
+        if item:
+            self._listings.move_to_end(path)
+            return item[0]
+        try:
+            listing = DirListing(path)
+        except OSError:
+            return None
+        monitor = None
+        try:
+            monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect('changed', self._changed_cb, path)
+        except GLib.Error as e:
+            # without a monitor the listing is only updated by add()
+            logger.warning('Unable to monitor the library directory %s: %s', path, e)
+        self._listings[path] = (listing, monitor)
+        while len(self._listings) > LIBRARY_INDEX_MAX_DIRS:
+            self._drop(next(iter(self._listings)))
+        return listing
+
+    def _drop(self, path):
+        _listing, monitor = self._listings.pop(path)
+        if monitor:
+            monitor.cancel()
+
+    def _changed_cb(self, monitor, file, other_file, event, path):
+        """ Applies the changes of the directory to its listing """
+        with self._lock:
+            item = self._listings.get(path)
+            if not item:
+                return
+            listing = item[0]
+            if event in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.MOVED_IN):
+                self._add_path(listing, file.get_path())
+            elif event in (Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT):
+                self._remove_path(listing, file.get_path())
+            elif event == Gio.FileMonitorEvent.RENAMED:
+                self._remove_path(listing, file.get_path())
+                self._add_path(listing, other_file.get_path())
+
+    @staticmethod
+    def _add_path(listing, path):
+        if os.path.exists(path):
+            listing.add(os.path.basename(path), os.path.isdir(path))
+
+    def _remove_path(self, listing, path):
+        listing.remove(os.path.basename(path))
+        self.invalidate(path)
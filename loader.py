@@ -14,20 +14,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import heapq
 import os
-import re
-import shutil
+import time
+from collections import OrderedDict
 from gi.repository import RB # type: ignore
 from gi.repository import GLib
-from account import KEY_FOLDER_HIERARCHY, KEY_CONFLICT_RESOLVE, KEY_FILENAME_TEMPLATE
-from account import KEY_DETECT_DIRS_IGNORE_CASE, KEY_DETECT_FILES_IGNORE_CASE
+from account import KEY_FOLDER_HIERARCHY, KEY_CONFLICT_RESOLVE, KEY_FILENAME_TEMPLATE, KEY_DOWNLOAD_CONCURRENCY
+from account import KEY_DETECT_DIRS_IGNORE_CASE, KEY_DETECT_FILES_IGNORE_CASE, KEY_AUDIO_ONLY_HISTORY
 from common import CONFLICT_ACTION_RENAME, CONFLICT_ACTION_REPLACE, CONFLICT_ACTION_SKIP, CONFLICT_ACTION_ASK, CONFLICT_ACTION_IGNORE
-from common import get_entry_location, clean_telegram_title, idle_add_once, is_msg_valid
+from common import get_entry_location, clean_telegram_title, idle_add_once, is_msg_valid, to_location, get_location_data
 from common import filepath_parse_pattern, SingletonMeta, get_entry_state, set_entry_state
 from conflict_dialog import ConflictDialog
-from storage import PinnedMessage, Playlist, Audio, SEGMENT_START, SEGMENT_END
+from file_mover import FileMover, move_file
+from library_index import LibraryIndex
+from storage import PinnedMessage, Playlist, Audio, SEGMENT_START, SEGMENT_END, JOB_QUEUED, JOB_ACTIVE, JOB_FAILED
 from telegram_client import TelegramApi, API_ALL_MESSAGES_LOADED, LAST_MESSAGE_ID
-from typing import Tuple, Any, Callable, TypedDict, Dict, Tuple
+from typing import Callable, TypedDict, Dict
+
+# TDLib download priorities (1-32) of the AudioTempLoader request classes
+TEMP_PRIORITY_PLAYING = 32
+TEMP_PRIORITY_NEXT = 24
+TEMP_PRIORITY_PREV = 16
+TEMP_PRIORITY_CLICK = 8
+
+DOWNLOAD_MAX_ATTEMPTS = 5           # Failed downloads of the library downloader are retried up to this number
+DOWNLOAD_RETRY_DELAY = 30           # Seconds before the first retry, doubled after every failed attempt
+DOWNLOAD_RETRY_MAX_DELAY = 1800     # Max seconds between the retries
 
 
 class AbsAudioLoader:
@@ -55,91 +68,167 @@ class AbsAudioLoader:
 class AudioTempLoader(AbsAudioLoader, metaclass=SingletonMeta):
     """
     AudioTempLoader is designed to sequentially download audio files into a temp directory.
-    The most recently added records to the queue are loaded first.
-    The downloading process is assigned the highest priority level.
+    Entries are loaded by priority class: the playing track first, then the next track,
+    the previous track and the manually requested ones, the most recently added first within a class.
+    A request of a higher class raises the TDLib priority of the same download in progress,
+    or pre-empts a download of another entry, which goes back to the queue and resumes later.
     """
     def __init__(self, plugin):
         AbsAudioLoader.__init__(self, plugin)
-        self._is_hidden = False
+        self._heap = []             # (-priority, -seq, uri), entries with outdated priority are skipped
+        self._priorities = {}       # uri -> priority of the queued entries
+        self._seq = 0               # Insertion counter, keeps the newest entries first within a class
+        self._current = None        # Download in progress
 
-    def add_entry(self, entry):
-        """ Adds an entry to the queue if it is not already in the library or being loaded. """
+    def stop(self):
+        """ Stops the loader and resets the queue. """
+        AbsAudioLoader.stop(self)
+        self._heap = []
+        self._priorities = {}
+        self._current = None
+
+    def add_entry(self, entry, priority=TEMP_PRIORITY_CLICK):
+        """
+        Adds an entry to the queue if it is not already in the library or being loaded.
+        An entry which is already queued or being loaded by this loader gets the higher of the priorities.
+        """
         state = get_entry_state(entry)
-        if state != Audio.STATE_IN_LIBRARY and state != Audio.STATE_LOADING:
-            uri = get_entry_location(entry)
-            if uri not in self._queue:
-                self._queue.append(uri)
-                set_entry_state(self.plugin.db, entry, Audio.STATE_LOADING)
-                self.plugin.db.commit()
+        if state == Audio.STATE_IN_LIBRARY:
+            return self
+        uri = get_entry_location(entry)
+        current = self._current
+        if current and current['uri'] == uri:
+            if priority > current['priority']:
+                current['priority'] = priority
+                if current['file_id'] is not None:
+                    self.plugin.api.set_download_priority(current['file_id'], priority)
+            return self
+        queued = self._priorities.get(uri)
+        if queued is None and state == Audio.STATE_LOADING:
+            # being loaded by another loader
+            return self
+        if queued is None or priority > queued:
+            self._push(uri, priority)
+        if queued is None:
+            set_entry_state(self.plugin.db, entry, Audio.STATE_LOADING)
+            self.plugin.db.commit()
+        if current and priority > current['priority']:
+            self._preempt()
         return self
 
     def start(self):
         """ Starts the loader if there are items in the queue. """
-        if len(self._queue) > 0:
+        if self._priorities:
             if not self._running:
                 self._running = True
-                self._idx = len(self._queue) - 1
                 self._load()
-        else:
+        elif not self._current:
             self.stop()
         return self
 
-    def _process(self, audio):
+    def _push(self, uri, priority):
+        self._seq += 1
+        self._priorities[uri] = priority
+        heapq.heappush(self._heap, (-priority, -self._seq, uri))
+
+    def _pop(self):
+        """ Removes the entry with the highest priority from the queue and returns it. """
+        while self._heap:
+            priority, _, uri = heapq.heappop(self._heap)
+            if self._priorities.get(uri) == -priority:
+                del self._priorities[uri]
+                return uri, -priority
+        return None, 0
+
+    def _preempt(self):
+        """ Cancels the download in progress and returns its entry to the queue. """
+        current, self._current = self._current, None
+        self._push(current['uri'], current['priority'])
+        if current['file_id'] is not None:
+            self.plugin.api.cancel_download(current['file_id'])
+        if self._running:
+            idle_add_once(self._load)
+
+    def _set_file(self, job, file_id):
+        """ Keeps the TDLib file id of the job, applies the changes requested while the message was loaded. """
+        job['file_id'] = file_id
+        if job is not self._current:
+            self.plugin.api.cancel_download(file_id)
+        elif job['priority'] > job['started_priority']:
+            self.plugin.api.set_download_priority(file_id, job['priority'])
+
+    def _process(self, job, audio):
         """ Processes the downloaded audio file and updates the entry in the database. """
-        entry = self.get_entry(self._idx)
-        if not entry:
-            self._next(20)
-            return
-        if self._is_hidden:
-            self._is_hidden = False
-            audio.save({"is_hidden": True})
-        audio.update_entry(entry)
-        idle_add_once(entry.get_entry_type().emit, 'entry_downloaded', entry)
-        self._next(500)
+        entry = self.plugin.db.entry_lookup_by_location(job['uri'])
+        if entry:
+            if job['is_hidden']:
+                audio.save({"is_hidden": True})
+            audio.update_entry(entry)
+            idle_add_once(entry.get_entry_type().emit, 'entry_downloaded', entry)
+        self.plugin.temp_cache.touch(audio)
+        self.plugin.temp_cache.check()
+        if job is self._current:
+            self._next(500)
 
     def _next(self, delay=1000):
         """ Moves to the next entry in the queue after a delay. """
-        self._is_hidden = False
-        del self._queue[self._idx]
-        self._idx = len(self._queue) - 1
-        if self._idx < 0:
+        self._current = None
+        if not self._priorities:
             self.stop()
             return
         GLib.timeout_add(delay, self._load)
 
-    def _fail(self):
-        entry = self.get_entry(self._idx)
-        audio = self.plugin.storage.get_entry_audio(entry)
-        audio.is_error = True
-        set_entry_state(self.plugin.db, entry, audio.get_state())
-        self.plugin.db.commit()
+    def _fail(self, job):
+        if job is not self._current:
+            # pre-empted, the entry is queued again
+            return
+        entry = self.plugin.db.entry_lookup_by_location(job['uri'])
+        audio = self.plugin.storage.get_entry_audio(entry) if entry else None
+        if audio:
+            audio.is_error = True
+            set_entry_state(self.plugin.db, entry, audio.get_state())
+            self.plugin.db.commit()
         self._next(20)
 
     def _load(self):
         """ Loads the next audio file in the queue. """
-        if self._running:
-            entry = self.get_entry(self._idx)
-            if not entry:
-                self._next(20)
-                return
-            audio = self.plugin.storage.get_entry_audio(entry)
-            if not audio:
-                self._next(20)
-                return
-            file_path = audio.get_path()
-            if file_path:
-                set_entry_state(self.plugin.db, entry, audio.get_state())
-                self.plugin.db.commit()
-                self._next(20)
-            else:
-                self._is_hidden = audio.is_hidden
-                audio.download(success=self._process, fail=self._fail)
+        if not self._running or self._current:
+            return
+        uri, priority = self._pop()
+        if uri is None:
+            self.stop()
+            return
+        entry = self.plugin.db.entry_lookup_by_location(uri)
+        audio = self.plugin.storage.get_entry_audio(entry) if entry else None
+        if not audio:
+            self._next(20)
+            return
+        file_path = audio.get_path()
+        if file_path:
+            set_entry_state(self.plugin.db, entry, audio.get_state())
+            self.plugin.db.commit()
+            self._next(20)
+        else:
+            job = {
+                "uri": uri,
+                "priority": priority,
+                "started_priority": priority,
+                "file_id": None,    # TDLib file id, known once the message is loaded
+                "is_hidden": audio.is_hidden,
+            }
+            self._current = job
+            audio.download(success=lambda a: self._process(job, a), fail=lambda: self._fail(job),
+                           priority=priority, on_file=lambda file_id: self._set_file(job, file_id))
 
 
 class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
     """
-    AudioDownloader is designed to sequentially download audio files into a Music library.
-    The first entries added to the queue are downloaded first.
+    AudioDownloader is designed to download audio files into a Music library.
+    Up to `concurrency` files are downloaded at the same time, the first entries added to the queue
+    are started first. Files are moved into the library one at a time, in queue order within an album,
+    the file operations run in the FileMover worker thread.
+    Every entry has a job in the download_job table until its file is in the library, the jobs left
+    by the previous session are resumed, failed downloads are retried with a growing delay.
     The downloading process is assigned a medium priority level.
     """
     library_location: str           # Path to the music library
@@ -148,12 +237,24 @@ class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
     filename_template: str          # Filename template
     detect_dirs_ignore_case: bool   # Whether to ignore case when detecting directories
     detect_files_ignore_case: bool  # Whether to ignore case when detecting files
+    concurrency: int                # Max number of files downloaded at the same time
 
     def __init__(self, plugin):
         AbsAudioLoader.__init__(self, plugin)
         self._info = {}             # Information about the current download progress
-        self.processing_uri = None  # URI of the currently processing entry
+        self._downloading = set()   # Queue indices of entries being downloaded
+        self._downloaded = {}       # Queue index -> downloaded audio waiting to be moved (None if failed)
+        self._albums = {}           # Album key -> queue indices of started entries, in queue order
+        self._album_keys = {}       # Queue index -> album key
+        self._moving = None         # Queue index of the entry being moved into the library
+        self._moving_album = None   # Album key of the entry being moved
+        self._move_id = 0           # Counter of the started moves, tells a stale move callback after a restart
+        self._finished = 0          # Number of processed entries
+        self._jobs = {}             # Uri -> number of failed attempts, of the unfinished jobs
+        self._retries = {}          # Uri -> timer of the retry
         self.is_canceled = False
+        self.library_index = None   # Case-insensitive index of the library tree
+        self.mover = FileMover()
         self.setup()
 
     def setup(self):
@@ -164,36 +265,114 @@ class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
         self.filename_template = self.plugin.settings[KEY_FILENAME_TEMPLATE]
         self.detect_dirs_ignore_case = self.plugin.settings[KEY_DETECT_DIRS_IGNORE_CASE]
         self.detect_files_ignore_case = self.plugin.settings[KEY_DETECT_FILES_IGNORE_CASE]
-
-    def add_entries(self, entries):
+        self.concurrency = max(1, int(self.plugin.settings[KEY_DOWNLOAD_CONCURRENCY]))
+        if self.library_index is None or self.library_index.root != self.library_location:
+            if self.library_index is not None:
+                self.library_index.close()
+            self.library_index = LibraryIndex(self.library_location)
+
+    def release(self):
+        """ Stops the file mover once the submitted moves are done, releases the library index """
+        # the jobs are kept in the storage for the next session
+        for timer_id in self._retries.values():
+            GLib.source_remove(timer_id)
+        self._retries = {}
+        self.mover.stop()
+        if self.library_index is not None:
+            self.library_index.close()
+            self.library_index = None
+
+    def add_entries(self, entries, priority=0):
         """ Adds multiple entries to the queue if they are not already in the library. """
-        commit = False
+        audios = []
         for entry in entries:
             state = get_entry_state(entry)
             if state != Audio.STATE_IN_LIBRARY:
                 uri = get_entry_location(entry)
-                if uri not in self._queue:
+                audio = self.plugin.storage.get_entry_audio(entry) if uri not in self._jobs else None
+                if audio:
                     self._queue.append(uri)
+                    self._jobs[uri] = 0
+                    audios.append(audio)
                     set_entry_state(self.plugin.db, entry, Audio.STATE_LOADING)
-                    commit = True
+        if audios:
+            self.plugin.storage.add_download_jobs(audios, priority)
+            self.plugin.db.commit()
+
+    def resume(self):
+        """ Queues the unfinished jobs of the previous session and starts the downloader """
+        api = self.plugin.api
+        now = time.time()
+        commit = False
+        for chat_id, message_id, audio_id, attempts, retry_at in self.plugin.storage.get_download_jobs():
+            uri = to_location(api.hash, chat_id, message_id, audio_id)
+            if uri in self._jobs:
+                continue
+            self._jobs[uri] = attempts
+            if retry_at > now:
+                self._retries[uri] = GLib.timeout_add_seconds(int(retry_at - now) + 1, self._retry_cb, uri)
+            else:
+                self._queue.append(uri)
+            entry = self.plugin.db.entry_lookup_by_location(uri)
+            if entry:
+                set_entry_state(self.plugin.db, entry, Audio.STATE_LOADING)
+                commit = True
         if commit:
             self.plugin.db.commit()
+        if self._queue or self._retries:
+            self.setup()
+            if self._running:
+                self._fill()
+            else:
+                self.start()
+
+    def has_job(self, uri):
+        """ Whether the entry is queued for the library """
+        return uri in self._jobs
 
     def cancel(self):
-        """ Cancels the current download process and resets the state of entries in the queue. """
+        """
+        Cancels the download process and resets the state of entries which are not started yet.
+        Files already being downloaded are finished and moved into the library.
+        """
         if not self.is_canceled:
             self.is_canceled = True
-            for uri in self._queue:
-                if self.processing_uri != uri and uri is not None:
-                    entry = self.plugin.db.entry_lookup_by_location(uri)
-                    if entry:
-                        audio = self.plugin.storage.get_entry_audio(entry)
-                        if audio:
-                            set_entry_state(self.plugin.db, entry, audio.get_state())
+            for timer_id in self._retries.values():
+                GLib.source_remove(timer_id)
+            for uri in [*self._queue[self._idx:], *self._retries]:
+                if uri is not None:
+                    self._jobs.pop(uri, None)
+                    self._reset_state(uri)
+            self._retries = {}
+            self.plugin.storage.delete('download_job', {'state': JOB_QUEUED})
+            self.plugin.db.commit()
+            self._check_done()
+
+    def _reset_state(self, uri):
+        """ Resets the loading state of the entry which is not downloaded """
+        entry = self.plugin.db.entry_lookup_by_location(uri)
+        if entry and get_entry_state(entry) == Audio.STATE_LOADING:
+            audio = self.plugin.storage.get_entry_audio(entry)
+            if audio:
+                set_entry_state(self.plugin.db, entry, audio.get_state())
 
     def stop(self):
         """ Stops the downloader and updates the progress information. """
+        # entries left in the queue must not stay in the loading state
+        stale = [uri for uri in self._queue if uri is not None and uri not in self._retries]
+        for uri in stale:
+            # the job stays in the table for resume(), the entry can be queued again in this session
+            self._jobs.pop(uri, None)
+            self._reset_state(uri)
+        if stale:
+            self.plugin.db.commit()
         AbsAudioLoader.stop(self)
+        self._downloading = set()
+        self._downloaded = {}
+        self._albums = {}
+        self._album_keys = {}
+        self._moving = None
+        self._finished = 0
         self.is_canceled = False
         self._update_progress()
 
@@ -204,7 +383,8 @@ class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
                 self._info = {}
                 self._running = True
                 self._idx = 0
-                self._load()
+                self._finished = 0
+                self._fill()
             else:
                 self._update_progress()
         else:
@@ -222,54 +402,125 @@ class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
         total = len(self._queue)
         info = {
             "active": self._running,
-            "index": self._idx + 1,
+            "index": min(self._finished + 1, total),
             "total": total,
+            "downloading": len(self._downloading),
             "filename": filename if len(filename) else self._info.get('filename', ''),
-            "fraction": self._idx / total if total > 0 else 1.0,
+            "fraction": self._finished / total if total > 0 else 1.0,
         }
         self._info = info
         self.plugin.emit('update_download_info', info)
 
     def _move_file(self, action, src, dst):
-        """ Moves a file from the source to the destination, handling conflicts based on the specified action. """
+        """
+        Moves a file from the source to the destination, handling conflicts based on the specified action.
+        Runs in the FileMover worker thread
+        """
         dst_dir = str(os.path.dirname(dst)).rstrip('/')
         os.makedirs(dst_dir, exist_ok=True)
 
-        if action == CONFLICT_ACTION_SKIP:
-            if os.path.exists(dst):
-                print(f"File '{dst}' already exists. Skipping.")
-                return dst
-            else:
-                shutil.move(src, dst)
-
-        elif action == CONFLICT_ACTION_REPLACE:
-            shutil.move(src, dst)
+        if action == CONFLICT_ACTION_SKIP and os.path.exists(dst):
+            print(f"File '{dst}' already exists. Skipping.")
+            return dst
 
-        elif action == CONFLICT_ACTION_RENAME:
-            dst_base = os.path.basename(dst)
-            name, ext = os.path.splitext(dst_base)
+        if action == CONFLICT_ACTION_RENAME:
+            name, ext = os.path.splitext(os.path.basename(dst))
             counter = 1
-            new_dst = dst
-            while os.path.exists(new_dst):
-                new_dst = os.path.join(dst_dir, f"{name} ({counter}){ext}")
+            while os.path.exists(dst):
+                dst = os.path.join(dst_dir, f"{name} ({counter}){ext}")
                 counter += 1
-            shutil.move(src, new_dst)
-            return new_dst
+
+        if action in (CONFLICT_ACTION_SKIP, CONFLICT_ACTION_REPLACE, CONFLICT_ACTION_RENAME):
+            copied = move_file(src, dst, keep_src=True)
+            self.mover.moved(dst, src if copied else None)
+            self.library_index.add(dst, False)
         return dst
 
     def _move_audio_and_update(self, action, audio, filename):
-        """ Moves the audio file to the library and updates the entry in the database. """
-        entry = self.get_entry(self._idx)
-        if not entry:
-            self._next(20)
+        """ Moves the audio file to the library in the worker thread, then updates the entry in the database. """
+        idx, move_id = self._moving, self._move_id
+        uri = self._queue[idx] if idx is not None else None
+        entry = self.get_entry(idx) if idx is not None else None
+        if idx is not None and action != CONFLICT_ACTION_IGNORE:
+            self.mover.submit(self._move_file, (action, audio.local_path, filename),
+                              on_done=lambda dst: self._moved(idx, move_id, uri, entry, audio, dst),
+                              on_error=lambda e: self._move_failed(idx, move_id, uri, entry, audio, e),
+                              album=self._moving_album)
+        else:
+            self._moved(idx, move_id, uri, entry, audio, None)
+
+    def _moved(self, idx, move_id, uri, entry, audio, filename):
+        """ The file is moved into the library, or left in place if filename is None """
+        if uri is not None:
+            if filename is not None:
+                audio.save({"local_path": filename, "is_moved": True})
+            # the file is in the library even if the downloader was stopped meanwhile
+            self._job_done(uri)
+        if entry:
+            audio.update_entry(entry)
+            idle_add_once(self.plugin.emit, 'entry_added_to_library', entry)
+            idle_add_once(entry.get_entry_type().emit, 'entry_downloaded', entry)
+        self._moved_next(idx, move_id)
+
+    def _move_failed(self, idx, move_id, uri, entry, audio, error):
+        audio.is_error = True
+        if self._is_moving(idx, move_id):
+            # the job of a stopped downloader is kept, it is resumed with the next start
+            self._job_failed(uri, str(error))
+        if entry:
+            set_entry_state(self.plugin.db, entry, audio.get_state())
+            self.plugin.db.commit()
+        self._moved_next(idx, move_id)
+
+    def _job_key(self, uri):
+        chat_id, message_id = get_location_data(uri)
+        return {'chat_id': int(chat_id), 'message_id': int(message_id)}
+
+    def _job_done(self, uri):
+        """ The file is in the library or the job is not needed anymore """
+        self._jobs.pop(uri, None)
+        self.plugin.storage.delete('download_job', self._job_key(uri))
+
+    def _job_failed(self, uri, error):
+        """ The job is not retried anymore, it is kept with the error until the entry is downloaded again """
+        attempts = self._jobs.pop(uri, 0) + 1
+        self.plugin.storage.update('download_job', {'state': JOB_FAILED, 'attempts': attempts, 'last_error': error},
+                                   self._job_key(uri))
+
+    def _job_retry(self, uri, error) -> bool:
+        """ Schedules the retry of the failed download, returns False when the attempts are exhausted """
+        attempts = self._jobs.get(uri, 0) + 1
+        if attempts >= DOWNLOAD_MAX_ATTEMPTS or self.is_canceled:
+            self._job_failed(uri, error)
+            return False
+        self._jobs[uri] = attempts
+        delay = min(DOWNLOAD_RETRY_DELAY * 2 ** (attempts - 1), DOWNLOAD_RETRY_MAX_DELAY)
+        self.plugin.storage.update('download_job', {'state': JOB_QUEUED, 'attempts': attempts, 'last_error': error,
+                                                    'retry_at': int(time.time()) + delay}, self._job_key(uri))
+        self._retries[uri] = GLib.timeout_add_seconds(delay, self._retry_cb, uri)
+        return True
+
+    def _retry_cb(self, uri):
+        """ Queues the failed entry again """
+        self._retries.pop(uri, None)
+        self._queue.append(uri)
+        if self._running:
+            self._fill()
+        else:
+            self.start()
+        return False
+
+    def _is_moving(self, idx, move_id):
+        """ Whether the move is still in progress, the downloader may be stopped or restarted meanwhile """
+        return idx is not None and idx == self._moving and move_id == self._move_id
+
+    def _moved_next(self, idx, move_id):
+        if not self._is_moving(idx, move_id):
+            # the downloader is stopped while the file was moved
             return
-        if action != CONFLICT_ACTION_IGNORE:
-            filename = self._move_file(action, audio.local_path, filename)
-            audio.save({"local_path": filename, "is_moved": True})
-        audio.update_entry(entry)
-        idle_add_once(self.plugin.emit, 'entry_added_to_library', entry)
-        idle_add_once(entry.get_entry_type().emit, 'entry_downloaded', entry)
-        self._next(300)
+        self._moving = None
+        self._finish(idx)
+        idle_add_once(self._next)
 
     def _create_dirs(self, root, directory):
         """ Creates directories based on the folder hierarchy, optionally ignoring case. """
@@ -279,20 +530,15 @@ class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
             return path
 
         current_path = root
-        dirs = directory.split('/')
-
-        for dir_name in dirs:
-            pattern = re.compile(re.escape(dir_name), re.IGNORECASE)
-            found = False
-            for item in os.listdir(current_path):
-                if os.path.isdir(os.path.join(current_path, item)) and pattern.fullmatch(item):
-                    current_path = os.path.join(current_path, item)
-                    found = True
-                    break
-            if not found:
-                new_dir = os.path.join(current_path, dir_name)
-                os.makedirs(new_dir)
-                current_path = new_dir
+        for dir_name in directory.split('/'):
+            if not dir_name:
+                continue
+            found = self.library_index.find_dir(current_path, dir_name)
+            if found is None:
+                found = os.path.join(current_path, dir_name)
+                os.makedirs(found, exist_ok=True)
+                self.library_index.add(found, True)
+            current_path = found
         return current_path
 
     def _get_filename(self, filename):
@@ -300,164 +546,363 @@ class AudioDownloader(AbsAudioLoader, metaclass=SingletonMeta):
         if not self.detect_files_ignore_case:
             return filename
 
-        dirpath = os.path.dirname(filename)
-        basename = os.path.basename(filename)
-        pattern = re.compile(re.escape(basename), re.IGNORECASE)
-
-        for item in os.listdir(dirpath):
-            if os.path.isfile(os.path.join(dirpath, item)) and pattern.fullmatch(item):
-                return os.path.join(dirpath, item)
-        return filename
+        dirpath, basename = os.path.split(filename)
+        return self.library_index.find_file(dirpath, basename) or filename
 
     def _process(self, audio):
         """ Processes the downloaded audio file, moving it to the library and updating the database. """
-        tags = {
-            'title': audio.title,
-            'artist': audio.artist,
-            'album_artist': audio.get_album_artist(),
-            'album': audio.album,
-            'track_number': audio.track_number,
-            'date': audio.date,
-            'duration': audio.duration,
-            'genre': audio.genre,
-            'year': audio.get_year(),
-        }
+        tags = audio.get_tags()
         audio.meta_tags = tags
 
         filedir = filepath_parse_pattern(self.folder_hierarchy, tags)
-        filepath = self._create_dirs(self.library_location, filedir)
         file_ext = audio.get_file_ext()
         extension = f'.{file_ext}' if len(file_ext) else ''
         basename = filepath_parse_pattern(self.filename_template, tags)
-        filename = '%s/%s%s' % (filepath, basename, extension)
-        filename = self._get_filename(filename)
+        idx, move_id = self._moving, self._move_id
+        uri = self._queue[idx]
+        entry = self.get_entry(idx)
+        self.mover.submit(self._resolve_filename, (filedir, basename + extension),
+                          on_done=lambda result: self._resolved(idx, move_id, audio, *result),
+                          on_error=lambda e: self._move_failed(idx, move_id, uri, entry, audio, e),
+                          album=self._moving_album)
+
+    def _resolve_filename(self, filedir, name):
+        """ Creates the directories of the file, returns its path and whether it exists. Runs in the worker thread """
+        filepath = self._create_dirs(self.library_location, filedir)
+        filename = self._get_filename('%s/%s' % (filepath, name))
+        return filename, os.path.exists(filename)
 
+    def _resolved(self, idx, move_id, audio, filename, exists):
+        """ Asks how to resolve the conflict with the existing file, then moves the file """
+        if not self._is_moving(idx, move_id):
+            # the downloader is stopped while the file name was resolved
+            return
         if self.conflict_resolve == CONFLICT_ACTION_ASK:
-            if os.path.exists(filename):
+            if exists:
                 ConflictDialog(self.plugin, audio, filename, self._move_audio_and_update)
             else:
                 self._move_audio_and_update(CONFLICT_ACTION_REPLACE, audio, filename)
         else:
             self._move_audio_and_update(self.conflict_resolve, audio, filename)
 
-    def _next(self, delay=1000):
-        """ Moves to the next entry in the queue after a delay """
-        self.processing_uri = None
-        self._queue[self._idx] = None
-        self._idx = self._idx + 1
-        if self._idx >= len(self._queue) or self.is_canceled:
-            self.stop()
-            return
-        GLib.timeout_add(delay, self._load)
+    def _finish(self, idx):
+        """ Marks the queue entry as processed """
+        self._queue[idx] = None
+        self._finished += 1
+        self._update_progress()
 
-    def _fail(self):
-        entry = self.get_entry(self._idx)
-        audio = self.plugin.storage.get_entry_audio(entry)
-        audio.is_error = True
-        set_entry_state(self.plugin.db, entry, audio.get_state())
-        self.plugin.db.commit()
-        self._next(20)
+    def _check_done(self):
+        """ Stops the downloader when nothing is left to download or to move """
+        if self._running and not self._downloading and not self._downloaded and self._moving is None \
+                and not self._retries and (self._idx >= len(self._queue) or self.is_canceled):
+            self.stop()
 
-    def _load(self):
-        """ Loads the next audio file in the queue """
-        if self._running:
-            self.processing_uri = self._queue[self._idx]
-            entry = self.get_entry(self._idx)
-            if not entry:
-                self._next(20)
+    def _next(self):
+        """ Moves downloaded files and starts next downloads """
+        self._move_next()
+        self._fill()
+
+    def _fill(self):
+        """ Starts downloads until the concurrency limit is reached """
+        while self._running and not self.is_canceled and self._idx < len(self._queue) \
+                and len(self._downloading) < self.concurrency:
+            idx = self._idx
+            self._idx += 1
+            self._load(idx)
+        self._check_done()
+
+    def _move_next(self):
+        """ Moves downloaded files into the library one at a time, keeping the queue order within an album """
+        while self._running and self._moving is None:
+            idx = next((indices[0] for indices in self._albums.values() if indices[0] in self._downloaded), None)
+            if idx is None:
                 return
+            key = self._album_keys.pop(idx)
+            self._albums[key].pop(0)
+            if not self._albums[key]:
+                del self._albums[key]
+            audio = self._downloaded.pop(idx)
+            if audio is None:
+                self._finish(idx)
+                continue
+            self._moving = idx
+            self._move_id += 1
+            self._moving_album = key
+            self._process(audio)
+
+    def _downloaded_cb(self, idx, audio):
+        """ Download of the queue entry is completed """
+        self._downloading.discard(idx)
+        if self._running:
+            self._downloaded[idx] = audio
+            self._next()
+
+    def _fail(self, idx):
+        self._downloading.discard(idx)
+        if not self._running:
+            return
+        entry = self.get_entry(idx)
+        if not self._job_retry(self._queue[idx], 'Download failed') and entry:
             audio = self.plugin.storage.get_entry_audio(entry)
-            if not audio:
-                self._next(20)
-                return
-            self._update_progress(audio)
-            if audio.is_moved:
+            if audio:
+                audio.is_error = True
                 set_entry_state(self.plugin.db, entry, audio.get_state())
                 self.plugin.db.commit()
-                self._next(20)
-                return
-            file_path = audio.get_path()
-            if file_path:
-                self._process(audio)
-            else:
-                audio.download(success=self._process, fail=self._fail)
+        # unblocks the next files of the album
+        self._downloaded[idx] = None
+        self._next()
+
+    def _load(self, idx):
+        """ Starts processing of the queue entry, the entry is not created yet for the resumed jobs """
+        uri = self._queue[idx]
+        chat_id, message_id = get_location_data(uri)
+        audio = self.plugin.storage.get_audio(chat_id, message_id)
+        if not audio:
+            self._job_done(uri)
+            self._finish(idx)
+            return
+        entry = self.get_entry(idx)
+        self._update_progress(audio)
+        if audio.is_moved:
+            self._job_done(uri)
+            if entry:
+                set_entry_state(self.plugin.db, entry, audio.get_state())
+                self.plugin.db.commit()
+            self._finish(idx)
+            return
+        self.plugin.storage.update('download_job', {'state': JOB_ACTIVE}, self._job_key(uri))
+        key = (audio.chat_id, audio.get_album_artist(), audio.album)
+        self._album_keys[idx] = key
+        self._albums.setdefault(key, []).append(idx)
+        self._downloading.add(idx)
+        if audio.get_path():
+            # already in the temp directory, deferred to avoid recursion through _fill()
+            idle_add_once(self._downloaded_cb, idx, audio)
+        else:
+            audio.download(success=lambda a: self._downloaded_cb(idx, a), fail=lambda: self._fail(idx))
 
 
-MAX_PAGES_SHORT_INTERVAL = 10  # Maximum number of pages to load with a short interval
 SIGNAL_REACHED_NEXT  = 'SIGNAL_REACHED_NEXT'  # Signal for reaching the next segment
 
-INTERVAL_SHORT  = 5000    # 5 seconds
-INTERVAL_MEDIUM = 20000   # 20 seconds
 INTERVAL_LONG   = 120000  # 2 minutes
+INTERVAL_MAX    = 960000  # 16 minutes, refresh interval of channels without new audio
+INTERVAL_RETRY  = 30000   # 30 seconds, retry of a page request which timed out
+
+SYNC_MAX_IN_FLIGHT = 2    # Max number of channels waiting for a page at the same time
 
+HISTORY_PAGE_LIMIT = 50   # Messages per page when reading the whole history
+AUDIO_PAGE_LIMIT = 100    # Messages per page when searching the history for audio messages
 
-class PlaylistTimer(metaclass=SingletonMeta):
+
+class SyncScheduler(metaclass=SingletonMeta):
     """
-    A singleton class for managing a timer used in playlist loading.
+    Background sync of all channels. Every channel has its own PlaylistLoader with a cursor in its history.
+    Loaders take turns in round-robin order and at most SYNC_MAX_IN_FLIGHT of them wait for a page
+    at the same time. The visible channel goes first.
+    New, edited and deleted messages of the channels are pushed by the TDLib updates,
+    so the refresh only catches up what the updates could miss.
     """
-    _props: Tuple[Any, Any] | None
-    _timer_id: int | None
-
-    def __init__(self):
-        self._props = None
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self._loaders: Dict[int, PlaylistLoader] = OrderedDict()   # chat_id -> loader, in round-robin order
+        self._channels = None       # Chat ids of the selected channels, None for all
+        self._visible = None        # Loader of the visible channel
+        self._in_flight = set()     # Chat ids of the loaders waiting for a page
         self._timer_id = None
 
-    def add(self, interval, callback, *args):
-        """ Adds a timer with the specified interval, callback, and arguments """
-        self.remove()
-        self._props = (callback, args)
-        self._timer_id = GLib.timeout_add(interval, self.callback)
+    def add(self, source):
+        """ Creates the loader of the source channel and schedules its first sync """
+        loader = self._loaders.get(source.chat_id)
+        if loader is None:
+            loader = PlaylistLoader(source, source.chat_id, source.add_entry, self)
+            self._loaders[source.chat_id] = loader
+            self._watch()
+            self._reschedule()
+        return loader
+
+    def remove(self, loader):
+        """ Stops the loader and removes it from the schedule """
+        if self._loaders.get(loader.chat_id) is loader:
+            del self._loaders[loader.chat_id]
+            self._in_flight.discard(loader.chat_id)
+            if self._visible is loader:
+                self._visible = None
+            loader.stop()
+            self._watch()
+            self._reschedule()
 
-    def remove(self):
-        """ Removes the timer if it exists """
-        ret = False
-        if self._timer_id:
-            ret = GLib.source_remove(self._timer_id)
-            self._timer_id = None
-        return ret
-
-    def callback(self):
-        """ Executes the callback when the timer triggers """
+    def stop(self):
+        """ Stops all loaders """
+        for loader in list(self._loaders.values()):
+            self.remove(loader)
+        self._remove_timer()
+        api = TelegramApi.loaded()
+        if api:
+            api.unwatch_messages()
+
+    def set_channels(self, chat_ids):
+        """ Limits the sync to the selected channels """
+        self._channels = set(chat_ids)
+        self._watch()
+        self._reschedule()
+
+    def set_visible(self, loader):
+        """ Gives the loader of the visible channel the highest priority """
+        self._visible = loader
+        if loader is not None and not loader.head:
+            # refresh on opening if the last refresh is older than the interval of the visible channel
+            loader.due = min(loader.due, loader.synced_at + INTERVAL_LONG / 1000)
+        self._reschedule()
+
+    def is_visible(self, loader):
+        return self._visible is loader
+
+    def fetch(self, loader):
+        """ Runs the next step of the loader right now, regardless of the in-flight limit """
+        if loader.pending and loader.chat_id not in self._in_flight:
+            self._run(loader)
+            self._reschedule()
+
+    def done(self, loader):
+        """ Called by the loader when the requested page is processed """
+        self._in_flight.discard(loader.chat_id)
+        self._reschedule()
+
+    def messages_added(self, chat_id, message_ids, audios):
+        """ Called by the api with the new messages of the channel """
+        loader = self._loaders.get(chat_id)
+        if loader is not None:
+            loader.push(message_ids, audios)
+
+    def audio_changed(self, audio):
+        """ Called by the api with the audio of an edited message """
+        loader = self._loaders.get(audio.chat_id)
+        if loader is not None:
+            loader.source.refresh_entry(audio)
+
+    def messages_deleted(self, chat_id, audios):
+        """ Called by the api with the audio of the deleted messages """
+        loader = self._loaders.get(chat_id)
+        if loader is not None and audios:
+            loader.source.delete_entries(audios)
+
+    def resync(self):
+        """ Called by the api on reconnect, refreshes all channels as the updates could be missed """
+        for loader in self._loaders.values():
+            loader.head = 0
+            loader.due = 0.0
+        self._reschedule()
+
+    def _watch(self):
+        """ Subscribes to the message updates of the synced channels """
+        api = TelegramApi.loaded()
+        if api:
+            api.watch_messages([chat_id for chat_id in self._loaders
+                                if self._channels is None or chat_id in self._channels], self)
+
+    def _is_ready(self, loader, now):
+        return loader.pending is not None and loader.due <= now and loader.chat_id not in self._in_flight \
+            and (self._channels is None or loader.chat_id in self._channels)
+
+    def _run(self, loader):
+        self._in_flight.add(loader.chat_id)
+        self._loaders.move_to_end(loader.chat_id)
+        loader.run()
+
+    def _tick(self):
         self._timer_id = None
-        if self._props:
-            callback, args = self._props
-            callback(*args)
-            self._props = None
+        now = time.monotonic()
+        while len(self._in_flight) < SYNC_MAX_IN_FLIGHT:
+            if self._visible is not None and self._is_ready(self._visible, now):
+                self._run(self._visible)
+                continue
+            loader = next((ld for ld in self._loaders.values() if self._is_ready(ld, now)), None)
+            if loader is None:
+                break
+            self._run(loader)
+        self._reschedule()
         return False
 
-    def clear(self):
-        """ Clears the timer and its properties """
-        self._timer_id = None
-        self._props = None
+    def _reschedule(self):
+        """ Sets the timer to the time when the next loader is due """
+        self._remove_timer()
+        if len(self._in_flight) >= SYNC_MAX_IN_FLIGHT:
+            return
+        due = [ld.due for ld in self._loaders.values() if self._is_ready(ld, float('inf'))]
+        if due:
+            delay = max(0.0, min(due) - time.monotonic())
+            self._timer_id = GLib.timeout_add(int(delay * 1000), self._tick)
+
+    def _remove_timer(self):
+        if self._timer_id:
+            GLib.source_remove(self._timer_id)
+            self._timer_id = None
 
 
 class PlaylistLoader:
     """
     A class for loading and managing playlists from Telegram.
+    Steps of the loader are run by the SyncScheduler.
     """
     api: TelegramApi
     playlist: Playlist
-    timer: PlaylistTimer
+    scheduler: SyncScheduler
     terminated: bool
     last_msg_id: int
 
     def __str__(self) -> str:
         return f'PlaylistLoader <{self.chat_id}>'
 
-    def __init__(self, source, chat_id, add_entry):
+    def __init__(self, source, chat_id, add_entry, scheduler):
         self.terminated = False
         self.api = TelegramApi.loaded()
         self.source = source
         self.chat_id = chat_id
         self.add_entry = add_entry
-        self.page = 0
-        self.timer = PlaylistTimer()
+        self.scheduler = scheduler
+        self.request = None
+        self.pending = (self.start, ())     # Next step of the loader
+        self.due = 0.0                      # Monotonic time when the next step is due
+        self.synced_at = 0.0                # Monotonic time when the history was last read up to the end
+        self.backoff = INTERVAL_LONG        # Interval of the next refresh, grows while there is no new audio
+        self.found = False                  # Whether new audio is found in the current refresh
+        self.head = 0                       # Newest message of the read history, extended by the pushed messages
+        # segments hold the ranges of already read messages, audio search skips the other messages
+        # of a range, so both modes share the segments
+        self.audio_only = source.plugin.settings[KEY_AUDIO_ONLY_HISTORY]
+
+    def run(self):
+        """ Runs the next step """
+        if self.pending:
+            callback, args = self.pending
+            self.pending = None
+            callback(*args)
+
+    def _next(self, interval, callback, *args):
+        """ Sets the next step, run by the scheduler after the interval """
+        self.pending = (callback, args)
+        self.due = time.monotonic() + interval / 1000
+
+    def _refresh_interval(self):
+        """ Interval before the next refresh, doubles up to INTERVAL_MAX while the channel has no new audio """
+        self.synced_at = time.monotonic()
+        if self.head and self.api.is_message_updates_started:
+            # new messages are pushed, the refresh only catches up what the updates could miss
+            self.found = False
+            return INTERVAL_MAX
+        if self.found or self.scheduler.is_visible(self):
+            self.backoff = INTERVAL_LONG
+        else:
+            self.backoff = min(self.backoff * 2, INTERVAL_MAX)
+        self.found = False
+        return self.backoff
 
     def start(self, *obj):
         """ Start loading messages starting from new messages """
         if self.terminated:
             return
         self.last_msg_id = 0
+        self.head = 0
         self.playlist = Playlist.read(self.chat_id)
         self.playlist.insert_empty()
         self._load({}, limit=1)
@@ -465,7 +910,20 @@ class PlaylistLoader:
     def _add_audio(self, audio, blob):
         """ Add audio as entry in the playlist. """
         if not audio.is_reloaded:
-            self.add_entry(audio)
+            self.found = True
+            # entries of a channel which is not opened yet are added from the storage on opening
+            if self.source.initialised:
+                self.add_entry(audio)
+
+    def push(self, message_ids, audios):
+        """ Add audio of the new messages, extends the newest segment unless the history is being read """
+        for audio in audios:
+            self._add_audio(audio, None)
+        newest = max(message_ids)
+        if self.head and newest > self.head and not self.terminated:
+            self.head = newest
+            self.playlist.set_current(SEGMENT_START, newest)
+            self.playlist.save()
 
     def _each(self, data, blob):
         """ Iterate over all messages, check for segment boundaries """
@@ -485,15 +943,18 @@ class PlaylistLoader:
         """ Read data, update playlist segments, loading next page """
         if self.terminated:
             return
+        self.request = None
+        self._process_page(blob, cmd)
+        self.scheduler.done(self)
+
+    def _process_page(self, blob, cmd):
         GLib.timeout_add(2000, self.source.emit, 'playlist-fetch-end')
 
         signal = blob.get('signal')
         offset_msg_id = blob.get('last_msg_id', 0)
 
         if cmd == API_ALL_MESSAGES_LOADED or offset_msg_id in (0, self.last_msg_id, LAST_MESSAGE_ID):
-            self.source.has_reached_end = True
-            self.timer.add(INTERVAL_LONG, self.start)
-            idle_add_once(self.source.emit, 'playlist-reached-end')
+            self._reached_end()
             return
 
         if self.playlist.current(SEGMENT_START) == 0:
@@ -506,42 +967,58 @@ class PlaylistLoader:
             self.playlist.join_segments(message_id)
             offset_msg_id = self.playlist.current(SEGMENT_END)
 
-        if self.playlist.save():
-            self.playlist = Playlist.read(self.chat_id)
+        self.playlist.save()
 
         if (signal == SIGNAL_REACHED_NEXT and self.source.has_reached_end) or offset_msg_id == LAST_MESSAGE_ID:
-            self.source.has_reached_end = True
-            self.timer.add(INTERVAL_LONG, self.start)
-            idle_add_once(self.source.emit, 'playlist-reached-end')
+            self._reached_end()
             return
 
-        if self.page <= MAX_PAGES_SHORT_INTERVAL:
-            self.page = self.page + 1
 
         self.last_msg_id = offset_msg_id
-        self.timer.add(INTERVAL_MEDIUM if self.page > MAX_PAGES_SHORT_INTERVAL else INTERVAL_SHORT,
-                       self._load, {"offset_msg_id": offset_msg_id})
+        # paced by the current rate of the history requests, which drops on flood waits
+        self._next(self.api.limiter.interval('history'), self._load, {"offset_msg_id": offset_msg_id})
         idle_add_once(self.source.emit, 'playlist-segment-loading')
 
-    def _load(self, blob, limit=50):
+    def _reached_end(self):
+        """ The history is read up to the stored segments or to the first message """
+        self.source.has_reached_end = True
+        if self.playlist.current(SEGMENT_END):
+            self.head = self.playlist.current(SEGMENT_START)
+        self._next(self._refresh_interval(), self.start)
+        idle_add_once(self.source.emit, 'playlist-reached-end')
+
+    def _load(self, blob, limit=None):
         """ Load messages """
         if self.terminated:
             return
 
+        if limit is None:
+            limit = AUDIO_PAGE_LIMIT if self.audio_only else HISTORY_PAGE_LIMIT
         self.source.emit('playlist-fetch-started')
-        self.api.load_messages_idle(self.chat_id, update=self._add_audio, each=self._each, on_success=self._process,
-                                    blob={**blob}, limit=limit)
+        self.request = self.api.load_messages_idle(self.chat_id, update=self._add_audio, each=self._each, on_success=self._process,
+                                    blob={**blob}, limit=limit, audio_only=self.audio_only,
+                                    on_error=lambda result: self._failed(blob, limit))
+
+    def _failed(self, blob, limit):
+        """ The page request timed out, the same page is requested again by the scheduler """
+        if self.terminated:
+            return
+        self.request = None
+        GLib.timeout_add(2000, self.source.emit, 'playlist-fetch-end')
+        self._next(INTERVAL_RETRY, self._load, blob, limit)
+        self.scheduler.done(self)
 
     def fetch(self):
         """ Fetch next messages """
-        if self.timer.remove():
-            self.timer.callback()
+        self.scheduler.fetch(self)
 
     def stop(self):
         """ Stop loading """
         self.terminated = True
-        self.timer.remove()
-        self.timer.clear()
+        if self.request is not None:
+            self.request.cancel()
+            self.request = None
+        self.pending = None
         self.source.emit('playlist-fetch-end')
 
 
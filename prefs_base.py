@@ -18,6 +18,7 @@ import gi
 gi.require_version('Gtk', '3.0')
 import json
 from gi.repository import GObject, Gtk, GLib
+from typing import cast, List
 from account import KEY_CONNECTED, KEY_CHANNELS, KEY_PAGE_GROUP
 
 
@@ -88,6 +89,35 @@ class PrefsPageBase(GObject.GObject):
             if reload:
                 GLib.idle_add(self.prefs.plugin.emit, 'reload_display_pages')
 
+    def _init_combo(self, combo: Gtk.ComboBox, variants: List[List[str]], name: str, variant_int=False):
+        idx = 0
+        value = self.settings[name]
+        store = Gtk.ListStore(int if variant_int else str, str) # type: ignore
+        for i, o in enumerate(variants):
+            if value == o[1]:
+                idx = i
+            store.append([o[1], o[0]])
+        combo.set_model(store)
+        combo.set_active(idx)
+        set_combo_text_column(combo, 1)
+        combo.connect('changed', self._on_combo_changed, name, variant_int)
+
+    def _on_combo_changed(self, combo: Gtk.ComboBox, name: str, variant_int=False):
+        tree_iter = combo.get_active_iter()
+        if tree_iter is not None:
+            model = cast(Gtk.TreeModel, combo.get_model())
+            if model:
+                value = model[tree_iter][0]  # pyright: ignore[reportIndexIssue]
+                if variant_int:
+                    self.settings.set_int(name, value)
+                else:
+                    self.settings.set_string(name, value)
+                self._update(name, value)
+                self.on_change(name, value)
+
+    def _update(self, name: str, value):
+        pass
+
     def get_window(self):
         return self.ui.get_object('window')
 
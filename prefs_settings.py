@@ -19,14 +19,15 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import RB  # type: ignore
 from gi.repository import Gtk
-from prefs_base import PrefsPageBase, set_combo_text_column
+from prefs_base import PrefsPageBase
 from common import filepath_parse_pattern, show_error
 from common import CONFLICT_ACTION_RENAME, CONFLICT_ACTION_REPLACE, CONFLICT_ACTION_SKIP, CONFLICT_ACTION_ASK
 from account import KEY_CONFLICT_RESOLVE, KEY_LIBRARY_PATH, KEY_FOLDER_HIERARCHY, KEY_FILENAME_TEMPLATE
+from account import KEY_DOWNLOAD_CONCURRENCY
 from account import KEY_PRELOAD_MAX_FILE_SIZE, KEY_PRELOAD_FILE_FORMATS, AUDIO_FORMAT_ALL
-from account import KEY_PRELOAD_NEXT_TRACK, KEY_PRELOAD_PREV_TRACK, KEY_PRELOAD_HIDDEN_TRACK
+from account import KEY_PRELOAD_NEXT_TRACK, KEY_PRELOAD_PREV_TRACK, KEY_PRELOAD_HIDDEN_TRACK, KEY_STREAM_PLAYBACK
 from account import KEY_DETECT_DIRS_IGNORE_CASE, KEY_DETECT_FILES_IGNORE_CASE
-from typing import cast, List
+from typing import cast
 
 
 import gettext
@@ -63,6 +64,15 @@ conflict_resolve_variants = [
     [_('Ask for Action'), CONFLICT_ACTION_ASK],
 ]
 
+download_concurrency_variants = [
+    [_('1 file'), 1],
+    [_('2 files'), 2],
+    [_('3 files'), 3],
+    [_('4 files'), 4],
+    [_('6 files'), 6],
+    [_('8 files'), 8],
+]
+
 preload_max_size_variants = [
     [_('No size limit'), 0],
     [_('10 MB'), 10],
@@ -105,6 +115,7 @@ class PrefsSettingsPage(PrefsPageBase):
         self.library_location_entry = cast(Gtk.Entry, self.ui.get_object('library_location_entry'))
         self.library_location_btn = cast(Gtk.Button, self.ui.get_object('library_location_btn'))
         self.conflict_resolve_combo = cast(Gtk.ComboBox, self.ui.get_object('conflict_resolve_combo'))
+        self.download_concurrency_combo = cast(Gtk.ComboBox, self.ui.get_object('download_concurrency_combo'))
         self.dir_hierarchy_combo = cast(Gtk.ComboBox, self.ui.get_object('dir_hierarchy_combo'))
         self.name_template_combo = cast(Gtk.ComboBox, self.ui.get_object('name_template_combo'))
         self.template_example_label = cast(Gtk.Label, self.ui.get_object('template_example_label'))
@@ -118,6 +129,7 @@ class PrefsSettingsPage(PrefsPageBase):
         self.preload_prev_check = cast(Gtk.CheckButton, self.ui.get_object('preload_prev_check'))
         self.preload_next_check = cast(Gtk.CheckButton, self.ui.get_object('preload_next_check'))
         self.preload_hidden_check = cast(Gtk.CheckButton, self.ui.get_object('preload_hidden_check'))
+        self.stream_playback_check = cast(Gtk.CheckButton, self.ui.get_object('stream_playback_check'))
 
         self.preload_max_file_size_combo = cast(Gtk.ComboBox, self.ui.get_object('preload_max_file_size_combo'))
         self.preload_file_formats_combo = cast(Gtk.ComboBox, self.ui.get_object('preload_file_formats_combo'))
@@ -125,12 +137,14 @@ class PrefsSettingsPage(PrefsPageBase):
         self._init_check(self.preload_prev_check, KEY_PRELOAD_PREV_TRACK)
         self._init_check(self.preload_next_check, KEY_PRELOAD_NEXT_TRACK)
         self._init_check(self.preload_hidden_check, KEY_PRELOAD_HIDDEN_TRACK)
+        self._init_check(self.stream_playback_check, KEY_STREAM_PLAYBACK)
 
         self.library_location_entry.set_text(self.account.get_library_path())
         self.library_location_btn.connect('clicked', self._browse_libpath_cb)
         self.library_location_entry.connect("focus-out-event", self._libpath_entry_cb)
 
         self._init_combo(self.conflict_resolve_combo, conflict_resolve_variants, KEY_CONFLICT_RESOLVE)
+        self._init_combo(self.download_concurrency_combo, download_concurrency_variants, KEY_DOWNLOAD_CONCURRENCY, True)
         self._init_combo(self.dir_hierarchy_combo, library_layout_paths, KEY_FOLDER_HIERARCHY)
         self._init_combo(self.name_template_combo, library_layout_filenames, KEY_FILENAME_TEMPLATE)
 
@@ -155,32 +169,6 @@ class PrefsSettingsPage(PrefsPageBase):
         self.on_change(name, is_checked)
         self._update_check_sensitive()
 
-    def _init_combo(self, combo: Gtk.ComboBox, variants: List[List[str]], name: str, variant_int=False):
-        idx = 0
-        value = self.settings[name]
-        store = Gtk.ListStore(int if variant_int else str, str) # type: ignore
-        for i, o in enumerate(variants):
-            if value == o[1]:
-                idx = i
-            store.append([o[1], o[0]])
-        combo.set_model(store)
-        combo.set_active(idx)
-        set_combo_text_column(combo, 1)
-        combo.connect('changed', self._on_combo_changed, name, variant_int)
-
-    def _on_combo_changed(self, combo: Gtk.ComboBox, name: str, variant_int=False):
-        tree_iter = combo.get_active_iter()
-        if tree_iter is not None:
-            model = cast(Gtk.TreeModel, combo.get_model())
-            if model:
-                value = model[tree_iter][0]  # pyright: ignore[reportIndexIssue]
-                if variant_int:
-                    self.settings.set_int(name, value)
-                else:
-                    self.settings.set_string(name, value)
-                self._update(name, value)
-                self.on_change(name, value)
-
     def _update(self, name: str, value):
         # avoid re-execution for identical values
         if self._values.get(name) == value:
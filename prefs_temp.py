@@ -17,89 +17,70 @@
 import gi
 gi.require_version('Gtk', '3.0')
 import os
-import subprocess
-import shlex
 from gi.repository import RB
 from gi.repository import Gtk, Gio, GLib, Gdk
+from account import KEY_TEMP_CACHE_QUOTA, KEY_TEMP_CACHE_MIN_FREE
 from common import file_uri, pretty_file_size
 from prefs_base import PrefsPageBase
 
 import gettext
 gettext.install('rhythmbox', RB.locale_dir())
 
-plugin_dir = Gio.file_new_for_path(RB.user_data_dir()).resolve_relative_path('telegram').get_path()
-
-def delete_files_recursively(directory, progress_callback=None):
-    for root, dirs, files in os.walk(directory, topdown=False):
-        for name in files:
-            file_path = os.path.join(root, name)
-            try:
-                if file_path.startswith(plugin_dir):
-                    print("Deleting %s" % file_path)
-                    os.remove(file_path)
-                    if progress_callback:
-                        progress_callback(file_path)
-            except Exception as e:
-                print(f"Error deleting file {file_path}: {e}")
-            yield True
-
-        for name in dirs:
-            dir_path = os.path.join(root, name)
-            try:
-                if dir_path.startswith(plugin_dir):
-                    print("rmdir %s" % dir_path)
-                    os.rmdir(dir_path)
-                    if progress_callback:
-                        progress_callback(dir_path)
-            except Exception as e:
-                print(f"Error deleting directory {dir_path}: {e}")
-            yield True
-
-    yield False
-
-def start_deletion(directory, progress_callback=None, completion_callback=None):
-    deletion_generator = delete_files_recursively(directory, progress_callback)
-
-    def idle_deletion_task():
-        try:
-            if next(deletion_generator):
-                return True
-        except StopIteration:
-            pass
-
-        if completion_callback:
-            completion_callback()
-
-        return False
+temp_quota_variants = [
+    [_('No size limit'), 0],
+    [_('500 MB'), 500],
+    [_('1 GB'), 1000],
+    [_('2 GB'), 2000],
+    [_('5 GB'), 5000],
+    [_('10 GB'), 10000],
+    [_('20 GB'), 20000],
+    [_('50 GB'), 50000],
+]
+
+temp_min_free_variants = [
+    [_('Disabled'), 0],
+    [_('500 MB'), 500],
+    [_('1 GB'), 1000],
+    [_('2 GB'), 2000],
+    [_('5 GB'), 5000],
+    [_('10 GB'), 10000],
+]
 
-    GLib.idle_add(idle_deletion_task)
+plugin_dir = Gio.file_new_for_path(RB.user_data_dir()).resolve_relative_path('telegram').get_path()
 
 
 class PrefsTempPage(PrefsPageBase):
     name = _('Temporary Files')
     main_box = 'temp_vbox'
     ui_file = 'ui/prefs/temp.ui'
-    _is_calculating = False
     temp_dir = None
     temp_path_entry = None
 
     def _create_widget(self):
-        self._is_calculating = False
         self.temp_usage_label = self.ui.get_object('temp_usage_label')
         self.temp_path_entry = self.ui.get_object('temp_path_entry')
         self.usage_refresh_btn = self.ui.get_object('usage_refresh_btn')
         self.clear_tmp_btn = self.ui.get_object('clear_tmp_btn')
         self.clear_tmp_btn_label = self.ui.get_object('clear_tmp_btn_label')
         self.view_dir_btn = self.ui.get_object('view_dir_btn')
-        # self.progress_label = self.ui.get_object('deleting_progress_label')
-        # self.progress_label.set_text('')
+        self.temp_quota_combo = self.ui.get_object('temp_quota_combo')
+        self.temp_min_free_combo = self.ui.get_object('temp_min_free_combo')
+        self.progress_label = self.ui.get_object('deleting_progress_label')
+        self.progress_label.set_text('')
 
         self.usage_refresh_btn.connect('clicked', self._refresh_btn_clicked)
         self.clear_tmp_btn.connect('clicked', self._clear_tmp_btn_clicked)
         self.view_dir_btn.connect('clicked', self._view_dir_btn_clicked)
 
+        self._init_combo(self.temp_quota_combo, temp_quota_variants, KEY_TEMP_CACHE_QUOTA, True)
+        self._init_combo(self.temp_min_free_combo, temp_min_free_variants, KEY_TEMP_CACHE_MIN_FREE, True)
+
         self.upd_temp_dir()
 
+    def _update(self, name, value):
+        # apply the new limits at once
+        self.plugin.temp_cache.check(0)
+
     def register_signals(self):
         self.prefs.connect('api-connect', self.upd_temp_dir)
         self.prefs.connect('api-disconnect', self.upd_temp_dir)
@@ -114,63 +95,19 @@ class PrefsTempPage(PrefsPageBase):
             self.calculate_size()
 
     def calculate_size(self):
-        if self.temp_dir is None:
+        """ Shows the size of the temp files, it is tracked by the storage """
+        if self.temp_dir is None or not self.plugin.storage:
             self.temp_usage_label.set_text(_("0"))
-            return
-
-        if self._is_calculating:
-            return
-
-        self._is_calculating = True
-
-        self.usage_refresh_btn.set_sensitive(False)
-        self.temp_usage_label.set_text(_("Calculating..."))
-        try:
-            cmd = f"du -sb -- {shlex.quote(self.temp_dir)}/* 2>/dev/null | awk '{{sum += $1}} END {{print sum}}'"
-            result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            GLib.io_add_watch(result.stdout, GLib.IO_IN, self.on_subprocess_output, result)
-        except Exception as e:
-            self.temp_usage_label.set_text(f"Error: {e}")
-            self.usage_refresh_btn.set_sensitive(True)
-            self._is_calculating = False
-        return False
-
-    def on_subprocess_output(self, source, condition, process):
-        if condition == GLib.IO_IN:
-            output = source.read()
-            size = ("%s 0" % output).split()[0] if output else "Error"
-            readable_size = pretty_file_size(int(size)) if size.isdigit() else size
-            self.temp_usage_label.set_text(readable_size)
-            process.stdout.close()
-            process.stderr.close()
-            process.terminate()
-            self.usage_refresh_btn.set_sensitive(True)
-            self._is_calculating = False
             return False
-        return True
+        size, count = self.plugin.storage.get_temp_usage()
+        self.temp_usage_label.set_text(_("%s in %d files") % (pretty_file_size(size), count))
+        self.usage_refresh_btn.set_sensitive(True)
+        return False
 
     def _refresh_btn_clicked(self, widget):
         self.usage_refresh_btn.set_sensitive(False)
-        self.temp_usage_label.set_text(_("Calculating..."))
         GLib.idle_add(self.calculate_size)
 
-    def _update_entries(self):
-        pass
-        # commit = False
-        # for source in self.plugin.get_all_sources():
-        #     entry_view = source.get_entry_view()
-        #     # print(entry_view)
-        #     model = entry_view.get_property("model")
-        #     # print(model)
-        #     # model = source.get_entry_view().get_model()
-        #     iter = model.get_iter_first()
-        #     while iter is not None:
-        #         entry = model.get_value(iter, 0)
-        #         audio = self.plugin.storage.get_entry_audio(entry)
-        #         if audio and audio.is_downloaded and not audio.is_moved:
-        #             self.plugin.db.entry_set(entry, RB.RhythmDBPropType.COMMENT, audio.get_state())
-        #             self.plugin.db.commit()
-
     def _delete_temp_files_dialog(self, widget=None):
         self.clear_tmp_btn.set_sensitive(False)
         msg = _('Are you sure you want to delete temporary files?')
@@ -188,23 +125,23 @@ class PrefsTempPage(PrefsPageBase):
             label = self.clear_tmp_btn_label.get_label()
             self.clear_tmp_btn_label.set_label(_('Deleting...'))
 
-            def on_complete():
-                self.plugin.storage.update('audio',
-                                           {'is_downloaded': 0, 'local_path': ''},
-                                           {'is_downloaded': 1, 'is_moved': 0})
+            def on_complete(files, size, elapsed):
                 self.clear_tmp_btn_label.set_label(label)
-                # self.progress_label.set_text('')
+                self.progress_label.set_text(_('Deleted %d files (%s) in %.1f s') % (
+                    files, pretty_file_size(size), elapsed))
                 self.clear_tmp_btn.set_sensitive(True)
                 self.calculate_size()
-                # GLib.idle_add(self._update_entries)
 
-            # def on_progress(path):
-            #     self.progress_label.set_text(path)
+            def on_progress(files, size, elapsed):
+                self.progress_label.set_text(_('Deleted %d files (%s), %d files/s') % (
+                    files, pretty_file_size(size), files / max(elapsed, 0.001)))
 
-            if len(self.temp_dir) > 32 and self.temp_dir.endswith('music'):
-                start_deletion(self.temp_dir, completion_callback=on_complete)
-        else:
-            self.clear_tmp_btn.set_sensitive(True)
+            if self.temp_dir and len(self.temp_dir) > 32 and self.temp_dir.endswith('music') \
+                    and self.temp_dir.startswith(plugin_dir) \
+                    and self.plugin.temp_cache.purge(on_progress, on_complete):
+                return
+            self.clear_tmp_btn_label.set_label(label)
+        self.clear_tmp_btn.set_sensitive(True)
 
     def _clear_tmp_btn_clicked(self, widget):
         self._delete_temp_files_dialog()
@@ -18,7 +18,7 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import RB
 from gi.repository import Gtk, GLib
-from prefs_base import PrefsPageBase, set_combo_text_column
+from prefs_base import PrefsPageBase
 from account import KEY_RATING_COLUMN, KEY_DATE_ADDED_COLUMN, KEY_FILE_SIZE_COLUMN, KEY_AUDIO_FORMAT_COLUMN
 from account import KEY_PAGE_GROUP, KEY_AUDIO_VISIBILITY, KEY_TOP_PICKS_COLUMN, KEY_IN_LIBRARY_COLUMN
 from account import VAL_AV_VISIBLE, VAL_AV_HIDDEN, VAL_AV_ALL, VAL_AV_DUAL, AUDIO_FORMAT_ALL, KEY_DISPLAY_AUDIO_FORMATS
@@ -181,29 +181,10 @@ class PrefsViewPage(PrefsPageBase):
         self.plugin.require_restart_plugin = True
         self.restart_warning_box.set_visible(True)
 
-    def _init_combo(self, combo, variants, name):
-        idx = 0
-        value = self.settings[name]
-        store = Gtk.ListStore(str, str) # noqa
-        for i, o in enumerate(variants):
-            if value == o[1]:
-                idx = i
-            store.append([o[1], o[0]])
-        combo.set_model(store)
-        combo.set_active(idx)
-        set_combo_text_column(combo, 1)
-        combo.connect('changed', self._on_combo_changed, name)
-
-    def _on_combo_changed(self, combo, name):
-        tree_iter = combo.get_active_iter()
-        if tree_iter is not None:
-            model = combo.get_model()
-            value = model[tree_iter][0]
-            if name in self._combos_require_restart:
-                self.plugin.require_restart_plugin = True
-                self.restart_warning_box.set_visible(True)
-            self.settings.set_string(name, value)
-            self.on_change(name, value)
+    def _update(self, name, value):
+        if name in self._combos_require_restart:
+            self.plugin.require_restart_plugin = True
+            self.restart_warning_box.set_visible(True)
 
     def _sync_hidden_chats_cb(self, *args):
         db = self.plugin.storage.db
@@ -231,6 +212,7 @@ class PrefsViewPage(PrefsPageBase):
             db_cur.execute(query, values)
             db.commit()
             db_cur.close()
+            self.plugin.storage.audio_cache.clear()
 
         def flash_idle(data_iter):
             values = []
@@ -19,7 +19,7 @@ import json
 from gi.repository import RB # type: ignore
 from gi.repository import GObject, Gtk, Gio, GLib
 from gi.repository import Peas, PeasGtk # type: ignore # noqa
-from loader import AudioDownloader, AudioTempLoader
+from loader import AudioDownloader, AudioTempLoader, SyncScheduler
 from telegram_search import TelegramSearchEntryType, TelegramSearchSource
 from telegram_source import TelegramSource
 from telegram_client import TelegramApi, TelegramAuthError
@@ -29,7 +29,9 @@ from account import KEY_CHANNELS, KEY_PAGE_GROUP, KEY_TOP_PICKS_COLUMN, KEY_IN_L
 from telegram_entry import TelegramEntryType
 from common import get_location_data, show_error, to_location, idle_add_once
 from columns import TopPicks, InLibraryColumn
-from storage import Audio, VISIBILITY_VISIBLE, VISIBILITY_HIDDEN
+from storage import VISIBILITY_VISIBLE, VISIBILITY_HIDDEN
+from tag_reader import TagReader
+from temp_cache import TempCache
 from typing import cast, Any, Union
 
 import gettext
@@ -97,6 +99,9 @@ class TelegramPlugin(GObject.GObject, Peas.Activatable):
         self.storage = None
         self.loader = None
         self.downloader = None
+        self.temp_cache = None
+        self.stream_proxy = None
+        self.sync = None
         self.group_id = None
         self.require_restart_plugin = False
         self.rhythmdb_settings = None
@@ -161,6 +166,8 @@ class TelegramPlugin(GObject.GObject, Peas.Activatable):
         self.rhythmdb_settings = Gio.Settings.new('org.gnome.rhythmbox.rhythmdb')
         self.downloader = AudioDownloader(self)
         self.loader = AudioTempLoader(self)
+        self.temp_cache = TempCache(self)
+        self.sync = SyncScheduler(self)
         self.group_id = None
         self.display_pages = {}
         self.search_source = None
@@ -186,11 +193,22 @@ class TelegramPlugin(GObject.GObject, Peas.Activatable):
         print('Telegram plugin deactivating')
         self.top_picks.deactivate()
         self.delete_display_pages(True)
+        self.sync.stop()
+        self.downloader.release()
+        TagReader().stop()
+        self.temp_cache.stop()
         self.remove_plugin_menu(True)
 
         for signal in self.signals.get('db', []):
             self.db.disconnect(signal)
 
+        if self.stream_proxy:
+            self.stream_proxy.stop()
+            self.stream_proxy = None
+
+        if self.storage:
+            self.storage.flush()
+
         self.db = None
         self.storage = None
         self.signals = {}
@@ -285,11 +303,24 @@ class TelegramPlugin(GObject.GObject, Peas.Activatable):
                 self.api.login()
                 self.storage = self.api.storage
                 self.do_reload_display_pages()
+                TagReader().backfill(self.storage, self.on_tags_backfilled)
+                self.temp_cache.check()
+                self.downloader.resume()
             except TelegramAuthError as err:
                 show_error(err.get_info())
         else:
             self.delete_display_pages()
 
+    def on_tags_backfilled(self, audios):
+        """ Updates the entries of the audio whose tags are read from the downloaded files """
+        if not self.db or not self.api:
+            return
+        for audio in audios:
+            entry = self.db.entry_lookup_by_location(to_location(self.api.hash, audio.chat_id, audio.message_id, audio.id))
+            if entry:
+                audio.update_entry(entry, self.db, commit=False)
+        self.db.commit()
+
     def on_entry_changed(self, db, entry, changes):
         """
         Handles changes to song entries in the Rhythmbox database.
@@ -315,7 +346,7 @@ class TelegramPlugin(GObject.GObject, Peas.Activatable):
             data = self.storage.select('audio', {'is_moved': 1, 'local_path': file_path}, limit=None) or list()
 
             for item in data:
-                audio = Audio(item)
+                audio = self.storage.get_row_audio(item)
 
                 if not (('play_count' in audio_changes and audio_changes['play_count'] > audio.play_count) or
                         ('rating' in audio_changes and audio_changes['rating'] != audio.rating)):
@@ -401,8 +432,10 @@ class TelegramPlugin(GObject.GObject, Peas.Activatable):
             for idx in self.sources:
                 if idx not in ids:
                     hide_source(self.sources[idx])
+            self.sync.set_channels(ids)
             self.add_search_page(group)
         else:
+            self.sync.set_channels([])
             for idx in self.sources:
                 hide_source(self.sources[idx])
 
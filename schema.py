@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import sqlite3
 from common import version_to_number
 
 
@@ -75,6 +77,186 @@ CREATE INDEX idx_pinned_chat ON pinned_message(chat_id);
 
 INIT_SCHEMA += migration_1_5_0_sql
 
+# full-text index over audio artist/title, external content table kept in sync by triggers
+FTS_TOKENIZERS = ('unicode61 remove_diacritics 2', 'unicode61 remove_diacritics 1')
+
+migration_1_5_1_triggers_sql = '''
+CREATE TRIGGER audio_fts_ai AFTER INSERT ON audio BEGIN
+    INSERT INTO audio_fts (rowid, artist, title) VALUES (new.id, new.artist, new.title);
+END;
+CREATE TRIGGER audio_fts_ad AFTER DELETE ON audio BEGIN
+    INSERT INTO audio_fts (audio_fts, rowid, artist, title) VALUES ('delete', old.id, old.artist, old.title);
+END;
+CREATE TRIGGER audio_fts_au AFTER UPDATE OF artist, title ON audio BEGIN
+    INSERT INTO audio_fts (audio_fts, rowid, artist, title) VALUES ('delete', old.id, old.artist, old.title);
+    INSERT INTO audio_fts (rowid, artist, title) VALUES (new.id, new.artist, new.title);
+END;
+INSERT INTO audio_fts (audio_fts) VALUES ('rebuild');
+'''
+
+
+def migration_1_5_1_py_func(cursor):
+    """ Create audio_fts table, skipped when sqlite is built without FTS5 (search falls back to LIKE) """
+    for tokenizer in FTS_TOKENIZERS:
+        try:
+            cursor.execute(f"CREATE VIRTUAL TABLE audio_fts USING fts5(artist, title, content='audio', "
+                           f"content_rowid='id', tokenize='{tokenizer}');")
+            break
+        except sqlite3.OperationalError as e:
+            print(f"Unable to create audio_fts with tokenizer '{tokenizer}': {e}")
+    else:
+        return
+    cursor.executescript(migration_1_5_1_triggers_sql)
+
+
+# indexes for the audio access paths, idx_audio_chat_hidden supersedes idx_chat_id
+migration_1_5_2_sql = '''
+DROP INDEX IF EXISTS idx_chat_id;
+CREATE INDEX IF NOT EXISTS idx_audio_chat_hidden ON audio(chat_id, is_hidden);
+CREATE INDEX IF NOT EXISTS idx_audio_moved_path ON audio(is_moved, local_path);
+CREATE INDEX IF NOT EXISTS idx_audio_moved_hidden ON audio(is_moved, is_hidden);
+CREATE INDEX IF NOT EXISTS idx_audio_hidden_date ON audio(is_hidden, date);
+ANALYZE audio;
+'''
+
+# chat entries are loaded by pages ordered by message_id
+migration_1_5_3_sql = '''
+DROP INDEX IF EXISTS idx_audio_chat_hidden;
+CREATE INDEX IF NOT EXISTS idx_audio_chat_hidden_message ON audio(chat_id, is_hidden, message_id);
+'''
+
+# playlist history segments, one row per segment instead of the json list in playlist.segments
+migration_1_5_4_sql = '''
+CREATE TABLE playlist_segment (
+   `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+   `chat_id` INTEGER NOT NULL,
+   `start_id` INTEGER NOT NULL,
+   `end_id` INTEGER NOT NULL
+);
+CREATE INDEX idx_playlist_segment_chat ON playlist_segment(chat_id, start_id);
+'''
+
+
+def migration_1_5_4_py_func(cursor):
+    """ Copy segments from playlist.segments json, overlapping segments are merged into one row """
+    rows = []
+    for chat_id, segments in cursor.execute("SELECT chat_id, segments FROM playlist;").fetchall():
+        try:
+            segments = json.loads(segments)
+        except ValueError:
+            continue
+        merged = []
+        for low, high in sorted((min(segment), max(segment)) for segment in segments
+                                if len(segment) == 2 and segment[0] and segment[1]):
+            if merged and low <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        rows.extend((chat_id, high, low) for low, high in merged)
+    cursor.executemany("INSERT INTO playlist_segment (chat_id, start_id, end_id) VALUES (?, ?, ?);", rows)
+    cursor.execute("UPDATE playlist SET segments = '[]';")
+
+
+# chat catalog of the channel picker, kept current from the chat updates
+migration_1_5_5_sql = '''
+CREATE TABLE chat (
+   `id` INTEGER PRIMARY KEY,
+   `title` TEXT NOT NULL,
+   `type` VARCHAR(16) NOT NULL DEFAULT '',
+   `last_message_id` INTEGER DEFAULT 0,
+   `audio_count` INTEGER DEFAULT 0
+);
+'''
+
+# links of the messages, resolved by getMessageLink
+migration_1_5_6_sql = '''
+CREATE TABLE message_link (
+   `chat_id` INTEGER NOT NULL,
+   `message_id` INTEGER NOT NULL,
+   `link` TEXT NOT NULL,
+    PRIMARY KEY (`chat_id`, `message_id`)
+) WITHOUT ROWID;
+'''
+
+# tags read from the downloaded files, tags_read marks the files which are already parsed
+migration_1_5_7_sql = '''
+ALTER TABLE audio ADD COLUMN `album_artist` TEXT DEFAULT NULL;
+ALTER TABLE audio ADD COLUMN `year` INTEGER DEFAULT NULL;
+ALTER TABLE audio ADD COLUMN `disc_number` INTEGER DEFAULT NULL;
+ALTER TABLE audio ADD COLUMN `tags_read` INTEGER DEFAULT 0;
+CREATE INDEX IF NOT EXISTS idx_audio_tags_read ON audio(tags_read, is_downloaded);
+'''
+
+# temp cache: last_access orders the eviction, temp_usage keeps the total size of the downloaded
+# files which are not moved to the library, it is maintained by the triggers
+migration_1_5_8_sql = '''
+ALTER TABLE audio ADD COLUMN `last_access` INTEGER DEFAULT 0;
+CREATE INDEX IF NOT EXISTS idx_audio_temp_lru ON audio(is_downloaded, is_moved, last_access, play_count);
+
+CREATE TABLE temp_usage (
+   `id` INTEGER PRIMARY KEY CHECK (`id` = 0),
+   `size` INTEGER NOT NULL DEFAULT 0,
+   `count` INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO temp_usage (id, size, count)
+    SELECT 0, COALESCE(SUM(size), 0), COUNT(*) FROM audio WHERE is_downloaded = 1 AND is_moved = 0;
+
+CREATE TRIGGER audio_temp_usage_ai AFTER INSERT ON audio
+WHEN new.is_downloaded = 1 AND new.is_moved = 0 BEGIN
+    UPDATE temp_usage SET size = size + new.size, count = count + 1 WHERE id = 0;
+END;
+CREATE TRIGGER audio_temp_usage_ad AFTER DELETE ON audio
+WHEN old.is_downloaded = 1 AND old.is_moved = 0 BEGIN
+    UPDATE temp_usage SET size = size - old.size, count = count - 1 WHERE id = 0;
+END;
+CREATE TRIGGER audio_temp_usage_au AFTER UPDATE OF is_downloaded, is_moved, size ON audio
+WHEN (old.is_downloaded = 1 AND old.is_moved = 0) OR (new.is_downloaded = 1 AND new.is_moved = 0) BEGIN
+    UPDATE temp_usage SET
+        size = size - (CASE WHEN old.is_downloaded = 1 AND old.is_moved = 0 THEN old.size ELSE 0 END)
+                    + (CASE WHEN new.is_downloaded = 1 AND new.is_moved = 0 THEN new.size ELSE 0 END),
+        count = count - (old.is_downloaded = 1 AND old.is_moved = 0) + (new.is_downloaded = 1 AND new.is_moved = 0)
+    WHERE id = 0;
+END;
+'''
+
+# jobs of the library downloader, kept until the file is moved to the library, so they survive restarts
+migration_1_5_9_sql = '''
+CREATE TABLE download_job (
+   `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+   `chat_id` INTEGER NOT NULL,
+   `message_id` INTEGER NOT NULL,
+   `audio_id` INTEGER NOT NULL,
+   `state` INTEGER NOT NULL DEFAULT 0,
+   `priority` INTEGER NOT NULL DEFAULT 0,
+   `attempts` INTEGER NOT NULL DEFAULT 0,
+   `retry_at` INTEGER NOT NULL DEFAULT 0,
+   `last_error` TEXT DEFAULT NULL,
+   `created_at` INTEGER NOT NULL,
+    UNIQUE (`chat_id`, `message_id`)
+);
+CREATE INDEX idx_download_job_state ON download_job(state, priority, id);
+'''
+
+# the audio counts of the chats are kept up to date by the triggers, instead of a recount on every read
+migration_1_5_10_sql = '''
+UPDATE chat SET audio_count = (SELECT COUNT(*) FROM audio WHERE audio.chat_id = chat.id);
+
+CREATE TRIGGER chat_audio_count_ai AFTER INSERT ON audio BEGIN
+    UPDATE chat SET audio_count = audio_count + 1 WHERE id = new.chat_id;
+END;
+CREATE TRIGGER chat_audio_count_ad AFTER DELETE ON audio BEGIN
+    UPDATE chat SET audio_count = audio_count - 1 WHERE id = old.chat_id;
+END;
+CREATE TRIGGER chat_audio_count_au AFTER UPDATE OF chat_id ON audio WHEN old.chat_id != new.chat_id BEGIN
+    UPDATE chat SET audio_count = audio_count - 1 WHERE id = old.chat_id;
+    UPDATE chat SET audio_count = audio_count + 1 WHERE id = new.chat_id;
+END;
+CREATE TRIGGER chat_audio_count_chat_ai AFTER INSERT ON chat BEGIN
+    UPDATE chat SET audio_count = (SELECT COUNT(*) FROM audio WHERE audio.chat_id = new.id) WHERE id = new.id;
+END;
+'''
+
+
 MIGRATIONS = {
     # example
     # '1.0.14': (
@@ -83,5 +265,36 @@ MIGRATIONS = {
     # ),
     '1.5.0': (
         migration_1_5_0_sql
-    )
+    ),
+    '1.5.1': (
+        migration_1_5_1_py_func
+    ),
+    '1.5.2': (
+        migration_1_5_2_sql
+    ),
+    '1.5.3': (
+        migration_1_5_3_sql
+    ),
+    '1.5.4': (
+        migration_1_5_4_sql,
+        migration_1_5_4_py_func
+    ),
+    '1.5.5': (
+        migration_1_5_5_sql
+    ),
+    '1.5.6': (
+        migration_1_5_6_sql
+    ),
+    '1.5.7': (
+        migration_1_5_7_sql
+    ),
+    '1.5.8': (
+        migration_1_5_8_sql
+    ),
+    '1.5.9': (
+        migration_1_5_9_sql
+    ),
+    '1.5.10': (
+        migration_1_5_10_sql
+    ),
 }
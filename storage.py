@@ -15,14 +15,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import time
 import sqlite3
-import json
+import re
 import logging
+import bisect
+import functools
+from collections import OrderedDict
 import schema
 from gi.repository import RB  # type: ignore
-from common import audio_content_set, empty_cb, get_audio_tags, get_date, get_year, mime_types, filepath_parse_pattern
+from gi.repository import GLib
+from common import audio_content_set, empty_cb, get_date, get_year, mime_types, filepath_parse_pattern
 from common import get_location_data, set_entry_state, version_to_number, extract_track_number
-from typing import List, Literal, Dict, Tuple, Union, Callable, Iterable, TypedDict, Optional
+from tag_reader import TagReader
+from typing import List, Literal, Dict, Tuple, Union, Callable, Iterable, Iterator, TypedDict, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +40,203 @@ VISIBILITY_ALL = None
 VISIBILITY_VISIBLE = 1
 VISIBILITY_HIDDEN = 0
 
+# states of the download jobs
+JOB_QUEUED = 0
+JOB_ACTIVE = 1
+JOB_FAILED = 2
+
+COMMIT_DELAY = 250        # max delay (ms) before pending writes are committed
+COMMIT_MAX_PENDING = 200  # commit immediately when this many writes are pending
+
+# connection profile applied on database open, every key is a sqlite PRAGMA
+CONNECTION_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 64 * 1024 * 1024,  # bytes
+    'cache_size': -16 * 1024,       # negative value is the size in KiB
+    'temp_store': 'MEMORY',
+}
+
+STATEMENT_CACHE_SIZE = 256  # number of prepared statements kept by the sqlite3 connection
+
+SEARCH_LIMIT = 500  # max number of rows returned by Storage.search_audio
+
+AUDIO_CACHE_SIZE = 2048  # max number of Audio objects kept in the identity map
+
+ENTRIES_PAGE_SIZE = 500  # rows per query in Storage.load_entries()
+MAX_MESSAGE_ID = 1 << 62
+
+AUDIO_KEYS_CHUNK = 400    # max (chat_id, message_id) pairs per query, keeps below sqlite variables limit
+
+PLAN_EXPECTED_SCANS = ('VIRTUAL TABLE', 'CONSTANT ROW', 'SCAN k')  # see Storage.check_query_plans()
+
+SQL_GET_AUDIO = "SELECT * FROM `audio` WHERE chat_id = ? AND message_id = ? LIMIT 1"
+
+SQL_INSERT_AUDIO = """
+    INSERT INTO `audio` (
+        chat_id, message_id, mime_type, title, artist, file_name, `date`, `created_at`, size, duration,
+        local_path, is_downloaded, track_number)
+    VALUES (
+        :chat_id, :message_id, :mime_type, :title, :artist, :file_name, :date, :created_at, :size, :duration,
+        :local_path, :is_downloaded, :track_number)
+"""
+
+# existing audio is updated only if it was downloaded, same as Storage.add_audio()
+SQL_UPSERT_AUDIO = SQL_INSERT_AUDIO + """
+    ON CONFLICT (chat_id, message_id) DO UPDATE SET
+        size = excluded.size,
+        local_path = excluded.local_path,
+        is_downloaded = excluded.is_downloaded,
+        is_moved = 0
+    WHERE excluded.local_path IS NOT NULL AND excluded.local_path != ''
+"""
+
+# tags of the backfilled files, a missing tag keeps the current value
+SQL_UPDATE_AUDIO_TAGS = """
+    UPDATE `audio` SET
+        album = COALESCE(:album, album),
+        album_artist = COALESCE(:album_artist, album_artist),
+        genre = COALESCE(:genre, genre),
+        year = COALESCE(:year, year),
+        track_number = COALESCE(:track_number, track_number),
+        disc_number = COALESCE(:disc_number, disc_number),
+        tags_read = 1
+    WHERE id = :id
+"""
+
+SQL_GET_TEMP_USAGE = "SELECT size, count FROM `temp_usage` WHERE id = 0"
+
+# downloaded files which are not in the library, least recently played first
+SQL_SELECT_TEMP_LRU = """
+    SELECT * FROM `audio` WHERE is_downloaded = 1 AND is_moved = 0
+    ORDER BY last_access, play_count LIMIT ? OFFSET ?
+"""
+
+SQL_EVICT_AUDIO = "UPDATE `audio` SET is_downloaded = 0, local_path = NULL WHERE id = ? AND is_moved = 0"
+
+SQL_SELECT_TEMP_AUDIO_PATHS = "SELECT * FROM `audio` WHERE is_moved = 0 AND local_path IN (%s) AND is_downloaded = 1"
+
+# a failed job of the same audio is queued again
+SQL_ADD_DOWNLOAD_JOB = """
+    INSERT INTO `download_job` (chat_id, message_id, audio_id, priority, created_at)
+    VALUES (:chat_id, :message_id, :audio_id, :priority, :created_at)
+    ON CONFLICT (chat_id, message_id) DO UPDATE SET
+        state = 0, priority = excluded.priority, attempts = 0, retry_at = 0, last_error = NULL
+    WHERE state = 2
+"""
+
+SQL_SELECT_DOWNLOAD_JOBS = """
+    SELECT chat_id, message_id, audio_id, attempts, retry_at FROM `download_job`
+    WHERE state = 0 ORDER BY priority DESC, id
+"""
+
+SQL_UPSERT_CHAT = """
+    INSERT INTO `chat` (id, title, type, last_message_id)
+    VALUES (:id, :title, :type, :last_message_id)
+    ON CONFLICT (id) DO UPDATE SET
+        title = excluded.title,
+        type = excluded.type,
+        last_message_id = MAX(last_message_id, excluded.last_message_id)
+"""
+
+SQL_SEARCH_AUDIO_FTS = """
+    SELECT a.* FROM audio_fts f JOIN `audio` a ON a.id = f.rowid
+    WHERE audio_fts MATCH ? ORDER BY f.rank LIMIT ?
+"""
+
+
+def _where_sql(keys: Tuple[str, ...]) -> str:
+    """ Build WHERE clause for the keys """
+    return ' AND '.join(f'`{k}` = ?' for k in keys)
+
+
+@functools.lru_cache(maxsize=128)
+def sql_select(table: str, keys: Tuple[str, ...], limit=None, order=None) -> str:
+    """ Build SELECT statement, identical arguments return the same SQL string """
+    sql = f"SELECT * FROM `{table}` WHERE {_where_sql(keys)}"
+    if order:
+        sql += ' ORDER BY %s' % order
+    if limit and limit > 0:
+        sql = f'{sql} LIMIT {limit}'
+    return sql
+
+
+@functools.lru_cache(maxsize=128)
+def sql_update(table: str, keys: Tuple[str, ...], where_keys: Tuple[str, ...], limit=None) -> str:
+    """ Build UPDATE statement, identical arguments return the same SQL string """
+    set_keys = ', '.join(f'`{k}` = ?' for k in keys)
+    sql = f"UPDATE `{table}` SET {set_keys} WHERE {_where_sql(where_keys)}"
+    if limit and limit > 0:
+        sql = f'{sql} LIMIT {limit}'
+    return sql
+
+
+@functools.lru_cache(maxsize=128)
+def sql_delete(table: str, where_keys: Tuple[str, ...]) -> str:
+    """ Build DELETE statement, identical arguments return the same SQL string """
+    return f"DELETE FROM `{table}` WHERE {_where_sql(where_keys)}"
+
+
+@functools.lru_cache(maxsize=128)
+def sql_insert(table: str, keys: Tuple[str, ...]) -> str:
+    """ Build INSERT statement, identical arguments return the same SQL string """
+    set_keys = ', '.join(f'`{k}`' for k in keys)
+    set_place = ', '.join('?' * len(keys))
+    return f"INSERT INTO `{table}` ({set_keys}) VALUES ({set_place})"
+
+
+@functools.lru_cache(maxsize=32)
+def sql_select_page(table: str, keys: Tuple[str, ...], order_key: str, limit: int) -> str:
+    """ Build SELECT statement for the page of rows before the order_key value, in descending order """
+    return f"SELECT * FROM `{table}` WHERE {_where_sql(keys)} AND `{order_key}` < ? " \
+           f"ORDER BY `{order_key}` DESC LIMIT {limit}"
+
+
+@functools.lru_cache(maxsize=32)
+def sql_count(table: str, keys: Tuple[str, ...]) -> str:
+    """ Build SELECT COUNT statement """
+    return f"SELECT COUNT(*) FROM `{table}` WHERE {_where_sql(keys)}"
+
+
+@functools.lru_cache(maxsize=32)
+def sql_select_audio_keys(columns: str, count: int) -> str:
+    """ Build SELECT statement for the count of (chat_id, message_id) pairs """
+    values = ', '.join(['(?, ?)'] * count)
+    # join instead of row-value IN, which sqlite runs as a full scan of audio
+    return f"SELECT {columns} FROM (VALUES {values}) AS k " \
+           f"JOIN `audio` ON `audio`.chat_id = k.column1 AND `audio`.message_id = k.column2"
+
+
+def storage_queries() -> List[Tuple[str, Tuple]]:
+    """ Queries run by Storage and its users, with sample params, used by Storage.check_query_plans() """
+    return [
+        (SQL_GET_AUDIO, (0, 0)),
+        (sql_select_audio_keys('`audio`.*', 2), (0, 0, 0, 0)),
+        (sql_select_page('audio', ('chat_id',), 'message_id', ENTRIES_PAGE_SIZE), (0, 0)),
+        (sql_select_page('audio', ('chat_id', 'is_hidden'), 'message_id', ENTRIES_PAGE_SIZE), (0, 0, 0)),
+        (sql_count('audio', ('chat_id', 'is_hidden')), (0, 0)),
+        (sql_select('audio', ('is_moved', 'local_path')), (1, '')),
+        (sql_select('audio', ('is_moved', 'is_hidden')), (0, 1)),
+        (sql_select('audio', ('is_hidden',), order='date DESC'), (1,)),
+        (sql_select('audio', ('tags_read', 'is_downloaded')), (0, 1)),
+        (SQL_GET_TEMP_USAGE, ()),
+        (sql_delete('audio', ('id',)), (0,)),
+        (SQL_SELECT_TEMP_LRU, (1, 0)),
+        (SQL_EVICT_AUDIO, (0,)),
+        (SQL_SELECT_TEMP_AUDIO_PATHS % '?', ('',)),
+        (SQL_SELECT_DOWNLOAD_JOBS, ()),
+        (sql_update('download_job', ('state',), ('state',)), (0, 1)),
+        (sql_update('download_job', ('state', 'attempts', 'last_error'), ('chat_id', 'message_id')), (0, 0, '', 0, 0)),
+        (sql_delete('download_job', ('chat_id', 'message_id')), (0, 0)),
+        (sql_delete('download_job', ('state',)), (0,)),
+        (sql_update('audio', ('rating',), ('id',), 1), (0, 0)),
+        (sql_update('audio', ('is_downloaded', 'local_path'), ('is_downloaded', 'is_moved')), (0, '', 1, 0)),
+        (sql_select('playlist', ('chat_id',), 1), (0,)),
+        (sql_select('pinned_message', ('chat_id',)), (0,)),
+        (sql_select('playlist_segment', ('chat_id',)), (0,)),
+        (sql_delete('playlist_segment', ('chat_id', 'start_id', 'end_id')), (0, 0, 0)),
+    ]
+
 
 class PinnedMessageData(TypedDict):
     # id: Optional[int]
@@ -79,101 +282,234 @@ class PinnedMessage:
         return Storage.loaded().insert('pinned_message', data)
 
 
+class SegmentSet:
+    """
+    Sorted set of disjoint message id intervals, used for loaded history ranges.
+    Containment lookup is a binary search, adding an interval merges it with overlapping ones
+    """
+
+    def __init__(self, segments: Iterable[Tuple[int, int]] = ()):
+        self._lows: List[int] = []
+        self._highs: List[int] = []
+        for start, end in segments:
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self._lows)
+
+    def __iter__(self):
+        """ Iterate (start, end) pairs, start is the highest message id """
+        return zip(self._highs, self._lows)
+
+    def find(self, value) -> Optional[Tuple[int, int]]:
+        """ Get (start, end) segment containing the value """
+        i = bisect.bisect_right(self._lows, value) - 1
+        if i >= 0 and self._highs[i] >= value:
+            return self._highs[i], self._lows[i]
+        return None
+
+    def add(self, start, end) -> Tuple[Tuple[int, int], List[Tuple[int, int]]]:
+        """ Add segment, returns the merged (start, end) segment and the list of segments merged into it """
+        low, high = min(start, end), max(start, end)
+        i = bisect.bisect_left(self._lows, low)
+        # previous segment overlapping the new one
+        if i > 0 and self._highs[i - 1] >= low:
+            i -= 1
+        j = i
+        while j < len(self._lows) and self._lows[j] <= high:
+            j += 1
+        merged = list(zip(self._highs[i:j], self._lows[i:j]))
+        if merged:
+            low = min(low, self._lows[i])
+            high = max(high, self._highs[j - 1])
+        self._lows[i:j] = [low]
+        self._highs[i:j] = [high]
+        return (high, low), merged
+
+    def remove(self, start, end) -> bool:
+        """ Remove segment """
+        i = bisect.bisect_left(self._lows, min(start, end))
+        if i < len(self._lows) and self._highs[i] == max(start, end):
+            del self._lows[i]
+            del self._highs[i]
+            return True
+        return False
+
+
 class Playlist:
-    """ Represents a playlist with segments and metadata """
+    """
+    Represents a playlist with metadata and loaded history segments.
+    The segment being loaded (current) is kept apart from the stored ones until insert_empty()
+    """
     id: int
     chat_id: int
     title: str
     original_title: str
-    snapshot: str
-    segments: List[List[int]]
+    segments: SegmentSet
+    current_segment: List[int]
     has_changed: bool = False
 
     def __str__(self) -> str:
         return f'Playlist <{self.chat_id}>'
 
-    def __init__(self, data):
+    def __init__(self, data, segments: Iterable[Tuple[int, int]] = ()):
         """ Initialize playlist with data """
-        self.update(data)
+        self.update(data, segments)
 
     def is_changed_segments(self):
         """ Check if segments have changed """
-        return json.dumps(self.segments) != self.snapshot
+        return bool(self._deleted or self._added) or tuple(self.current_segment) != self._saved_current
 
-    def update(self, data):
+    def update(self, data, segments: Iterable[Tuple[int, int]] = ()):
         """ Update playlist data """
-        id_, chat_id, title, original_title, segments = data
+        id_, chat_id, title, original_title, _segments = data
         self.id = id_
         self.chat_id = chat_id
         self.title = title
         self.original_title = original_title
-        self.snapshot = segments
-        self.segments = json.loads(segments)
+        self.segments = SegmentSet()
+        self.current_segment = [0, 0]
+        self._saved_current = (0, 0)
+        self._deleted: List[Tuple[int, int]] = []
+        self._added: List[Tuple[int, int]] = []
+        for start, end in segments:
+            self._add_segment(start, end, saved=True)
+
+    def _add_segment(self, start, end, saved=False):
+        """ Add segment to the set, tracks rows which have to be written on save() """
+        segment, merged = self.segments.add(start, end)
+        if saved and not merged:
+            return
+        for item in merged:
+            if item in self._added:
+                self._added.remove(item)
+            else:
+                self._deleted.append(item)
+        if saved:
+            self._deleted.append((max(start, end), min(start, end)))
+        self._added.append(segment)
 
     def insert_empty(self):
-        """ Insert empty segment at current position """
-        self.segments.insert(CURRENT_SEGMENT, [0, 0])
+        """ Store current segment and start a new empty one """
+        start, end = self.current_segment
+        if start and end:
+            if self._saved_current != (0, 0):
+                # the row of the current segment is replaced by the merged one
+                self._deleted.append(self._saved_current)
+            self._add_segment(start, end)
+        self.current_segment = [0, 0]
+        self._saved_current = (0, 0)
 
     def set_current(self, segment_type, value):
         """ Set value for current segment """
-        self.segments[CURRENT_SEGMENT][segment_type] = value
+        self.current_segment[segment_type] = value
 
     def current(self, segment_type):
         """ Get current segment value """
-        return self.segments[CURRENT_SEGMENT][segment_type] if len(self.segments) else 0
+        return self.current_segment[segment_type]
 
     def search(self, value):
-        """ Search for value in segments """
-        for num, segment in enumerate(self.segments):
-            if num == CURRENT_SEGMENT:
-                continue
-            if value in segment:
-                return num, segment.index(value)
-        return None
+        """ Search for the stored segment containing value """
+        return self.segments.find(value)
 
     @staticmethod
     def read(chat_id):
         """ Read playlist from storage by chat_id """
-        playlist = Storage.loaded().select('playlist', {"chat_id": chat_id})
+        storage = Storage.loaded()
+        playlist = storage.select('playlist', {"chat_id": chat_id})
         data = playlist if playlist else tuple([0, chat_id, '', '', '[]'])
-        return Playlist(data)
+        segments = storage.select('playlist_segment', {"chat_id": chat_id}, limit=None)
+        return Playlist(data, [(start, end) for _id, _chat_id, start, end in segments])
 
     def join_segments(self, value):
-        """ Join segments around specified value """
-        segments = [self.segments[CURRENT_SEGMENT].copy()]
-        segments_old = self.segments.copy()
-        for num, segment in enumerate(segments_old):
-            if num == CURRENT_SEGMENT:
-                continue
-            if value in segment:
-                bound = segment.index(value)
-                if bound == SEGMENT_START:
-                    segments[CURRENT_SEGMENT][SEGMENT_END] = segment[SEGMENT_END]
-                # else:
-                #     segments[CURRENT_SEGMENT][SEGMENT_END] = value
-                continue
-            segments.append(segment)
-        self.segments = segments
+        """ Join the stored segment containing value into the current segment """
+        segment = self.segments.find(value)
+        if segment is None:
+            return
+        self.segments.remove(*segment)
+        if segment in self._added:
+            self._added.remove(segment)
+        else:
+            self._deleted.append(segment)
+        start, end = segment
+        self.current_segment[SEGMENT_START] = max(self.current_segment[SEGMENT_START], start)
+        self.current_segment[SEGMENT_END] = min(self.current_segment[SEGMENT_END] or end, end)
 
     def save(self):
-        """ Save playlist to storage """
+        """ Save changed segments to storage """
         if not self.is_changed_segments():
             return False
-        playlist = {
-            "chat_id": self.chat_id,
-            "title": self.title,
-            "original_title": self.original_title,
-            "segments": json.dumps(self.segments)
-        }
-        # print('Saving playlist')
+        storage = Storage.loaded()
+        if self.id == 0:
+            storage.insert('playlist', {
+                "chat_id": self.chat_id,
+                "title": self.title,
+                "original_title": self.original_title,
+            })
+            self.id = storage.select('playlist', {"chat_id": self.chat_id})[0]
+        current = tuple(self.current_segment)
+        deleted = self._deleted
+        added = self._added
+        if current != self._saved_current:
+            if self._saved_current != (0, 0):
+                deleted = deleted + [self._saved_current]
+            if current[SEGMENT_START] and current[SEGMENT_END]:
+                added = added + [current]
+        for start, end in deleted:
+            storage.delete('playlist_segment', {"chat_id": self.chat_id, "start_id": start, "end_id": end})
+        for start, end in added:
+            storage.insert('playlist_segment', {"chat_id": self.chat_id, "start_id": start, "end_id": end})
+        self._deleted = []
+        self._added = []
+        self._saved_current = current if current[SEGMENT_START] and current[SEGMENT_END] else (0, 0)
         self.has_changed = False
-        if self.id != 0:
-            return Storage.loaded().update('playlist', playlist, {"chat_id": self.chat_id}, 1)
-        return Storage.loaded().insert('playlist', playlist)
+        return True
+
+
+AUDIO_FIELDS = ('id', 'chat_id', 'message_id', 'mime_type', 'track_number', 'title', 'artist', 'album', 'genre',
+                'file_name', 'created_at', 'date', 'size', 'duration', 'is_downloaded', 'is_moved', 'is_hidden',
+                'local_path', 'play_count', 'rating', 'album_artist', 'year', 'disc_number', 'tags_read', 'last_access')
+AUDIO_FIELD_DEFAULTS = {'album': '', 'genre': '', 'play_count': 0, 'rating': 0, 'album_artist': '', 'year': 0,
+                        'disc_number': 0, 'tags_read': 0, 'last_access': 0}
+
+_NO_DEFAULT = object()
+
+
+class AudioField:
+    """ Audio attribute, reads the assigned value or decodes it lazily from the sqlite row """
+    __slots__ = ('name', 'index', 'default')
+
+    def __init__(self, name, index=None, default=_NO_DEFAULT):
+        self.name = name
+        self.index = index
+        self.default = default
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        data = obj._data
+        if data is not None and self.name in data:
+            return data[self.name]
+        row = obj._row
+        if row is not None and self.index is not None:
+            value = row[self.index]
+            return value or self.default if self.default is not _NO_DEFAULT else value
+        if self.default is _NO_DEFAULT:
+            raise AttributeError(f"'Audio' object has no attribute '{self.name}'")
+        return self.default
+
+    def __set__(self, obj, value):
+        if obj._data is None:
+            obj._data = {}
+        obj._data[self.name] = value
+
+    def __delete__(self, obj):
+        if obj._data is not None:
+            obj._data.pop(self.name, None)
 
 
 class Audio:
-    """ Represents an audio track with metadata and state """
+    """ Represents an audio track with metadata and state, row fields are decoded on first access """
     STATE_DEFAULT = 0
     STATE_DOWNLOADED = 1
     STATE_IN_LIBRARY = 2
@@ -203,43 +539,33 @@ class Audio:
     play_count: int
     rating: Literal[0, 1, 2, 3, 4, 5]
 
-    is_error = False
-    is_reloaded = False
-    link = None
+    __slots__ = ('_row', '_data')
 
     def __str__(self) -> str:
         return f'Audio <{self.chat_id},{self.message_id}>'
 
     def __init__(self, data):
-        self.update(data)
+        self._data = None
+        if type(data) == tuple:
+            self._set_row(data)
+        else:
+            self._row = None
+            self.update(data)
+
+    def _set_row(self, data):
+        if len(data) != len(AUDIO_FIELDS):
+            raise ValueError(f"Unexpected audio row length: {len(data)}")
+        self._row = data
 
     def update(self, data):
         """ Update audio data """
         if type(data) == tuple:
-            id_, chat_id, message_id, mime_type, track_number, title, artist, album, genre, file_name, created_at, \
-                date, size, duration, is_downloaded, is_moved, is_hidden, local_path, play_count, rating = data
-            self.id = id_
-            self.chat_id = chat_id
-            self.message_id = message_id
-            self.mime_type = mime_type
-            self.track_number = track_number
-            self.title = title
-            self.artist = artist
-            self.album_artist = self.artist
-            self.album = album or ''
-            self.genre = genre or ''
-            self.file_name = file_name
-            self.created_at = created_at
-            self.date = date
-            self.size = size
-            self.duration = duration
-            self.is_downloaded = is_downloaded
-            self.is_moved = is_moved
-            self.is_hidden = is_hidden
-            self.local_path = local_path
-            self.play_count = play_count or 0
-            self.rating = rating or 0
+            self._set_row(data)
+            if self._data:
+                # drop values assigned over the previous row, keep the runtime state
+                self._data = {k: v for k, v in self._data.items() if k not in AUDIO_FIELDS}
         else:
+            self._row = None
             self.id = data.get('id', 0)
             self.chat_id = data['chat_id']
             self.message_id = data['message_id']
@@ -247,7 +573,7 @@ class Audio:
             self.track_number = data.get('track_number', 0)
             self.title = data.get('title', '')
             self.artist = data.get('artist', '')
-            self.album_artist = self.artist
+            self.album_artist = data.get('album_artist', '')
             self.album = data.get('album', '')
             self.genre = data.get('genre', '')
             self.file_name = data.get('file_name', '')
@@ -261,14 +587,33 @@ class Audio:
             self.local_path = data.get('local_path')
             self.play_count = data.get('play_count', 0)
             self.rating = data.get('rating', 0)
+            self.year = data.get('year', 0)
+            self.disc_number = data.get('disc_number', 0)
+            self.tags_read = data.get('tags_read', 0)
+            self.last_access = data.get('last_access', 0)
 
     def get_album_artist(self):
         """ Get album artist or fallback to artist """
         return self.album_artist if self.album_artist and len(self.album_artist) else self.artist
 
     def get_year(self):
-        """ Get year from date """
-        return get_year(self.date)
+        """ Get year from the tags or from date """
+        return self.year or get_year(self.date)
+
+    def get_tags(self):
+        """ Get tags used by the file path patterns """
+        return {
+            'title': self.title,
+            'artist': self.artist,
+            'album_artist': self.get_album_artist(),
+            'album': self.album,
+            'track_number': self.track_number,
+            'disc_number': self.disc_number,
+            'date': self.date,
+            'duration': self.duration,
+            'genre': self.genre,
+            'year': self.get_year(),
+        }
 
     def is_file_exists(self):
         """ Check if audio file exists """
@@ -289,46 +634,55 @@ class Audio:
             return Audio.STATE_DOWNLOADED
         return Audio.STATE_DEFAULT
 
-    def _upd_and_move(self):
-        """ Update tags and move file to organized location """
-        if len(self.local_path or ''):
-            # read tags
-            tags = get_audio_tags(self.local_path)
-            self.album_artist = tags.get('album_artist', tags.get('artist', 'Unknown'))
-            for tag in dict(tags):
-                if tags[tag] is None:
-                    del tags[tag]
-            # format temp filename
-            src_dir = os.path.dirname(self.local_path)
-            chn_dir = f"{self.chat_id}".replace('-100', '')
-            sub_dir = filepath_parse_pattern('%ta/%ta - %at (%ay)', tags)
-            dst_dir = str(os.path.join(src_dir, chn_dir, sub_dir))
-            os.makedirs(dst_dir, exist_ok=True)
-            new_path = os.path.join(dst_dir, '%s.%s' % (self.message_id, self.get_file_ext()))
-            os.rename(self.local_path, new_path)
-            # remove tags which not used by Audio
-            if tags.get('album_artist'):
-                del tags['album_artist']
-            if tags.get('year'):
-                del tags['year']
-            # write both tags and new local_path
-            self.save({**tags, "local_path": new_path})
-
-    def download(self, success=empty_cb, fail=empty_cb):
-        """ Download audio file """
+    def _upd_and_move(self, done):
+        """ Update tags and move file to organized location, tags are read by the TagReader worker pool """
+        if not len(self.local_path or ''):
+            done()
+            return
+        if self.tags_read:
+            # the file of the same message is already parsed
+            self._move_temp(self.get_tags(), {})
+            done()
+            return
+
+        def tags_cb(tags):
+            if tags is not None:
+                tags = {tag: value for tag, value in tags.items() if value is not None}
+                self._move_temp(tags, {**tags, "tags_read": 1})
+            done()
+
+        TagReader().read(self.local_path, tags_cb)
+
+    def _move_temp(self, tags, data):
+        """ Moves the file in the temp directory by the tags, saves the data with the new local_path """
+        src_dir = os.path.dirname(self.local_path)
+        chn_dir = f"{self.chat_id}".replace('-100', '')
+        sub_dir = filepath_parse_pattern('%ta/%ta - %at (%ay)', tags)
+        dst_dir = str(os.path.join(src_dir, chn_dir, sub_dir))
+        os.makedirs(dst_dir, exist_ok=True)
+        new_path = os.path.join(dst_dir, '%s.%s' % (self.message_id, self.get_file_ext()))
+        os.rename(self.local_path, new_path)
+        self.save({**data, "local_path": new_path})
+
+    def download(self, success=empty_cb, fail=empty_cb, priority=1, on_file=empty_cb, canceled=empty_cb):
+        """
+        Download audio file, on_file(file_id) gets the TDLib file id once the download is queued.
+        A canceled download calls canceled() and is not an error of the audio
+        """
         storage = Storage.loaded()
         api = storage.api
 
         def on_success(data):
+            self.is_error = False
             self.update(data)
-            self._upd_and_move()
-            success(self)
+            self._upd_and_move(lambda: success(self))
 
         def on_fail():
             self.is_error = True
             fail()
 
-        api.download_audio_idle(self.chat_id, self.message_id, priority=1, on_success=on_success, on_error=on_fail)
+        api.download_audio_idle(self.chat_id, self.message_id, priority=priority, on_success=on_success, on_error=on_fail,
+                                on_file=on_file, on_cancel=canceled)
 
     def get_path(self):
         """ Get file path if exists """
@@ -339,15 +693,21 @@ class Audio:
 
     def save(self, data):
         """ Save audio data to storage """
-        res = Storage.loaded().update('audio', data, {"id": self.id}, limit=1)
+        storage = Storage.loaded()
+        res = storage.update('audio', data, {"id": self.id}, limit=1)
         if res:
             for k in data.keys():
                 setattr(self, k, data[k])
+            # keep the instance from the identity map in sync
+            cached = storage.audio_cache.peek((int(self.chat_id), int(self.message_id)))
+            if cached is not None and cached is not self:
+                for k in data.keys():
+                    setattr(cached, k, data[k])
         return res
 
-    def get_link(self):
-        """ Get message link from Telegram """
-        return Storage.loaded().api.get_message_link(self.chat_id, self.message_id)
+    def get_link(self, on_success, on_error=empty_cb):
+        """ Get message link, from the cache or from Telegram asynchronously """
+        Storage.loaded().api.get_message_link_idle(self.chat_id, self.message_id, on_success, on_error)
 
     def get_file_ext(self):
         """ Get file extension from mime type or filename """
@@ -360,10 +720,12 @@ class Audio:
         if db is None:
             db = entry.get_entry_type().db
         db.entry_set(entry, RB.RhythmDBPropType.TRACK_NUMBER, self.track_number)
+        if self.disc_number:
+            db.entry_set(entry, RB.RhythmDBPropType.DISC_NUMBER, self.disc_number)
         db.entry_set(entry, RB.RhythmDBPropType.TITLE, self.title)
         db.entry_set(entry, RB.RhythmDBPropType.ARTIST, self.artist)
         db.entry_set(entry, RB.RhythmDBPropType.ALBUM, self.album)
-        db.entry_set(entry, RB.RhythmDBPropType.ALBUM_ARTIST, self.artist)
+        db.entry_set(entry, RB.RhythmDBPropType.ALBUM_ARTIST, self.get_album_artist())
         db.entry_set(entry, RB.RhythmDBPropType.GENRE, self.genre)
         db.entry_set(entry, RB.RhythmDBPropType.DURATION, self.duration)
         db.entry_set(entry, RB.RhythmDBPropType.FIRST_SEEN, int(self.created_at))
@@ -377,6 +739,14 @@ class Audio:
             db.commit()
 
 
+for _index, _name in enumerate(AUDIO_FIELDS):
+    setattr(Audio, _name, AudioField(_name, _index, AUDIO_FIELD_DEFAULTS.get(_name, _NO_DEFAULT)))
+Audio.is_error = AudioField('is_error', default=False)  # type: ignore
+Audio.is_reloaded = AudioField('is_reloaded', default=False)  # type: ignore
+Audio.link = AudioField('link', default=None)  # type: ignore
+Audio.meta_tags = AudioField('meta_tags')  # type: ignore
+
+
 MigrationStep = Union[str, Callable]
 
 
@@ -442,6 +812,49 @@ class Migration:
                     print(f"Error applying migration for version {version}: {e}")
                     raise
 
+class AudioCache:
+    """ Bounded LRU identity map of Audio objects keyed by (chat_id, message_id) """
+
+    def __init__(self, max_size=AUDIO_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[Tuple[int, int], Audio] = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key) -> Optional[Audio]:
+        """ Get audio and mark it as recently used, counts hits and misses """
+        audio = self._items.get(key)
+        if audio is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return audio
+
+    def peek(self, key) -> Optional[Audio]:
+        """ Get audio without affecting the LRU order and counters """
+        return self._items.get(key)
+
+    def put(self, audio: Audio):
+        """ Add audio, evicts the least recently used items when the cache is full """
+        key = (int(audio.chat_id), int(audio.message_id))
+        self._items[key] = audio
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def remove(self, key):
+        """ Drop the item """
+        self._items.pop(key, None)
+
+    def clear(self):
+        """ Drop all items """
+        self._items.clear()
+
+
 class Storage:
     """ Manages database storage and operations """
     _instance = None
@@ -449,13 +862,19 @@ class Storage:
     def __str__(self) -> str:
         return f'Storage <{self.api.hash}>'
 
-    def __init__(self, api, files_dir):
+    def __init__(self, api, files_dir, profile=None):
         """ Initialize storage """
         self.api = api
         self.files_dir = files_dir
         self.db_file = os.path.join(self.files_dir, 'data.sqlite')
         create_db = not os.path.exists(self.db_file)
-        self.db = sqlite3.connect(self.db_file)
+        self.db = sqlite3.connect(self.db_file, cached_statements=STATEMENT_CACHE_SIZE)
+        self._apply_profile(CONNECTION_PROFILE if profile is None else profile)
+        # rows removed by REPLACE conflicts must fire the audio_fts delete trigger
+        self.db.execute('PRAGMA recursive_triggers = ON')
+        self._pending = 0
+        self._commit_timer_id = None
+        self.audio_cache = AudioCache()
         Storage._instance = self
 
         if create_db:
@@ -468,71 +887,99 @@ class Storage:
         migration = Migration(self.db, schema.MIGRATIONS)
         migration.apply()
 
+        self.has_fts = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'audio_fts'").fetchone() is not None
+
+        if logger.isEnabledFor(logging.DEBUG):
+            self.check_query_plans()
+
     @staticmethod
     def loaded():
         """ Get loaded storage instance """
         return Storage._instance
 
+    def check_query_plans(self, queries=None) -> List[Tuple[str, str]]:
+        """ Run EXPLAIN QUERY PLAN for the queries and report full table scans """
+        scans = []
+        for sql, params in queries if queries is not None else storage_queries():
+            for row in self.db.execute(f'EXPLAIN QUERY PLAN {sql}', params):
+                detail = row[-1]
+                # scans of VALUES lists and of virtual (fts) tables are expected
+                if detail.startswith('SCAN ') and not any(x in detail for x in PLAN_EXPECTED_SCANS):
+                    scans.append((' '.join(sql.split()), detail))
+        for sql, detail in scans:
+            logger.warning('Full scan in query plan: %s (%s)', sql, detail)
+        return scans
+
+    def _apply_profile(self, profile):
+        """ Apply connection profile (sqlite pragmas) """
+        for name, value in profile.items():
+            try:
+                self.db.execute(f'PRAGMA {name} = {value}')
+            except sqlite3.DatabaseError as e:
+                logger.warning('Unable to set PRAGMA %s = %s: %s', name, value, e)
+
+    def _write(self, sql, params=()):
+        """
+        Execute a mutation inside the open transaction. The statement runs immediately on the shared
+        connection, so reads see it, but the commit is deferred and grouped with other writes
+        """
+        cursor = self.db.execute(sql, params)
+        self._pending += 1
+        self._write_done()
+        return cursor
+
+    def _write_done(self):
+        """ Schedule commit of pending writes """
+        if self._pending >= COMMIT_MAX_PENDING:
+            self.flush()
+        elif self._commit_timer_id is None:
+            self._commit_timer_id = GLib.timeout_add(COMMIT_DELAY, self._commit_timeout_cb)
+
+    def _commit_timeout_cb(self):
+        """ Timer callback, commits pending writes """
+        self._commit_timer_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """ Commit all pending writes in a single transaction """
+        if self._commit_timer_id is not None:
+            GLib.source_remove(self._commit_timer_id)
+            self._commit_timer_id = None
+        if self._pending or self.db.in_transaction:
+            self._pending = 0
+            self.db.commit()
+
     def select(self, table, where, limit=1):
         """ Select rows from table """
-        set_where = []
-        set_values = []
-        for k in where.keys():
-            set_where.append(f'{k} = ?')
-            set_values.append(where[k])
-        set_where = ' and '.join(set_where)
-        sql = f"SELECT * FROM `{table}` WHERE {set_where}"
-        if limit and limit > 0:
-            sql = f'{sql} LIMIT {limit}'
-        cursor = self.db.execute(sql, tuple(set_values))
+        sql = sql_select(table, tuple(where.keys()), limit)
+        cursor = self.db.execute(sql, tuple(where.values()))
         if not limit or limit != 1:
             return cursor.fetchall()
         return cursor.fetchone()
 
     def update(self, table, data, where, limit=0):
         """ Update rows in table """
-        set_keys, set_values = self._prepare(data)
-        set_where = []
-        for k in where.keys():
-            set_where.append(f'{k} = ?')
-            set_values.append(where[k])
-        set_where = ' AND '.join(set_where)
-        sql = f"UPDATE `{table}` SET {set_keys} WHERE {set_where}"
-        if limit and limit > 0:
-            sql = f'{sql} LIMIT {limit}'
-        cursor = self.db.execute(sql, tuple(set_values))
-        result = cursor.rowcount > 0
-        self.db.commit()
-        return result
+        sql = sql_update(table, tuple(data.keys()), tuple(where.keys()), limit)
+        cursor = self._write(sql, (*data.values(), *where.values()))
+        if table == 'audio' and tuple(where.keys()) != ('id',):
+            # bulk update, cached objects may be stale (updates by id are synced by Audio.save)
+            self.audio_cache.clear()
+        return cursor.rowcount > 0
+
+    def delete(self, table, where) -> bool:
+        """ Delete rows from table """
+        cursor = self._write(sql_delete(table, tuple(where.keys())), tuple(where.values()))
+        if table == 'audio':
+            self.audio_cache.clear()
+        return cursor.rowcount > 0
 
     def insert(self, table, data) -> bool:
         """ Insert row into table """
-        set_keys = []
-        set_place = []
-        set_values = []
-        for k in data.keys():
-            set_keys.append(f'{k}')
-            set_values.append(data[k])
-            set_place.append('?')
-        set_keys = ', '.join(set_keys)
-        set_place = ', '.join(set_place)
-        sql = f"INSERT INTO `{table}` ({set_keys}) VALUES ({set_place})"
-        cursor = self.db.execute(sql, tuple(set_values))
-        result = cursor.rowcount > 0
-        self.db.commit()
-        return result
-
-    def _prepare(self, data) -> Tuple[str, List[str]]:
-        """ Prepare data for SQL operations """
-        if not data:
-            return '', []
-        set_keys = []
-        set_values = []
-        for k in data.keys():
-            set_keys.append(f'`{k}` = ?')
-            set_values.append(data[k])
-        set_keys = ', '.join(set_keys)
-        return set_keys, set_values
+        sql = sql_insert(table, tuple(data.keys()))
+        cursor = self._write(sql, tuple(data.values()))
+        return cursor.rowcount > 0
 
     def get_entry_audio(self, entry):
         """ Get Audio instance from Rhythmbox entry """
@@ -542,55 +989,106 @@ class Storage:
 
     def get_audio(self, chat_id, message_id, convert=True):
         """ Get audio by chat and message ID """
-        audio = self.db.execute(
-            "SELECT * FROM `audio` WHERE chat_id = '%s' and message_id = '%s' LIMIT 1" % (chat_id, message_id))
-        result = audio.fetchone()
+        key = (int(chat_id), int(message_id))
+        if convert:
+            audio = self.audio_cache.get(key)
+            if audio is not None:
+                return audio
+        result = self.db.execute(SQL_GET_AUDIO, key).fetchone()
         if result and convert:
-            return Audio(result)
+            audio = Audio(result)
+            self.audio_cache.put(audio)
+            return audio
         return result
 
-    def load_entries(self, chat_id, each, visibility=VISIBILITY_ALL):
-        """ Load entries for chat with visibility filter """
-        sql = 'SELECT * FROM `audio` WHERE chat_id = ?' # noqa
-        data = (chat_id,)
-        if visibility == VISIBILITY_VISIBLE:
-            sql += ' AND is_hidden = ?'
-            data = (chat_id, 0)
-        elif visibility == VISIBILITY_HIDDEN:
-            sql += ' AND is_hidden = ?'
-            data = (chat_id, 1)
-        cursor = self.db.cursor()
-        cursor.execute(sql, data)
-        for row in cursor:
-            each(Audio(row))
+    @staticmethod
+    def _fts_query(query, column='any'):
+        """ Build FTS5 match expression, every word of the query is matched as a prefix """
+        words = re.findall(r'\w+', query)
+        if not words:
+            return None
+        terms = ['"%s"*' % word.replace('"', '""') for word in words]
+        if column in ('artist', 'title'):
+            return '%s : (%s)' % (column, ' AND '.join(terms))
+        return ' AND '.join(terms)
+
+    def search_audio(self, query, column='any', limit=SEARCH_LIMIT) -> List[Audio]:
+        """ Search audio by artist and/or title, results are ordered by relevance """
+        if self.has_fts:
+            match = self._fts_query(query, column)
+            if match is None:
+                return []
+            cursor = self.db.execute(SQL_SEARCH_AUDIO_FTS, (match, limit))
+        else:
+            like = f'%{query}%'
+            if column in ('artist', 'title'):
+                cursor = self.db.execute(f'SELECT * FROM `audio` WHERE {column} LIKE ? LIMIT ?', (like, limit))
+            else:
+                cursor = self.db.execute('SELECT * FROM `audio` WHERE artist LIKE ? OR title LIKE ? LIMIT ?',
+                                         (like, like, limit))
+        audios = [self.get_row_audio(row) for row in cursor]
         cursor.close()
+        return audios
+
+    def get_row_audio(self, row):
+        """
+        Get Audio instance for the row. The cached instance is reused (and refreshed) if present,
+        otherwise a new one is created without adding it to the cache, so bulk reads don't flush it
+        """
+        audio = self.audio_cache.peek((int(row[1]), int(row[2])))
+        if audio is None:
+            return Audio(row)
+        audio.update(row)
+        return audio
+
+    @staticmethod
+    def _visibility_where(chat_id, visibility):
+        """ Get where keys and params for chat entries with visibility filter """
+        if visibility == VISIBILITY_VISIBLE:
+            return ('chat_id', 'is_hidden'), (chat_id, 0)
+        if visibility == VISIBILITY_HIDDEN:
+            return ('chat_id', 'is_hidden'), (chat_id, 1)
+        return ('chat_id',), (chat_id,)
+
+    def count_entries(self, chat_id, visibility=VISIBILITY_ALL) -> int:
+        """ Count entries for chat with visibility filter """
+        keys, params = self._visibility_where(chat_id, visibility)
+        return self.db.execute(sql_count('audio', keys), params).fetchone()[0]
+
+    def load_entries(self, chat_id, visibility=VISIBILITY_ALL, page_size=ENTRIES_PAGE_SIZE) -> Iterator[Audio]:
+        """
+        Iterate entries for chat with visibility filter, newest messages first.
+        Rows are selected by pages after the last message_id, so no cursor is kept open between pages
+        """
+        keys, params = self._visibility_where(chat_id, visibility)
+        sql = sql_select_page('audio', keys, 'message_id', page_size)
+        last_id = MAX_MESSAGE_ID
+        while True:
+            rows = self.db.execute(sql, (*params, last_id)).fetchall()
+            for row in rows:
+                yield self.get_row_audio(row)
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][2]
 
     def each(self, callback, table, where, order=None):
         """ Iterate through table rows """
-        set_where = []
-        set_values = []
-        for k in where.keys():
-            set_where.append(f'{k} = ?')
-            set_values.append(where[k])
-        set_where = ' and '.join(set_where)
-        sql = f"SELECT * FROM `{table}` WHERE {set_where}"
-        if order:
-            sql += ' ORDER BY %s' % order
         cursor = self.db.cursor()
-        cursor.execute(sql, tuple(set_values))
+        cursor.execute(sql_select(table, tuple(where.keys()), order=order), tuple(where.values()))
         for row in cursor:
             callback(row)
         cursor.close()
 
-    def add_audio(self, data, convert=True):
-        """ Add new audio to storage """
+    @staticmethod
+    def _audio_row(data):
+        """ Extract audio row from the message, returns None if the message has no valid audio """
         content = data.get('content', {})
         audio = content.get('audio')
 
         if not (audio and audio_content_set <= set(audio)):
             logger.warning('Audio message has no required keys, skipping...')
             logger.debug(content)
-            return
+            return None
         d = {}
 
         completed = audio['audio']['remote']['is_uploading_completed']
@@ -599,7 +1097,7 @@ class Storage:
 
         if not completed:
             logger.warning('Audio message: %d not uploaded, skipping...', audio_id)
-            return
+            return None
 
         d['track_number'] = extract_track_number(audio['file_name'])
         d['chat_id'] = data['chat_id']
@@ -614,6 +1112,13 @@ class Storage:
         d['is_downloaded'] = 1 if local['is_downloading_completed'] else 0
         d['created_at'] = data['date']
         d['date'] = get_date(data['date'])
+        return d
+
+    def add_audio(self, data, convert=True):
+        """ Add new audio to storage """
+        d = self._audio_row(data)
+        if d is None:
+            return None
 
         tg_audio = self.get_audio(d['chat_id'], d['message_id'], True)
         if tg_audio:
@@ -636,15 +1141,192 @@ class Storage:
 
             return d if not convert else tg_audio
 
-        cursor = self.db.execute("""
-            INSERT INTO `audio` (
-                chat_id, message_id, mime_type, title, artist, file_name, `date`, `created_at`, size, duration,
-                local_path, is_downloaded, track_number)
-            VALUES (
-                :chat_id, :message_id, :mime_type, :title, :artist, :file_name, :date, :created_at, :size, :duration,
-                :local_path, :is_downloaded, :track_number)
-        """ , d)
+        cursor = self._write(SQL_INSERT_AUDIO, d)
 
         d['id'] = cursor.lastrowid
-        self.db.commit()
-        return d if not convert else Audio(d)
+        if not convert:
+            return d
+        audio = Audio(d)
+        self.audio_cache.put(audio)
+        return audio
+
+    def update_audio_content(self, chat_id, message_id, content) -> Optional['Audio']:
+        """ Update stored audio from the edited message content, returns None if the audio is not stored """
+        audio = self.get_audio(chat_id, message_id)
+        if not audio:
+            return None
+        d = self._audio_row({'chat_id': chat_id, 'id': message_id, 'date': audio.created_at, 'content': content})
+        if d is None:
+            return None
+        data = {k: d[k] for k in ('mime_type', 'track_number', 'title', 'artist', 'file_name', 'duration', 'size')}
+        if d['size'] != audio.size and not audio.is_moved:
+            # the file is replaced, the downloaded one is out of date
+            data.update({'local_path': d['local_path'], 'is_downloaded': d['is_downloaded']})
+        audio.save(data)
+        return audio
+
+    def remove_audios(self, chat_id, message_ids) -> List['Audio']:
+        """
+        Remove audio of the deleted messages, returns the removed audio.
+        Audio moved to the library is kept and hidden
+        """
+        removed = []
+        deleted = []
+        for message_id in message_ids:
+            audio = self.get_audio(chat_id, message_id)
+            if not audio:
+                continue
+            if audio.is_moved:
+                if not audio.is_hidden:
+                    audio.save({'is_hidden': 1})
+            else:
+                deleted.append(audio)
+            removed.append(audio)
+        if deleted:
+            # one batch, only the keys of the deleted rows are dropped from the cache
+            self.db.executemany(sql_delete('audio', ('id',)), [(audio.id,) for audio in deleted])
+            self._pending += len(deleted)
+            self._write_done()
+            for audio in deleted:
+                self.audio_cache.remove((int(audio.chat_id), int(audio.message_id)))
+        return removed
+
+    def save_audio_tags(self, rows) -> List['Audio']:
+        """ Save tags read from the files of the audio in one batch, rows are (audio, tags) pairs """
+        params = []
+        for audio, tags in rows:
+            params.append({'id': audio.id, **{k: tags.get(k) for k in
+                           ('album', 'album_artist', 'genre', 'year', 'track_number', 'disc_number')}})
+        self.db.executemany(SQL_UPDATE_AUDIO_TAGS, params)
+        self._pending += len(params)
+        self._write_done()
+        # keep the instances from the identity map in sync
+        audios = []
+        for audio, _tags in rows:
+            row = self.db.execute(SQL_GET_AUDIO, (audio.chat_id, audio.message_id)).fetchone()
+            if row:
+                cached = self.audio_cache.peek((int(audio.chat_id), int(audio.message_id)))
+                if cached is not None:
+                    cached.update(row)
+                audios.append(cached or Audio(row))
+        return audios
+
+    def get_temp_usage(self) -> Tuple[int, int]:
+        """ Get total size and number of the downloaded files which are not moved to the library """
+        row = self.db.execute(SQL_GET_TEMP_USAGE).fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    def get_temp_lru(self, limit, offset=0) -> List['Audio']:
+        """ Get the downloaded audio which is not moved to the library, least recently played first """
+        return [self.get_row_audio(row) for row in self.db.execute(SQL_SELECT_TEMP_LRU, (limit, offset))]
+
+    def evict_audios(self, audios):
+        """ Mark the audio whose temp files are deleted as not downloaded, in one batch """
+        self.db.executemany(SQL_EVICT_AUDIO, [(audio.id,) for audio in audios])
+        self._pending += len(audios)
+        self._write_done()
+        for audio in audios:
+            audio.is_downloaded = 0
+            audio.local_path = None
+            # keep the instance from the identity map in sync
+            cached = self.audio_cache.peek((int(audio.chat_id), int(audio.message_id)))
+            if cached is not None and cached is not audio:
+                cached.is_downloaded = 0
+                cached.local_path = None
+
+    def purge_temp_audio(self, paths) -> List['Audio']:
+        """ Mark the audio whose temp files are deleted as not downloaded, returns the audio """
+        audios = []
+        paths = list(paths)
+        for i in range(0, len(paths), AUDIO_KEYS_CHUNK):
+            chunk = paths[i:i + AUDIO_KEYS_CHUNK]
+            sql = SQL_SELECT_TEMP_AUDIO_PATHS % ', '.join('?' * len(chunk))
+            audios.extend(self.get_row_audio(row) for row in self.db.execute(sql, chunk))
+        if audios:
+            self.evict_audios(audios)
+        return audios
+
+    def add_download_jobs(self, audios, priority=0):
+        """ Add download jobs of the audio in one batch """
+        now = int(time.time())
+        params = [{'chat_id': audio.chat_id, 'message_id': audio.message_id, 'audio_id': audio.id,
+                   'priority': priority, 'created_at': now} for audio in audios]
+        self.db.executemany(SQL_ADD_DOWNLOAD_JOB, params)
+        self._pending += len(params)
+        self._write_done()
+
+    def get_download_jobs(self) -> List[Tuple[int, int, int, int, int]]:
+        """
+        Get (chat_id, message_id, audio_id, attempts, retry_at) of the unfinished download jobs.
+        Jobs which were active when the previous session ended are queued again
+        """
+        self.update('download_job', {'state': JOB_QUEUED}, {'state': JOB_ACTIVE})
+        return self.db.execute(SQL_SELECT_DOWNLOAD_JOBS).fetchall()
+
+    def get_chats(self) -> Dict[int, dict]:
+        """ Get the chat catalog with the number of stored audio in every chat, kept by the triggers """
+        cursor = self.db.execute("SELECT id, title, type, last_message_id, audio_count FROM `chat`")
+        return {row[0]: {'id': row[0], 'title': row[1], 'type': row[2], 'last_message_id': row[3],
+                         'audio_count': row[4]} for row in cursor}
+
+    def save_chats(self, chats):
+        """ Insert or update chats of the catalog """
+        chats = list(chats)
+        if chats:
+            self.db.executemany(SQL_UPSERT_CHAT, chats)
+            self._pending += len(chats)
+            self._write_done()
+
+    def get_message_links(self, chat_id, message_ids) -> Dict[int, str]:
+        """ Get cached links of the chat messages, message_id -> link """
+        links = {}
+        message_ids = list(message_ids)
+        for i in range(0, len(message_ids), AUDIO_KEYS_CHUNK):
+            chunk = message_ids[i:i + AUDIO_KEYS_CHUNK]
+            sql = "SELECT message_id, link FROM `message_link` WHERE chat_id = ? AND message_id IN (%s)" % \
+                  ', '.join('?' * len(chunk))
+            links.update(self.db.execute(sql, (int(chat_id), *chunk)).fetchall())
+        return links
+
+    def save_message_link(self, chat_id, message_id, link):
+        """ Cache the link of the message """
+        self._write("INSERT OR REPLACE INTO `message_link` (chat_id, message_id, link) VALUES (?, ?, ?)",
+                    (int(chat_id), int(message_id), link))
+
+    def _select_audio_keys(self, columns, keys):
+        """ Select audio rows by list of (chat_id, message_id) keys """
+        rows = []
+        for i in range(0, len(keys), AUDIO_KEYS_CHUNK):
+            chunk = keys[i:i + AUDIO_KEYS_CHUNK]
+            sql = sql_select_audio_keys(columns, len(chunk))
+            rows.extend(self.db.execute(sql, [v for key in chunk for v in key]).fetchall())
+        return rows
+
+    def add_audios(self, messages) -> List['Audio']:
+        """
+        Add a page of audio messages to storage in a single batch.
+        Already stored audio is returned with the is_reloaded flag set (used by PlaylistLoader)
+        """
+        rows = {}
+        for data in messages:
+            d = self._audio_row(data)
+            if d is not None:
+                rows[(d['chat_id'], d['message_id'])] = d
+        if not rows:
+            return []
+
+        keys = list(rows.keys())
+        existing = set((row[0], row[1])
+                       for row in self._select_audio_keys('`audio`.chat_id, `audio`.message_id', keys))
+
+        self.db.executemany(SQL_UPSERT_AUDIO, list(rows.values()))
+        self._pending += len(rows)
+        self._write_done()
+
+        result = {}
+        for row in self._select_audio_keys('`audio`.*', keys):
+            audio = self.get_row_audio(row)
+            key = (audio.chat_id, audio.message_id)
+            audio.is_reloaded = key in existing
+            result[key] = audio
+        return [result[key] for key in keys if key in result]
@@ -0,0 +1,354 @@
+# rhythmbox-telegram
+# Copyright (C) 2023-2026 Andrey Izman <izmanw@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from common import idle_add_once, empty_cb
+
+logger = logging.getLogger(__name__)
+
+STREAM_PRIORITY = 32            # TDLib priority of the streamed file downloads
+STREAM_CHUNK_SIZE = 64 * 1024   # Max size of one response write
+STREAM_PREBUFFER = 256 * 1024   # Bytes buffered at the requested offset before the response is started
+STREAM_SEEK_AHEAD = 1024 * 1024 # Offsets this close to the downloaded part are not requested separately
+STREAM_WAIT_TIMEOUT = 30        # Seconds without download progress before a request fails
+STREAM_REQUEST_TIMEOUT = 5      # Seconds to wait for the TDLib file state requests
+STREAMS_KEEP = 2                # Number of streams kept open
+
+REGEX_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class AudioStream:
+    """
+    Partially downloaded TDLib file. Keeps the TDLib download running from the offset the player
+    needs and lets the request threads wait for the downloaded bytes.
+    The downloadFile requests go through the rate limiter of the api, the file state requests are
+    answered by TDLib from its local state, so they are sent directly
+    """
+    def __init__(self, api, size, mime_type, on_complete):
+        self.api = api
+        self.tg = api.tg
+        self.file_id = None             # TDLib file id, known once the message is loaded
+        self.failed = False             # The message has no file to stream
+        self.size = size
+        self.mime_type = mime_type or 'application/octet-stream'
+        self.on_complete = on_complete
+        self.path = None
+        self.completed = False
+        self.download_offset = None
+        self.downloaded_prefix = 0
+        self._pending_offset = None     # Offset requested before the file id is known
+        self._fd = None
+        self._cond = threading.Condition()
+
+    def set_file(self, file):
+        """ Called on the main loop with the file of the loaded message, starts the requested download """
+        with self._cond:
+            self.file_id = file['id']
+            offset, self._pending_offset = self._pending_offset, None
+            self._cond.notify_all()
+        self.update(file)
+        if offset is not None:
+            self.request(offset)
+
+    def fail(self, *args):
+        """ Called on the main loop if the message can not be loaded, the waiting requests give up """
+        with self._cond:
+            self.failed = True
+            self._cond.notify_all()
+
+    def update(self, file):
+        """ Called from the tdlib worker thread with the updateFile state """
+        local = file.get('local', {})
+        with self._cond:
+            if local.get('path'):
+                self.path = local['path']
+            if file.get('size'):
+                self.size = file['size']
+            self.downloaded_prefix = local.get('downloaded_prefix_size', 0)
+            completed = local.get('is_downloading_completed', False)
+            notify_complete = completed and not self.completed
+            self.completed = completed
+            if notify_complete and self._fd is None and self.path:
+                # open before the completed file is moved out of the TDLib directory
+                self._open(self.path)
+            self._cond.notify_all()
+        if notify_complete and self.on_complete:
+            idle_add_once(self.on_complete)
+
+    def request(self, offset):
+        """ Starts the download from the given offset, unless it is already downloaded soon """
+        with self._cond:
+            if self.completed or self.failed:
+                return
+            if self.file_id is None:
+                self._pending_offset = offset
+                return
+            start = self.download_offset
+            if start is not None and start <= offset <= start + self.downloaded_prefix + STREAM_SEEK_AHEAD:
+                return
+            self.download_offset = offset
+            self.downloaded_prefix = 0
+        # limit 0 downloads the file up to the end, then TDLib completes the parts before the offset
+        send = lambda: self.tg.call_method('downloadFile', {
+            'file_id': self.file_id,
+            'priority': STREAM_PRIORITY,
+            'offset': offset,
+            'limit': 0,
+            'synchronous': False
+        })
+        # the rate limiter is driven by the main loop
+        idle_add_once(self.api.request, 'download', send, empty_cb)
+
+    def available(self, offset):
+        """ Returns the number of downloaded bytes starting at the offset """
+        if self.completed:
+            return max(0, self.size - offset)
+        if self.file_id is None:
+            return 0
+        r = self.tg.call_method('getFileDownloadedPrefixSize', {'file_id': self.file_id, 'offset': offset})
+        r.wait(timeout=STREAM_REQUEST_TIMEOUT, raise_exc=False)
+        if r.error or not r.update:
+            return 0
+        # the result type is Count in older TDLib versions and FileDownloadedPrefixSize in newer ones
+        return r.update.get('size', r.update.get('count', 0))
+
+    def wait(self, offset, need):
+        """ Waits until `need` bytes at the offset are downloaded, returns the number of available bytes """
+        need = min(need, self.size - offset)
+        deadline = time.monotonic() + STREAM_WAIT_TIMEOUT
+        last = -1
+        while True:
+            if self.failed:
+                return 0
+            count = self.available(offset)
+            if count >= need:
+                return count
+            if count > last:
+                last = count
+                deadline = time.monotonic() + STREAM_WAIT_TIMEOUT
+            elif time.monotonic() > deadline:
+                return count
+            self.request(offset + count)
+            with self._cond:
+                self._cond.wait(1)
+
+    def read(self, offset, length):
+        """ Reads downloaded bytes of the file """
+        with self._cond:
+            if self._fd is None:
+                path = self.path or self._get_path()
+                if not path or not self._open(path):
+                    return b''
+            fd = self._fd
+        return os.pread(fd, length, offset)
+
+    def _open(self, path):
+        # the descriptor stays valid when TDLib or the plugin moves the file
+        try:
+            self._fd = os.open(path, os.O_RDONLY)
+            return True
+        except OSError as e:
+            logger.warning('Unable to open the stream file %s: %s', path, e)
+            return False
+
+    def _get_path(self):
+        if self.file_id is None:
+            return None
+        r = self.tg.call_method('getFile', {'file_id': self.file_id})
+        r.wait(timeout=STREAM_REQUEST_TIMEOUT, raise_exc=False)
+        if r.error or not r.update:
+            return None
+        self.path = r.update.get('local', {}).get('path') or None
+        return self.path
+
+    def close(self):
+        with self._cond:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self.on_complete = None
+            self._cond.notify_all()
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    """ Serves the byte ranges of the streams """
+    server: 'StreamServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def _serve(self, body):
+        stream = self.server.proxy.get(self.path.lstrip('/').split('.', 1)[0])
+        if not stream:
+            self.send_error(404)
+            return
+
+        size = stream.size
+        start, end = 0, size - 1
+        partial = False
+        match = REGEX_RANGE.match(self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            partial = True
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(0, size - int(match.group(2)))
+        if start > end:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        available = stream.wait(start, STREAM_PREBUFFER) if body else 0
+        if body and not available:
+            self.send_error(503)
+            return
+
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', stream.mime_type)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if partial:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if not body:
+            return
+
+        pos = start
+        try:
+            while pos <= end:
+                if not available:
+                    available = stream.wait(pos, STREAM_CHUNK_SIZE)
+                    if not available:
+                        logger.warning('Stream of file %s stalled at %d', stream.file_id, pos)
+                        break
+                data = stream.read(pos, min(available, STREAM_CHUNK_SIZE, end - pos + 1))
+                if not data:
+                    break
+                self.wfile.write(data)
+                pos += len(data)
+                available -= len(data)
+        except OSError:
+            # the player closes the connection on seek, or the stream was closed
+            pass
+        self.close_connection = True
+
+
+class StreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        super().__init__(('127.0.0.1', 0), StreamRequestHandler)
+
+
+class StreamProxy:
+    """
+    Local HTTP server which lets the player read Telegram audio while it is being downloaded.
+    The player gets a http://127.0.0.1 uri, range requests of seeks move the TDLib download offset
+    """
+    def __init__(self, api):
+        self.api = api
+        self._streams = OrderedDict()   # key -> AudioStream, the most recently opened last
+        self._files = {}                # TDLib file id -> AudioStream
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """ Starts the server thread and listening to the file updates """
+        if not self._server:
+            self._server = StreamServer(self)
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            self.api.tg.add_update_handler('updateFile', self._update_file_cb)
+        return self
+
+    def stop(self):
+        """ Stops the server and closes the streams """
+        if self._server:
+            self.api.tg.remove_update_handler('updateFile', self._update_file_cb)
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            streams = list(self._streams.values())
+            self._streams.clear()
+            self._files.clear()
+        for stream in streams:
+            stream.close()
+
+    def open(self, audio, on_complete=None):
+        """ Starts streaming of the audio and returns the uri for the player """
+        if not self._server or not audio.size:
+            return None
+        key = '%s_%s' % (audio.chat_id, audio.message_id)
+        closed = []
+        created = False
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream:
+                self._streams.move_to_end(key)
+            else:
+                stream = AudioStream(self.api, audio.size, audio.mime_type, on_complete)
+                self._streams[key] = stream
+                created = True
+                while len(self._streams) > STREAMS_KEEP:
+                    _, old = self._streams.popitem(last=False)
+                    self._files.pop(old.file_id, None)
+                    closed.append(old)
+        for old in closed:
+            old.close()
+        if created:
+            self.api.get_audio_file_idle(audio.chat_id, audio.message_id,
+                                         on_success=lambda file: self._set_file(stream, file), on_error=stream.fail)
+        stream.request(0)
+        return 'http://127.0.0.1:%d/%s.%s' % (self._server.server_port, key, audio.get_file_ext())
+
+    def _set_file(self, stream, file):
+        """ Registers the stream for the updates of its file """
+        with self._lock:
+            if stream not in self._streams.values():
+                # closed meanwhile
+                return
+            self._files[file['id']] = stream
+        stream.set_file(file)
+
+    def get(self, key):
+        with self._lock:
+            return self._streams.get(key)
+
+    def _update_file_cb(self, update):
+        """ Callback for the TDLib file download updates """
+        file = update.get('file', {})
+        with self._lock:
+            stream = self._files.get(file.get('id'))
+        if stream:
+            stream.update(file)
@@ -0,0 +1,104 @@
+# rhythmbox-telegram
+# Copyright (C) 2023-2026 Andrey Izman <izmanw@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+import itertools
+import threading
+from gi.repository import RB  # type: ignore
+from common import get_audio_tags, idle_add_once, empty_cb, SingletonMeta
+
+TAG_WORKERS = 2             # Threads reading the tags
+TAG_BACKFILL_BATCH = 50     # Backfilled rows written to the storage at once
+
+# job priorities, files just downloaded go before the backfill
+TAG_PRIORITY_DOWNLOAD = 0
+TAG_PRIORITY_BACKFILL = 1
+
+
+class TagReader(metaclass=SingletonMeta):
+    """
+    Reads tags of the downloaded files in a pool of worker threads, each thread has its own RB.MetaData.
+    Results are delivered to the main loop
+    """
+
+    def __init__(self):
+        self._jobs = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._threads = []
+        self._backfill_left = 0
+        self._backfill_rows = []
+
+    def read(self, path, callback, priority=TAG_PRIORITY_DOWNLOAD):
+        """ Reads tags of the file, then calls callback(tags) in the main loop, tags are None if there is no file """
+        if not self._threads:
+            self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(TAG_WORKERS)]
+            for thread in self._threads:
+                thread.start()
+        self._jobs.put((priority, next(self._seq), (path, callback)))
+
+    def stop(self):
+        """ Drops the pending jobs and stops the worker threads """
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in self._threads:
+            self._jobs.put((-1, next(self._seq), None))
+        self._threads = []
+        self._backfill_left = 0
+        self._backfill_rows = []
+
+    def backfill(self, storage, on_updated=empty_cb):
+        """
+        Reads tags of the downloaded files which were never parsed, the rows are updated in batches.
+        Calls on_updated(audios) in the main loop with the updated audio of every batch.
+        Rows without a readable file are marked as read too, so they are not queued on every login
+        """
+        rows = storage.select('audio', {'tags_read': 0, 'is_downloaded': 1}, limit=None)
+        missing = []
+        for row in rows:
+            audio = storage.get_row_audio(row)
+            if audio.local_path:
+                self._backfill_left += 1
+                self.read(audio.local_path, lambda tags, a=audio: self._backfilled(storage, on_updated, a, tags),
+                          TAG_PRIORITY_BACKFILL)
+            else:
+                missing.append((audio, {}))
+        if missing:
+            storage.save_audio_tags(missing)
+
+    def _backfilled(self, storage, on_updated, audio, tags):
+        if self._backfill_left <= 0:
+            # stopped
+            return
+        self._backfill_left -= 1
+        # empty tags of a missing or unparsable file keep the stored values and only set tags_read
+        self._backfill_rows.append((audio, tags if tags is not None else {}))
+        if self._backfill_rows and (len(self._backfill_rows) >= TAG_BACKFILL_BATCH or not self._backfill_left):
+            rows, self._backfill_rows = self._backfill_rows, []
+            on_updated(storage.save_audio_tags(rows))
+
+    def _run(self):
+        metadata = RB.MetaData()
+        while True:
+            _priority, _seq, job = self._jobs.get()
+            if job is None:
+                return
+            path, callback = job
+            tags = get_audio_tags(path, metadata) if os.path.isfile(path) else None
+            idle_add_once(callback, tags)
@@ -16,10 +16,13 @@
 
 import re
 from gi.repository import RB  # type: ignore
-from gi.repository import GObject, Gdk, Gio, GLib
+from gi.repository import GObject, Gio, GLib
 import hashlib
 import logging
 import sys, os
+import threading
+import time
+from collections import deque
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "lib"))
 from telegram.client import Telegram
 from telegram.utils import AsyncResult
@@ -36,9 +39,41 @@ logger = logging.getLogger(__name__)
 
 
 class TelegramClient(Telegram):
-    """ Extended Telegram client with custom authorization handling """
+    """ Extended Telegram client with custom authorization handling and result watches """
     error = None
 
+    def __init__(self, *args, **kwargs):
+        self._watches: dict[str, list] = {}
+        self._watches_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _update_async_result(self, update):
+        """ Runs in the tdlib listener thread, wakes watches of the completed result """
+        result = super()._update_async_result(update)
+        if result is not None and result._ready.is_set():
+            with self._watches_lock:
+                watches = self._watches.pop(result.id, ())
+            for watch in watches:
+                watch.wake()
+        return result
+
+    def watch(self, result: AsyncResult, watch: 'ResultWatch'):
+        """ Register watch to be woken once the result is ready """
+        with self._watches_lock:
+            if not result._ready.is_set():
+                self._watches.setdefault(result.id, []).append(watch)
+                return
+        watch.wake()
+
+    def unwatch(self, result: AsyncResult, watch: 'ResultWatch'):
+        """ Unregister watch """
+        with self._watches_lock:
+            watches = self._watches.get(result.id)
+            if watches and watch in watches:
+                watches.remove(watch)
+                if not watches:
+                    del self._watches[result.id]
+
     def _wait_authorization_result(self, result: AsyncResult) -> AuthorizationState:
         authorization_state = None
 
@@ -59,6 +94,56 @@ class TelegramClient(Telegram):
         return AuthorizationState(authorization_state)
 
 
+class ResultWatch:
+    """
+    Calls back on the main loop exactly once when the TDLib request is completed, or when the timeout
+    expires (the result is not ready then). Replaces polling of AsyncResult from idle callbacks
+    """
+
+    def __init__(self, client: TelegramClient, result: AsyncResult, callback, timeout=None):
+        self.client = client
+        self.result = result
+        self.callback = callback
+        self.cancelled = False
+        self._done = False
+        self._timer_id = None
+        if timeout:
+            self._timer_id = GLib.timeout_add(int(timeout * 1000), self._timeout_cb)
+        client.watch(result, self)
+
+    def wake(self):
+        """ Called once from any thread when the result is ready """
+        GLib.idle_add(self._dispatch_cb)
+
+    def cancel(self):
+        """ Drop the request callback """
+        self.cancelled = True
+        self._remove_timer()
+        self.client.unwatch(self.result, self)
+
+    def _remove_timer(self):
+        if self._timer_id is not None:
+            GLib.source_remove(self._timer_id)
+            self._timer_id = None
+
+    def _dispatch_cb(self):
+        self._remove_timer()
+        if not self._done and not self.cancelled:
+            self._done = True
+            self.callback(self.result)
+        return False
+
+    def _timeout_cb(self):
+        self._timer_id = None
+        if not self._done and not self.cancelled:
+            request = self.result.request.get('@type') if self.result.request else self.result.id
+            logger.warning('Telegram API request %s timed out', request)
+            self._done = True
+            self.client.unwatch(self.result, self)
+            self.callback(self.result)
+        return False
+
+
 class TelegramAuthError(Exception):
     """ Exception for Telegram authorization errors """
     def __init__(self, message, info):
@@ -90,6 +175,8 @@ API_PAGE_LOADED = 'API_PAGE_LOADED'
 
 LAST_MESSAGE_ID = 0x100000  # 1048576
 
+REQUEST_TIMEOUT = 60  # seconds, for requests which are not downloads
+
 TDLIB_VERB_FATAL = 0
 TDLIB_VERB_ERROR = 1
 TDLIB_VERB_WARN  = 2
@@ -97,6 +184,150 @@ TDLIB_VERB_INFO  = 3
 TDLIB_VERB_DEBUG = 4
 
 
+# requests per second and burst size of the method classes
+RATE_LIMITS = {
+    'chats': (1.0, 2),       # loadChats
+    'history': (1.0, 3),     # getChatHistory, searchChatMessages
+    'message': (4.0, 8),     # getMessage, getMessageLink
+    'download': (2.0, 4),    # downloadFile
+}
+REGEX_FLOOD_WAIT = re.compile(r'(?:FLOOD_WAIT_|retry after )(\d+)')
+
+
+def get_flood_wait(r: AsyncResult):
+    """ Returns the number of seconds to wait if the request failed with FLOOD_WAIT_X or 429, otherwise None """
+    if r.ok_received or not r.error:
+        return None
+    info = r.error_info if r.error_info else {}
+    m = REGEX_FLOOD_WAIT.search(info.get('message') or '')
+    if m:
+        return int(m.group(1))
+    return 1 if info.get('code') == 429 else None
+
+
+class TokenBucket:
+    """ Request budget of a method class, the rate drops on flood waits and recovers with successful requests """
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        """ Seconds until a request can be sent """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def flood(self, seconds, now):
+        """ Blocks the class for the time given by the server and halves the rate """
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.tokens = 0
+
+    def success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class ApiRequest:
+    """ Request queued by the RateLimiter, sent when the budget of its method class allows """
+
+    def __init__(self, limiter: 'RateLimiter', klass, send, callback, timeout):
+        self.limiter = limiter
+        self.klass = klass
+        self.send = send
+        self.callback = callback
+        self.timeout = timeout
+        self.result = None
+        self.watch = None
+
+    def cancel(self):
+        """ Drop the request, or its callback if it is already sent """
+        if self.watch is not None:
+            self.watch.cancel()
+            self.watch = None
+        else:
+            self.limiter.discard(self)
+
+
+class RateLimiter:
+    """
+    Paces the TDLib requests of every method class with a token bucket. Requests failed with
+    FLOOD_WAIT_X or 429 are queued again and the class waits for the time given by the server
+    """
+
+    def __init__(self, api: 'TelegramApi'):
+        self.api = api
+        self.buckets = {klass: TokenBucket(*limit) for klass, limit in RATE_LIMITS.items()}
+        self.queues = {klass: deque() for klass in RATE_LIMITS}
+        self._timer_id = None
+
+    def interval(self, klass):
+        """ Interval in ms between the requests of the method class at its current rate """
+        return int(1000 / self.buckets[klass].rate)
+
+    def submit(self, request: ApiRequest):
+        self.queues[request.klass].append(request)
+        self._dispatch()
+
+    def discard(self, request: ApiRequest):
+        try:
+            self.queues[request.klass].remove(request)
+        except ValueError:
+            pass
+
+    def _dispatch(self):
+        """ Sends the queued requests allowed by the budgets, sets the timer for the rest """
+        if self._timer_id is not None:
+            GLib.source_remove(self._timer_id)
+            self._timer_id = None
+        now = time.monotonic()
+        wait = None
+        for klass, queue in self.queues.items():
+            bucket = self.buckets[klass]
+            while queue:
+                delay = bucket.delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+                bucket.take()
+                self._send(queue.popleft())
+        if wait is not None:
+            self._timer_id = GLib.timeout_add(int(wait * 1000) + 1, self._timer_cb)
+
+    def _timer_cb(self):
+        self._timer_id = None
+        self._dispatch()
+        return False
+
+    def _send(self, request: ApiRequest):
+        request.result = request.send()
+        request.watch = self.api.watch_result(request.result, lambda r: self._done(request), request.timeout)
+
+    def _done(self, request: ApiRequest):
+        request.watch = None
+        bucket = self.buckets[request.klass]
+        seconds = get_flood_wait(request.result)
+        if seconds is not None:
+            logger.warning('Telegram API flood wait %ds for %s requests', seconds, request.klass)
+            bucket.flood(seconds, time.monotonic())
+            self.queues[request.klass].appendleft(request)
+            self._dispatch()
+            return
+        if request.result.ok_received:
+            bucket.success()
+        request.callback(request.result)
+
+
 class TelegramApi(GObject.Object):
     """ Main Telegram API wrapper for Rhythmbox integration """
     object = GObject.Property(type=GObject.Object)
@@ -106,6 +337,7 @@ class TelegramApi(GObject.Object):
     storage = None
 
     __instances = {}
+    __current = None
 
     @staticmethod
     def loaded():
@@ -133,9 +365,20 @@ class TelegramApi(GObject.Object):
         self.temp_dir = os.path.join(self.files_dir, 'files')
 
         self.chats = {}
-        self.chats_count = 0
+        self.chats_loaded = False       # Whether all chats were loaded in this session
+        self._chats_lock = threading.Lock()
+        self._chat_updates = {}         # Chats changed by the updates, waiting to be saved
         self.last_message_id = 0
         self.is_chat_updates_started = False
+        self.canceled_downloads = set()
+        self.limiter = RateLimiter(self)
+        self._link_requests = {}        # (chat_id, message_id) -> callbacks waiting for the link
+        self._messages_lock = threading.Lock()
+        self._message_updates = []      # (kind, chat_id, data) of the watched chats, waiting for the main loop
+        self._watched_chats = set()
+        self._message_listener = None
+        self._connection_ready = False
+        self.is_message_updates_started = False
 
         self.tg = TelegramClient(
             api_id=self.api_id,
@@ -167,6 +410,8 @@ class TelegramApi(GObject.Object):
             raise TelegramAuthStateError(self.state)
 
         self.storage = Storage(self, self.files_dir)
+        with self._chats_lock:
+            self.chats = {**self.storage.get_chats(), **self.chats}
         if self.state:
             self.start_chat_updates()
         else:
@@ -190,46 +435,213 @@ class TelegramApi(GObject.Object):
         if not self.is_chat_updates_started:
             self.is_chat_updates_started = True
             self.tg.add_update_handler('updateNewChat', self._update_new_chat_cb)
+            self.tg.add_update_handler('updateChatTitle', self._update_chat_title_cb)
 
     def stop_chat_updates(self):
         """ Stop chat updates listener """
         self.is_chat_updates_started = False
         self.tg.remove_update_handler('updateNewChat', self._update_new_chat_cb)
+        self.tg.remove_update_handler('updateChatTitle', self._update_chat_title_cb)
 
     def _update_new_chat_cb(self, update):
         """ Callback for handling new chat updates from Telegram """
         chat = update.get('chat', {})
-        chat_id = chat.get('id')
-        if chat_id:
-            self.chats[chat_id] = get_chat_info(chat)
-
-    def _chats_idle_cb(self, data):
-        """ Idle callback for loading chats asynchronously """
-        r = data.get('result')
-        if not r:
-            r = data['result'] = self.tg.call_method('loadChats', {'limit': 100})
-        if not r._ready.is_set():  # wait to load
-            return True
-
-        data['result'] = None
-        total = len(self.chats)
-
-        if self.chats_count == total:
-            self.chats_count = total
-            data['update'](self.chats)
+        if chat.get('id'):
+            self._set_chat(get_chat_info(chat))
+
+    def _update_chat_title_cb(self, update):
+        """ Callback for handling chat title updates from Telegram """
+        chat_id = update.get('chat_id')
+        with self._chats_lock:
+            chat = self.chats.get(chat_id)
+        if chat:
+            self._set_chat({**chat, 'title': update.get('title', '')})
+
+    def _set_chat(self, info):
+        """ Runs in the tdlib worker thread, the changed chats are saved by the main loop in one batch """
+        with self._chats_lock:
+            chat = self.chats.get(info['id'])
+            if chat:
+                info = {**chat, **info, 'last_message_id': max(chat.get('last_message_id', 0), info['last_message_id'])}
+                if info == chat:
+                    return
+            self.chats[info['id']] = info
+            schedule = not self._chat_updates
+            self._chat_updates[info['id']] = info
+        if schedule:
+            GLib.idle_add(self._save_chats_cb)
+
+    def _save_chats_cb(self):
+        with self._chats_lock:
+            chats, self._chat_updates = self._chat_updates, {}
+        if self.storage:
+            self.storage.save_chats(chats.values())
+        return False
+
+    ############################################################
+    # Message updates
+    ############################################################
+    def watch_messages(self, chat_ids, listener):
+        """
+        Push new, edited and deleted messages of the chats to the listener on the main loop.
+        The listener implements messages_added, audio_changed, messages_deleted and resync
+        """
+        with self._messages_lock:
+            self._watched_chats = set(chat_ids)
+            self._message_listener = listener
+        if not self.is_message_updates_started:
+            self.is_message_updates_started = True
+            self.tg.add_update_handler('updateNewMessage', self._update_new_message_cb)
+            self.tg.add_update_handler('updateMessageContent', self._update_message_content_cb)
+            self.tg.add_update_handler('updateDeleteMessages', self._update_delete_messages_cb)
+            self.tg.add_update_handler('updateConnectionState', self._update_connection_state_cb)
+
+    def unwatch_messages(self):
+        """ Stop message updates listener """
+        if self.is_message_updates_started:
+            self.is_message_updates_started = False
+            self.tg.remove_update_handler('updateNewMessage', self._update_new_message_cb)
+            self.tg.remove_update_handler('updateMessageContent', self._update_message_content_cb)
+            self.tg.remove_update_handler('updateDeleteMessages', self._update_delete_messages_cb)
+            self.tg.remove_update_handler('updateConnectionState', self._update_connection_state_cb)
+        with self._messages_lock:
+            self._watched_chats = set()
+            self._message_listener = None
+            self._message_updates = []
+
+    def _update_new_message_cb(self, update):
+        """ Callback for new messages, skips the messages being sent """
+        message = update.get('message', {})
+        if not message.get('sending_state'):
+            self._push_message_update('new', message.get('chat_id'), message)
+
+    def _update_message_content_cb(self, update):
+        """ Callback for edited message content """
+        self._push_message_update('content', update.get('chat_id'), update)
+
+    def _update_delete_messages_cb(self, update):
+        """ Callback for deleted messages, messages only dropped from the TDLib cache are ignored """
+        if update.get('is_permanent') and not update.get('from_cache'):
+            self._push_message_update('delete', update.get('chat_id'), update)
+
+    def _update_connection_state_cb(self, update):
+        """ Updates may be missed while the connection is lost, the listener re-reads the chats on reconnect """
+        ready = update.get('state', {}).get('@type') == 'connectionStateReady'
+        reconnected = ready and not self._connection_ready
+        self._connection_ready = ready
+        if reconnected:
+            GLib.idle_add(self._resync_cb)
+
+    def _push_message_update(self, kind, chat_id, data):
+        """ Runs in the tdlib worker thread, the updates are handled by the main loop in one batch """
+        with self._messages_lock:
+            if chat_id not in self._watched_chats:
+                return
+            schedule = not self._message_updates
+            self._message_updates.append((kind, chat_id, data))
+        if schedule:
+            GLib.idle_add(self._message_updates_cb)
+
+    def _resync_cb(self):
+        listener = self._message_listener
+        if listener:
+            listener.resync()
+        return False
+
+    def _message_updates_cb(self):
+        with self._messages_lock:
+            updates, self._message_updates = self._message_updates, []
+            listener = self._message_listener
+        if not listener or not self.storage:
             return False
+        new_messages = []
+        for kind, chat_id, data in updates:
+            if kind != 'new' and new_messages:
+                # keep the order of the updates of the same message
+                self._add_new_messages(listener, new_messages)
+                new_messages = []
+            if kind == 'new':
+                new_messages.append(data)
+            elif kind == 'content':
+                self._change_message_content(listener, chat_id, data['message_id'], data.get('new_content', {}))
+            elif kind == 'delete':
+                listener.messages_deleted(chat_id, self.storage.remove_audios(chat_id, data.get('message_ids', [])))
+        if new_messages:
+            self._add_new_messages(listener, new_messages)
+        return False
+
+    def _add_new_messages(self, listener, messages):
+        """ Store audio of the new messages in one batch and pass them to the listener by chat """
+        audio_msgs = [data for data in messages
+                      if is_msg_valid(data) and get_content_type(data) == MessageType.AUDIO]
+        audios = self.storage.add_audios(audio_msgs)
+        chats = {}
+        for data in messages:
+            chats.setdefault(data['chat_id'], ([], []))[0].append(data['id'])
+        for audio in audios:
+            chats[audio.chat_id][1].append(audio)
+        for chat_id, (message_ids, chat_audios) in chats.items():
+            listener.messages_added(chat_id, message_ids, chat_audios)
+
+    def _change_message_content(self, listener, chat_id, message_id, content):
+        """ Update stored audio from the edited content, a message edited into audio is loaded as a new one """
+        audio = self.storage.update_audio_content(chat_id, message_id, content)
+        if audio:
+            listener.audio_changed(audio)
+        elif content.get('@type') == 'messageAudio':
+            def loaded_cb(r):
+                if r.ok_received and r.update and is_msg_valid(r.update):
+                    self._add_new_messages(listener, [r.update])
+            self.request('message', lambda: self.tg.get_message(chat_id, message_id), loaded_cb)
+
+    def watch_result(self, result: AsyncResult, callback, timeout=REQUEST_TIMEOUT) -> ResultWatch:
+        """ Call back on the main loop once the request is completed or timed out """
+        return ResultWatch(self.tg, result, callback, timeout)
+
+    def request(self, klass, send, callback, timeout=REQUEST_TIMEOUT) -> ApiRequest:
+        """
+        Send the request once the budget of the method class allows, then call back on the main loop
+        with the result. `send` makes the TDLib call and returns its AsyncResult
+        """
+        request = ApiRequest(self.limiter, klass, send, callback, timeout)
+        self.limiter.submit(request)
+        return request
+
+    def _load_chats(self, data):
+        """ Request the next chats page, repeated until no new chats are received """
+        self.request('chats', lambda: self.tg.call_method('loadChats', {'limit': 100}),
+                     lambda r: self._chats_idle_cb(data, r))
+
+    def _chats_idle_cb(self, data, r):
+        """ Main loop callback for loading chats asynchronously """
+        if r.ok_received:
+            self._load_chats(data)
+            return
 
-        self.chats_count = total
-        return True
+        # loadChats fails with 404 once all chats are loaded
+        self.chats_loaded = r.error and (r.error_info or {}).get('code') == 404
+        with self._chats_lock:
+            chats = dict(self.chats)
+        if chats != data['chats']:
+            data['update'](chats)
 
     def reset_chats(self):
         """ Clear cached chats data """
-        self.chats_count = 0
-        self.chats = {}
+        with self._chats_lock:
+            self.chats_loaded = False
+            self.chats = {}
 
     def get_chats_idle(self, update):
-        """ Load chats asynchronously """
-        Gdk.threads_add_idle(0, self._chats_idle_cb, {'update': update})
+        """
+        Load chats asynchronously. The cached chats are passed to `update` at once,
+        then chats are loaded in the background and `update` is called again if they changed
+        """
+        with self._chats_lock:
+            chats = dict(self.chats)
+        if chats:
+            update(chats)
+        if not self.chats_loaded:
+            self._load_chats({'update': update, 'chats': chats})
 
     ############################################################
     # Managing messages
@@ -245,31 +657,24 @@ class TelegramApi(GObject.Object):
             "on_success": on_success,
             "on_error": on_error,
         }
-        Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, self._load_pinned_messages_idle_cb, blob)
-
-    def _load_pinned_messages_idle_cb(self, blob):
-        """ Load pinned messages IDLE callback """
-        r = blob.get('result', None)
-
-        if not r:
-            r = blob['result'] = self.tg.call_method(
-                'searchChatMessages',
-                params={
-                    'chat_id': blob.get('chat_id'),
-                    "query": "",
-                    "from_message_id": blob.get('from_message_id', 0),
-                    "offset": blob.get('offset', 0),
-                    "limit": blob.get('limit', 100),
-                    "filter": { "@type": "searchMessagesFilterPinned" }
-                }
-            )
-
-        if not r._ready.is_set():
-            return True
+        send = lambda: self.tg.call_method(
+            'searchChatMessages',
+            params={
+                'chat_id': chat_id,
+                "query": "",
+                "from_message_id": from_message_id,
+                "offset": offset,
+                "limit": limit,
+                "filter": { "@type": "searchMessagesFilterPinned" }
+            }
+        )
+        return self.request('history', send, lambda r: self._load_pinned_messages_idle_cb(blob, r))
 
+    def _load_pinned_messages_idle_cb(self, blob, r):
+        """ Load pinned messages completion callback """
+        blob['result'] = r
         msgs = r.update.get('messages', []) if r.update else []
         blob['on_success'](msgs)
-        return False
 
     def load_message_idle(self, chat_id, message_id, on_success=empty_cb, on_error=empty_cb):
         """ Load single message asynchronously """
@@ -279,12 +684,17 @@ class TelegramApi(GObject.Object):
             "message_id": message_id,
             "on_success": on_success,
             "on_error": on_error,
-            "result": self.tg.get_message(chat_id, message_id)
         }
-        Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, _wait_cb, blob)
+        return self.request('message', lambda: self.tg.get_message(chat_id, message_id),
+                            lambda r: _wait_cb({**blob, 'result': r}))
 
-    def load_messages_idle(self, chat_id, update=None, each=None, on_success=None, blob=None, limit=100, offset=0):
-        """ Load multiple messages asynchronously """
+    def load_messages_idle(self, chat_id, update=None, each=None, on_success=None, blob=None, limit=100, offset=0,
+                           audio_only=False, on_error=None):
+        """
+        Load multiple messages asynchronously. With `audio_only` the history is searched
+        for audio messages, so pages contain no photos, texts and documents.
+        A request which timed out calls on_error(blob)
+        """
         blob = {
             **(blob if blob else {}),
             "limit": limit,
@@ -292,31 +702,37 @@ class TelegramApi(GObject.Object):
             "chat_id": chat_id,
             "update": update if update else empty_cb,
             "each": each if each else empty_cb,
-            "on_success": on_success if on_success else empty_cb
+            "on_success": on_success if on_success else empty_cb,
+            "on_error": on_error if on_error else empty_cb,
         }
-        Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, self._load_messages_idle_cb, blob)
+        if audio_only:
+            send = lambda: self.tg.call_method('searchChatMessages', {
+                'chat_id': chat_id,
+                'query': '',
+                'from_message_id': blob.get('offset_msg_id', 0),
+                'offset': offset,
+                'limit': limit,
+                'filter': {'@type': 'searchMessagesFilterAudio'},
+            })
+        else:
+            send = lambda: self.tg.get_chat_history(chat_id=chat_id, limit=limit,
+                from_message_id=blob.get('offset_msg_id', 0), offset=offset)
+        return self.request('history', send, lambda r: self._load_messages_idle_cb(blob, r))
 
-    def _load_messages_idle_cb(self, blob):
-        """ Idle callback for loading messages asynchronously """
-        offset_msg_id = blob.get('offset_msg_id', 0)
+    def _load_messages_idle_cb(self, blob, r):
+        """ Completion callback for loading messages asynchronously """
         last_msg_id = blob.get('last_msg_id', 0)
-        limit = blob.get('limit', 100)
-        offset = blob.get('offset', 0)
-        r = blob.get('result', None)
+        blob['result'] = r
 
-        if not r:
-            r = self.tg.get_chat_history(chat_id=blob.get('chat_id'), limit=limit,
-                from_message_id=offset_msg_id, offset=offset)
-            blob['result'] = r
-            return True
-
-        if not r._ready.is_set():
-            return True
+        if not r._ready.is_set():  # timed out, the history is not read to the end
+            logger.warning('tg, load messages: request timed out, chat %s', blob.get('chat_id'))
+            blob['on_error'](blob)
+            return
 
         if not r.update or not r.update['total_count'] or not r.update['messages']:
             logger.debug('tg, load messages: No messages found, exit loop')
             blob['on_success'](blob, API_ALL_MESSAGES_LOADED)
-            return False
+            return
 
         msgs = r.update.get('messages', [])
         blob['last_msg_id'] = msgs[-1]['id']
@@ -324,16 +740,18 @@ class TelegramApi(GObject.Object):
         if blob['last_msg_id'] == LAST_MESSAGE_ID:
             logger.debug('tg, load messages: No messages found, exit loop')
             blob['on_success'](blob, API_ALL_MESSAGES_LOADED)
-            return False
+            return
 
+        cmd = API_PAGE_LOADED
+        audio_msgs = []
         for data in msgs:
             if is_msg_valid(data):
                 msg_type = get_content_type(data)
                 current_msg_id = data['id']
 
                 if last_msg_id == current_msg_id:
-                    blob['on_success'](blob, API_END_OF_SEGMENT)
-                    return False
+                    cmd = API_END_OF_SEGMENT
+                    break
 
                 ret = blob['each'](data, blob)
                 if type(ret) is bool and not ret:
@@ -341,22 +759,54 @@ class TelegramApi(GObject.Object):
 
                 if msg_type == MessageType.AUDIO:
                     logger.debug('Detect audio file')
-                    audio = self.storage.add_audio(data)
-                    blob['update'](audio, blob) if audio else None
+                    audio_msgs.append(data)
 
-        blob['on_success'](blob, API_PAGE_LOADED)
-        return False
+        # write the whole page in one batch
+        for audio in self.storage.add_audios(audio_msgs):
+            blob['update'](audio, blob)
 
-    def get_message_link(self, chat_id, message_id):
-        """ Get shareable link for a message """
-        r = self.tg.call_method('getMessageLink', {
-            'chat_id': int(chat_id),
-            'message_id': int(message_id),
+        blob['on_success'](blob, cmd)
+
+    def get_message_link_idle(self, chat_id, message_id, on_success=empty_cb, on_error=empty_cb):
+        """ Get shareable link for a message, from the storage cache or asynchronously """
+        chat_id, message_id = int(chat_id), int(message_id)
+        link = self.storage.get_message_links(chat_id, (message_id,)).get(message_id)
+        if link:
+            on_success(link)
+            return
+        key = (chat_id, message_id)
+        callbacks = self._link_requests.get(key)
+        if callbacks is not None:
+            callbacks.append((on_success, on_error))
+            return
+        self._link_requests[key] = [(on_success, on_error)]
+        send = lambda: self.tg.call_method('getMessageLink', {
+            'chat_id': chat_id,
+            'message_id': message_id,
             "for_album": False,
             "for_group": False
         })
-        r.wait()
-        return r.update.get('link') if r.update else None
+        self.request('message', send, lambda r: self._message_link_cb(key, r))
+
+    def _message_link_cb(self, key, r):
+        """ Completion callback of getMessageLink, caches the link """
+        link = r.update.get('link') if r.ok_received and r.update else None
+        if link:
+            self.storage.save_message_link(*key, link)
+        else:
+            logger.debug('Unable to get link of message %s: %s', key, format_error(r))
+        for on_success, on_error in self._link_requests.pop(key, ()):
+            if link:
+                on_success(link)
+            else:
+                on_error()
+
+    def prefetch_message_links(self, chat_id, message_ids):
+        """ Request links of the messages which are not cached yet """
+        cached = self.storage.get_message_links(chat_id, message_ids)
+        for message_id in message_ids:
+            if message_id not in cached:
+                self.get_message_link_idle(chat_id, message_id)
 
     def get_message_direct_link(self, link):
         """ Convert public link to direct Telegram URI """
@@ -374,8 +824,13 @@ class TelegramApi(GObject.Object):
     ############################################################
     # Managing files
     ############################################################
-    def download_audio_idle(self, chat_id, message_id, priority=1, on_success=empty_cb, on_error=empty_cb):
-        """ Download audio message asynchronously """
+    def download_audio_idle(self, chat_id, message_id, priority=1, on_success=empty_cb, on_error=empty_cb,
+                            on_file=empty_cb, on_cancel=None):
+        """
+        Download audio message asynchronously, on_file(file_id) is called with the TDLib file id
+        of the audio once the download request is queued. A download stopped by cancel_download
+        calls on_cancel, or on_error if it is not given
+        """
         def download(data, *arg):
             if not data:
                 on_error()
@@ -383,62 +838,149 @@ class TelegramApi(GObject.Object):
             update = {'data': data}
 
             def set_file(file, *arg):
+                local = file.get('local', {})
+                if not local.get('is_downloading_completed'):
+                    if not local.get('is_downloading_active'):
+                        # stopped without cancel_download, nothing to wait for
+                        cb(on_cancel or on_error)()
+                        return
+                    # interrupted by a downloadFile request with another offset of the stream proxy,
+                    # keep waiting without moving the offset back
+                    self.download_file_idle(file['id'], priority=priority, offset=local.get('download_offset', 0),
+                                            on_success=set_file, on_error=on_error, on_cancel=on_cancel)
+                    return
                 update['data']['content']['audio']['audio'] = file
                 on_success(self.storage.add_audio(update['data'], convert=False))
-            self._download_audio_idle_cb(data, priority=priority, on_success=set_file, on_error=on_error)
+            self._download_audio_idle_cb(data, priority=priority, on_success=set_file, on_error=on_error,
+                                         on_file=on_file, on_cancel=on_cancel)
 
         self.load_message_idle(chat_id, message_id, on_success=download, on_error=on_error)
 
-    def _download_audio_idle_cb(self, data, priority=1, on_success=empty_cb, on_error=empty_cb):
+    def _download_audio_idle_cb(self, data, priority=1, on_success=empty_cb, on_error=empty_cb, on_file=empty_cb,
+                                on_cancel=None):
         """ Idle callback for downloading audio files from Telegram """
+        file = self._get_audio_file(data)
+        if not file:
+            on_error()
+            return
+
+        self.download_file_idle(file['id'], priority=priority, on_success=on_success, on_error=on_error,
+                                on_cancel=on_cancel)
+        on_file(file['id'])
+
+    def get_audio_file_idle(self, chat_id, message_id, on_success=empty_cb, on_error=empty_cb):
+        """ Get the TDLib file of an audio message asynchronously, without downloading it """
+        def loaded(data, *arg):
+            file = self._get_audio_file(data) if data else None
+            if file:
+                on_success(file)
+            else:
+                on_error()
+
+        self.load_message_idle(chat_id, message_id, on_success=loaded, on_error=on_error)
+
+    @staticmethod
+    def _get_audio_file(data):
+        """ Get the file of an audio message, None if the message has no audio or it is not uploaded """
         content = data.get('content', {})
         audio = content.get('audio')
 
         if not (audio and audio_content_set <= set(audio)):
             logger.warning('Audio message has no required keys, skipping...')
             logger.debug(content)
-            on_error()
-            return
-
-        completed = audio['audio']['remote']['is_uploading_completed']
-        audio_id = audio['audio']['id']
+            return None
 
-        if not completed:
-            logger.warning('Audio message: %d not uploaded, skipping...', audio_id)
-            on_error()
-            return
+        if not audio['audio']['remote']['is_uploading_completed']:
+            logger.warning('Audio message: %d not uploaded, skipping...', audio['audio']['id'])
+            return None
 
-        self.download_file_idle(audio_id, priority=priority, on_success=on_success, on_error=on_error)
+        return audio['audio']
 
-    def download_file_idle(self, file_id, priority=1, on_success=empty_cb, on_error=empty_cb):
-        """ Download any file asynchronously """
+    def download_file_idle(self, file_id, priority=1, offset=0, on_success=empty_cb, on_error=empty_cb,
+                           on_cancel=None):
+        """ Download any file asynchronously, a download stopped by cancel_download calls on_cancel or on_error """
         logger.debug('download_file_idle')
+        # synchronous downloads of large files can take long, so no timeout here
         blob = {
-            "result": self.tg.call_method('downloadFile', {
-                'file_id': file_id,
-                'priority': priority,
-                # 'synchronous': False
-                'synchronous': True
-            }),
             "on_success": on_success if on_success else empty_cb,
             "on_error": on_error if on_error else empty_cb,
+            "on_cancel": on_cancel if on_cancel else on_error,
         }
-        Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, _wait_cb, blob)
+        send = lambda: self.tg.call_method('downloadFile', {
+            'file_id': file_id,
+            'priority': priority,
+            'offset': offset,
+            # 'synchronous': False
+            'synchronous': True
+        })
+
+        def wait_cb(r):
+            blob['result'] = r
+            if file_id in self.canceled_downloads:
+                # canceled on purpose, nothing to report, whatever TDLib answered
+                self.canceled_downloads.discard(file_id)
+                cb(blob['on_cancel'])()
+                return
+            if not r.ok_received and r.error:
+                # a downloadFile request with another offset, sent by the stream proxy on seek,
+                # ends the synchronous request with an error while the download goes on
+                self._resume_download(file_id, priority, blob)
+                return
+            _wait_cb(blob)
+        return self.request('download', send, wait_cb, timeout=None)
+
+    def _resume_download(self, file_id, priority, blob):
+        """ Keeps waiting for a download whose synchronous request was interrupted, reports the error otherwise """
+        def file_cb(r):
+            local = r.update.get('local', {}) if r.ok_received and r.update else {}
+            if file_id in self.canceled_downloads:
+                self.canceled_downloads.discard(file_id)
+                cb(blob['on_cancel'])()
+            elif local.get('is_downloading_completed'):
+                blob['on_success'](r.update)
+            elif local.get('is_downloading_active'):
+                logger.debug('Download of file %d interrupted at %d, waiting again', file_id,
+                             local.get('download_offset', 0))
+                self.download_file_idle(file_id, priority=priority, offset=local.get('download_offset', 0),
+                                        on_success=blob['on_success'], on_error=blob['on_error'],
+                                        on_cancel=blob['on_cancel'])
+            else:
+                _wait_cb(blob)
+        # getFile is answered from the local file state, no need to queue it
+        self.watch_result(self.tg.call_method('getFile', {'file_id': file_id}), file_cb)
+
+    def set_download_priority(self, file_id, priority):
+        """ Changes the priority of a file download which is already in progress """
+        # an asynchronous downloadFile request for an active download only updates its priority,
+        # it is queued after the download request itself, so it is never sent before it
+        self.request('download', lambda: self.tg.call_method('downloadFile', {
+            'file_id': file_id,
+            'priority': priority,
+            'synchronous': False
+        }), empty_cb)
+
+    def cancel_download(self, file_id):
+        """ Stops a file download, the already downloaded part of the file is kept by TDLib """
+        self.canceled_downloads.add(file_id)
+        self.request('download', lambda: self.tg.call_method('cancelDownloadFile', {
+            'file_id': file_id,
+            'only_if_pending': False
+        }), empty_cb)
 
 
 def _wait_cb(blob):
-    """ Callback handler for async operations """
+    """ Completion handler for async operations """
     r = blob.get('result', None)
     if not r.ok_received and r.error:
         show_error(_('Error: Telegram API request failed'), format_error(r))
         cb(blob.get('on_error'))()
-        return False
+        return
 
-    if not r._ready.is_set():
-        return True
+    if not r._ready.is_set():  # timed out
+        cb(blob.get('on_error'))()
+        return
 
     blob.get('on_success')(r.update)
-    return False
 
 def format_error(r: AsyncResult) -> str | None:
     """ Format Telegram API error message """
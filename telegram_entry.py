@@ -17,8 +17,10 @@
 from gi.repository import RB, GObject
 from storage import Audio
 from account import KEY_PRELOAD_PREV_TRACK, KEY_PRELOAD_NEXT_TRACK, KEY_PRELOAD_HIDDEN_TRACK
-from account import KEY_PRELOAD_MAX_FILE_SIZE, KEY_PRELOAD_FILE_FORMATS, AUDIO_FORMAT_ALL
+from account import KEY_PRELOAD_MAX_FILE_SIZE, KEY_PRELOAD_FILE_FORMATS, AUDIO_FORMAT_ALL, KEY_STREAM_PLAYBACK
 from common import file_uri, get_location_data, get_entry_state, idle_add_once
+from loader import TEMP_PRIORITY_PLAYING, TEMP_PRIORITY_NEXT, TEMP_PRIORITY_PREV
+from stream_proxy import StreamProxy
 
 
 class TelegramEntryType(RB.RhythmDBEntryType):
@@ -123,9 +125,25 @@ class TelegramEntryType(RB.RhythmDBEntryType):
             iter = entry_view.iter_next(iter)
         return None
 
-    def _load_entry_audio(self, entry):
+    def _load_entry_audio(self, entry, priority=TEMP_PRIORITY_PLAYING):
         """ Loads the audio for the given entry. """
-        self.plugin.loader.add_entry(entry).start()
+        self.plugin.loader.add_entry(entry, priority).start()
+
+    def _get_stream_uri(self, audio, location):
+        """ Starts streaming of the audio while it is being downloaded, returns the uri for the player """
+        proxy = self.plugin.stream_proxy
+        if proxy and proxy.api is not self.plugin.api:
+            proxy.stop()
+            proxy = None
+        if not proxy:
+            self.plugin.stream_proxy = proxy = StreamProxy(self.plugin.api).start()
+        return proxy.open(audio, lambda: self._on_stream_completed(location))
+
+    def _on_stream_completed(self, location):
+        """ Hands the completely downloaded stream file over to the loader, which updates the entry """
+        entry = self.plugin.db.entry_lookup_by_location(location)
+        if entry:
+            self._load_entry_audio(entry)
 
     def _is_preload_enabled_for_audio(self, audio):
         """ Determine whether preloading should be enabled for a given audio """
@@ -162,9 +180,8 @@ class TelegramEntryType(RB.RhythmDBEntryType):
 
                 if prev_audio and not prev_audio.is_file_exists():
                     if self._is_preload_enabled_for_audio(prev_audio):
-                        idle_add_once(self._load_entry_audio, prev_entry)
+                        idle_add_once(self._load_entry_audio, prev_entry, TEMP_PRIORITY_PREV)
 
-        # The preloader loads first what was sent last
         if self.plugin.account.settings[KEY_PRELOAD_NEXT_TRACK]:
             next_entry = self.get_next_entry(entry)
             if next_entry and (preload_hidden or get_entry_state(next_entry) != Audio.STATE_HIDDEN):
@@ -172,12 +189,20 @@ class TelegramEntryType(RB.RhythmDBEntryType):
 
                 if next_audio and not next_audio.is_file_exists():
                     if self._is_preload_enabled_for_audio(next_audio):
-                        idle_add_once(self._load_entry_audio, next_entry)
+                        idle_add_once(self._load_entry_audio, next_entry, TEMP_PRIORITY_NEXT)
 
         if audio.is_file_exists():
             self._pending_playback = None
+            if not audio.is_moved:
+                self.plugin.temp_cache.touch(audio)
             return file_uri(audio.local_path)
 
+        if self.plugin.account.settings[KEY_STREAM_PLAYBACK]:
+            stream_uri = self._get_stream_uri(audio, location)
+            if stream_uri:
+                self._pending_playback = None
+                return stream_uri
+
         return_uri = None
 
         playing_entry = self.shell.props.shell_player.get_playing_entry()
@@ -273,20 +273,8 @@ class TelegramSearchSource(TelegramSource):
         self.hash_append = base64.b64encode(b).decode('ascii')
 
         if self.plugin.storage and len(self.search_query) >= 3:
-            cursor = self.plugin.storage.db.cursor()
-            if search_column == 'artist':
-                sql = 'SELECT * FROM `audio` WHERE artist LIKE ?'
-                cursor.execute(sql, (f'%{self.search_query}%',))
-            elif search_column == 'title':
-                sql = 'SELECT * FROM `audio` WHERE title LIKE ?'
-                cursor.execute(sql, (f'%{self.search_query}%',))
-            else:
-                sql = 'SELECT * FROM `audio` WHERE artist LIKE ? or title LIKE ?'
-                cursor.execute(sql, (f'%{self.search_query}%',f'%{self.search_query}%',))
-
-            for row in cursor:
-                self.add_entry(Audio(row))
-            cursor.close()
+            for audio in self.plugin.storage.search_audio(self.search_query, search_column):
+                self.add_entry(audio)
 
     def add_entry(self, audio: Audio):
         """ Adds a single audio entry to the source """
@@ -18,10 +18,9 @@ import rb # type: ignore
 import math
 from gi.repository import RB # type: ignore
 from gi.repository import GObject, Gtk, Gio, Gdk, GLib
-from common import to_location, get_location_data, SingletonMeta, get_first_artist, pretty_file_size, idle_add_once
-from common import file_uri, set_entry_state, is_telegram_source
+from common import to_location, get_location_data, SingletonMeta, get_first_artist, pretty_file_size
+from common import file_uri, set_entry_state, is_telegram_source, IdleTask
 from columns import StateColumn, SizeColumn, FormatColumn, TopPicksColumn, InLibraryColumn
-from loader import PlaylistLoader
 from storage import Audio, VISIBILITY_ALL, VISIBILITY_VISIBLE
 from account import KEY_RATING_COLUMN, KEY_DATE_ADDED_COLUMN, KEY_FILE_SIZE_COLUMN, KEY_AUDIO_FORMAT_COLUMN
 from account import KEY_TOP_PICKS_COLUMN, KEY_IN_LIBRARY_COLUMN, KEY_DISPLAY_AUDIO_FORMATS, AUDIO_FORMAT_ALL
@@ -31,6 +30,9 @@ import gettext
 gettext.install('rhythmbox', RB.locale_dir())
 _ = gettext.gettext
 
+LINK_PREFETCH_DELAY = 300   # ms the selection has to stay unchanged before its links are prefetched
+LINK_PREFETCH_LIMIT = 20    # max selected entries whose links are prefetched
+
 
 class BlinkingIndicator(Gtk.DrawingArea):
     def __init__(self, color=(0.0, 0.5, 1.0), size=20, radius=5, speed=0.05):
@@ -393,7 +395,11 @@ class TelegramSource(RB.BrowserSource):
         self.bar_ui = None
         self.has_reached_end = False
         self.entry_updated_id = None
-        self.loaded_entries = []
+        self.selection_changed_id = None
+        self.prefetch_timer_id = None
+        self.loaded_entries = set()
+        self.entries_task: Optional[IdleTask] = None
+        self.entries_total = 0
         self.custom_model = {}
         self.state_column = None
         self.display_formats = ()
@@ -443,6 +449,7 @@ class TelegramSource(RB.BrowserSource):
             return
         if self.visibility in (VISIBILITY_VISIBLE, VISIBILITY_ALL):
             self.refresh_btn.activate()
+            self.loader = self.plugin.sync.add(self)
         self.activated = True
         self.entry_updated_id = self.db.connect('entry-changed', self.on_entry_changed)
         self.props.entry_type.activate()
@@ -451,8 +458,10 @@ class TelegramSource(RB.BrowserSource):
         """ Deactivate the TelegramSource """
         if self.activated:
             self.activated = False
+            if self.entries_task is not None:
+                self.entries_task.cancel()
             if self.loader is not None:
-                self.loader.stop()
+                self.plugin.sync.remove(self.loader)
             self.loader = None
             self.db.disconnect(self.entry_updated_id)
             self.props.entry_type.deactivate()
@@ -509,55 +518,117 @@ class TelegramSource(RB.BrowserSource):
     def do_deselected(self):
         """
         Handles actions when the source is deselected, such as deactivating the download bar
-        and stopping the loader.
+        and moving the loader to the background.
         """
         self.bar.deactivate()
         self.alt_toolbar.deactivate()
         self.state_column.deactivate()
-        if self.loader is not None:
-            self.loader.stop()
-            self.loader = None
+        if self.selection_changed_id:
+            self.get_entry_view().disconnect(self.selection_changed_id)
+            self.selection_changed_id = None
+        if self.prefetch_timer_id:
+            GLib.source_remove(self.prefetch_timer_id)
+            self.prefetch_timer_id = None
+        if self.entries_task is not None:
+            # resumed on the next selection
+            self.entries_task.cancel()
+        if self.loader is not None and self.plugin.sync.is_visible(self.loader):
+            # keeps syncing in the background
+            self.plugin.sync.set_visible(None)
         self.plugin.remove_plugin_menu()
 
     def do_selected(self):
         """
         Handles actions when the source is selected, such as activating the download bar,
-        initializing the loader, and adding entries.
+        prioritizing the loader, and adding entries.
         """
         self.plugin.source = self
         self.state_column.activate()
+        self.selection_changed_id = self.get_entry_view().connect('selection-changed', self._selection_changed_cb)
         self.get_entry_view().set_sorting_order("FirstSeen", Gtk.SortType.DESCENDING)
         self.bar = DownloadBar(self.plugin)
         self.bar.activate(self)
 
         if not self.initialised:
             self.initialised = True
-            idle_add_once(self.add_entries)
+            self.add_entries()
+        elif self.entries_task is not None:
+            self.entries_task.start()
 
         self.plugin.add_plugin_menu()
         self.alt_toolbar.activate()
 
-        if self.visibility in (VISIBILITY_VISIBLE, VISIBILITY_ALL):
-            if self.loader is not None:
-                self.loader.stop()
-            self.loader = PlaylistLoader(self, self.chat_id, self.add_entry)
-            self.loader.start()
+        if self.loader is not None:
+            self.plugin.sync.set_visible(self.loader)
 
     def add_entries(self):
-        """ Loads and adds entries from the plugin's storage to the source """
-        if self.plugin.storage:
-            self.plugin.storage.load_entries(self.chat_id, self.add_entry, self.visibility)
-
-    def add_entry(self, audio: Audio):
+        """
+        Streams entries from the plugin's storage to the source in idle chunks,
+        newest first, so the first tracks appear without blocking the main loop
+        """
+        if not self.plugin.storage:
+            return
+        if self.entries_task is not None:
+            self.entries_task.cancel()
+        self.entries_total = self.plugin.storage.count_entries(self.chat_id, self.visibility)
+        entries = self.plugin.storage.load_entries(self.chat_id, self.visibility)
+        self.entries_task = IdleTask(entries, lambda audio: self.add_entry(audio, commit=False),
+                                     on_tick=self._add_entries_tick, on_done=self._add_entries_done)
+        self.props.load_status = RB.SourceLoadStatus.LOADING
+        self.entries_task.start()
+
+    def _add_entries_tick(self, task):
+        """ Commits entries added in the idle chunk and updates loading progress """
+        self.db.commit()
+        self.notify_status_changed()
+
+    def _add_entries_done(self, task):
+        self.entries_task = None
+        self.props.load_status = RB.SourceLoadStatus.LOADED
+        self.notify_status_changed()
+
+    def do_get_status(self, status, progress_text, progress):
+        """ Reports progress while entries are streamed from the storage """
+        if self.entries_task is not None and self.entries_total:
+            count = self.entries_task.count
+            return (_('Loading tracks'), '%s / %s' % (count, self.entries_total),
+                    min(1.0, count / self.entries_total))
+        return RB.BrowserSource.do_get_status(self, status, progress_text, progress)
+
+    def add_entry(self, audio: Audio, commit=True):
         """ Adds a single audio entry to the source if it hasn't been loaded already """
         if audio.id not in self.loaded_entries and any(k in self.display_formats for k in (AUDIO_FORMAT_ALL, audio.get_file_ext())):
-            self.loaded_entries.append(audio.id)
+            self.loaded_entries.add(audio.id)
             location = to_location(self.plugin.api.hash, audio.chat_id, audio.message_id, audio.id)
             self.custom_model["%s" % audio.id] = [pretty_file_size(audio.size, 1), audio.get_file_ext(), audio.created_at]
             entry = self.db.entry_lookup_by_location(location)
             if not entry:
                 entry = RB.RhythmDBEntry.new(self.db, self.entry_type, location)
-                audio.update_entry(entry, self.db)
+                # queued for the library by the previous session
+                loading = self.plugin.downloader.has_job(location)
+                if loading:
+                    set_entry_state(self.db, entry, Audio.STATE_LOADING)
+                audio.update_entry(entry, self.db, commit=commit, state=not loading)
+
+    def refresh_entry(self, audio: Audio):
+        """ Updates the entry of the edited audio """
+        location = to_location(self.plugin.api.hash, audio.chat_id, audio.message_id, audio.id)
+        entry = self.db.entry_lookup_by_location(location)
+        if entry:
+            idx = "%s" % audio.id
+            if idx in self.custom_model:
+                self.custom_model[idx] = [pretty_file_size(audio.size, 1), audio.get_file_ext(), audio.created_at]
+            audio.update_entry(entry, self.db)
+
+    def delete_entries(self, audios):
+        """ Deletes the entries of the audio removed from Telegram """
+        for audio in audios:
+            location = to_location(self.plugin.api.hash, audio.chat_id, audio.message_id, audio.id)
+            entry = self.db.entry_lookup_by_location(location)
+            if entry:
+                self.db.entry_delete(entry)
+            self.loaded_entries.discard(audio.id)
+        self.db.commit()
 
     def get_custom_model(self, idx):
         """ Returns the custom model data for the specified index """
@@ -614,16 +685,33 @@ class TelegramSource(RB.BrowserSource):
         entry = entries[0]
         location = entry.get_string(RB.RhythmDBPropType.LOCATION)
         chat_id, message_id = get_location_data(location)
-        audio = Audio({"chat_id": chat_id, "message_id": message_id})
-        link = audio.get_link()
-        direct_link = self.plugin.api.get_message_direct_link(link)
-        if direct_link:
-            try:
-                Gtk.show_uri(screen, direct_link, Gdk.CURRENT_TIME)
-            except GLib.Error:
+
+        def show_link(link):
+            direct_link = self.plugin.api.get_message_direct_link(link)
+            if direct_link:
+                try:
+                    Gtk.show_uri(screen, direct_link, Gdk.CURRENT_TIME)
+                except GLib.Error:
+                    Gtk.show_uri(screen, link, Gdk.CURRENT_TIME)
+            elif link:
                 Gtk.show_uri(screen, link, Gdk.CURRENT_TIME)
-        elif link:
-            Gtk.show_uri(screen, link, Gdk.CURRENT_TIME)
+
+        audio = Audio({"chat_id": chat_id, "message_id": message_id})
+        audio.get_link(show_link)
+
+    def _selection_changed_cb(self, *obj):
+        """ Prefetch links of the selected entries, once the selection settles """
+        if self.prefetch_timer_id:
+            GLib.source_remove(self.prefetch_timer_id)
+        self.prefetch_timer_id = GLib.timeout_add(LINK_PREFETCH_DELAY, self._prefetch_links)
+
+    def _prefetch_links(self):
+        self.prefetch_timer_id = None
+        entries = self.get_entry_view().get_selected_entries()[:LINK_PREFETCH_LIMIT]
+        message_ids = [get_location_data(entry.get_string(RB.RhythmDBPropType.LOCATION))[1] for entry in entries]
+        if message_ids and self.plugin.api:
+            self.plugin.api.prefetch_message_links(self.chat_id, [int(i) for i in message_ids])
+        return False
 
     def file_manager_action(self):
         """Opens the selected entry's file location in the default file manager """
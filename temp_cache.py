@@ -0,0 +1,237 @@
+# rhythmbox-telegram
+# Copyright (C) 2023-2026 Andrey Izman <izmanw@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+import threading
+from gi.repository import RB, GLib  # type: ignore
+from account import KEY_TEMP_CACHE_QUOTA, KEY_TEMP_CACHE_MIN_FREE
+from common import SingletonMeta, get_location_data, set_entry_state, to_location, idle_add_once, empty_cb
+
+logger = logging.getLogger(__name__)
+
+TEMP_CHECK_DELAY = 3000     # Delay (ms) of the check after a download, the downloads in a row are checked once
+TEMP_EVICT_BATCH = 50       # Max number of files deleted in one main loop iteration
+PURGE_REPORT_INTERVAL = 0.5 # Seconds between the progress reports of the purge
+MB = 1000000
+
+
+def purge_dir(root, report=empty_cb, deleted=None):
+    """
+    Deletes the files and the subdirectories of the directory, the directory itself is kept.
+    Calls report(files, size) periodically, returns the number and the total size of the deleted files.
+    The paths of the deleted files are appended to the deleted list if it is given
+    """
+    files = size = 0
+    reported = time.monotonic()
+    stack = [root]
+    dirs = []
+    while stack:
+        path = stack.pop()
+        dirs.append(path)
+        try:
+            with os.scandir(path) as items:
+                for item in items:
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append(item.path)
+                        continue
+                    try:
+                        item_size = item.stat(follow_symlinks=False).st_size
+                        os.unlink(item.path)
+                    except OSError as e:
+                        logger.warning('Unable to delete temp file %s: %s', item.path, e)
+                        continue
+                    files += 1
+                    size += item_size
+                    if deleted is not None:
+                        deleted.append(item.path)
+                    now = time.monotonic()
+                    if now - reported >= PURGE_REPORT_INTERVAL:
+                        reported = now
+                        report(files, size)
+        except OSError as e:
+            logger.warning('Unable to list temp directory %s: %s', path, e)
+    # a directory is listed before its subdirectories, so the reversed order removes the deepest first
+    for path in reversed(dirs[1:]):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    return files, size
+
+
+class TempCache(metaclass=SingletonMeta):
+    """
+    Keeps the temporary audio files within the size quota and the free disk space above the threshold.
+    The least recently played files are deleted first, files moved to the library are never touched.
+    The usage is read from the storage, where it is kept up to date by the triggers of the audio table
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self._check_id = None
+        self._purging = False
+        self._skipped = 0           # Number of LRU rows kept by the previous evictions of the check
+
+    @staticmethod
+    def touch(audio):
+        """ Marks the audio as just played, its file goes to the end of the eviction order """
+        audio.save({'last_access': int(time.time())})
+
+    def check(self, delay=TEMP_CHECK_DELAY):
+        """ Schedules the eviction of the files exceeding the limits """
+        if self._check_id is None:
+            self._check_id = GLib.timeout_add(delay, self._check_cb)
+
+    def stop(self):
+        """ Cancels the scheduled check """
+        if self._check_id is not None:
+            GLib.source_remove(self._check_id)
+            self._check_id = None
+
+    def _check_cb(self):
+        self._check_id = None
+        if not self._purging and self.evict():
+            self.check(0)
+        return False
+
+    def get_excess(self) -> int:
+        """ Get number of bytes to free to get within the quota and above the free space threshold """
+        api, storage = self.plugin.api, self.plugin.storage
+        if not api or not storage or not api.temp_dir:
+            return 0
+        quota = self.plugin.account.settings[KEY_TEMP_CACHE_QUOTA] * MB
+        min_free = self.plugin.account.settings[KEY_TEMP_CACHE_MIN_FREE] * MB
+        excess = 0
+        if quota > 0:
+            excess = storage.get_temp_usage()[0] - quota
+        if min_free > 0:
+            try:
+                st = os.statvfs(api.temp_dir)
+                excess = max(excess, min_free - st.f_bavail * st.f_frsize)
+            except OSError as e:
+                logger.warning('Unable to get free space of %s: %s', api.temp_dir, e)
+        return excess
+
+    def evict(self) -> bool:
+        """
+        Deletes a batch of the least recently played files, returns whether the limits are still exceeded.
+        The files which can not be deleted are skipped by the next batches of the same check
+        """
+        excess = self.get_excess()
+        if excess <= 0:
+            self._skipped = 0
+            return False
+        api, storage = self.plugin.api, self.plugin.storage
+        audios = storage.get_temp_lru(TEMP_EVICT_BATCH, self._skipped)
+        if not audios:
+            self._skipped = 0
+            return False
+        root = os.path.join(api.temp_dir, 'music')
+        playing = self._get_playing_key()
+        evicted = []
+        for audio in audios:
+            if excess <= 0:
+                break
+            if (int(audio.chat_id), int(audio.message_id)) == playing or not self._delete(audio.local_path, root):
+                self._skipped += 1
+                continue
+            evicted.append(audio)
+            excess -= audio.size
+        if evicted:
+            storage.evict_audios(evicted)
+            self._update_entries(evicted)
+        if excess <= 0:
+            self._skipped = 0
+            return False
+        return True
+
+    def purge(self, on_progress=empty_cb, on_done=empty_cb) -> bool:
+        """
+        Deletes all temp files in a worker thread, on_progress(files, size, elapsed) is called in the main loop.
+        Then marks the audio whose files are deleted as not downloaded, resets the states of their entries
+        and calls on_done(files, size, elapsed). Returns False if a purge is already running
+        """
+        if self._purging:
+            return False
+        self._purging = True
+        root = os.path.join(self.plugin.api.temp_dir, 'music')
+        started = time.monotonic()
+
+        def report(files, size):
+            idle_add_once(on_progress, files, size, time.monotonic() - started)
+
+        def run():
+            deleted = []
+            try:
+                result = purge_dir(root, report, deleted)
+            except Exception as e:
+                logger.warning('Purge of temp directory %s failed: %s', root, e)
+                result = (len(deleted), 0)
+            idle_add_once(done, deleted, *result)
+
+        def done(deleted, files, size):
+            self._purging = False
+            # only the rows of the deleted files, a download finished during the purge keeps its file
+            audios = self.plugin.storage.purge_temp_audio(deleted)
+            self._update_entries(audios)
+            on_done(files, size, time.monotonic() - started)
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def _get_playing_key(self):
+        """ Get (chat_id, message_id) of the playing telegram entry, its file is kept """
+        entry = self.plugin.shell.props.shell_player.get_playing_entry()
+        if entry and str(entry.get_entry_type()).startswith('TelegramEntryType'):
+            location = entry.get_string(RB.RhythmDBPropType.LOCATION)
+            chat_id, message_id = get_location_data(location)
+            return int(chat_id), int(message_id)
+        return None
+
+    @staticmethod
+    def _delete(path, root):
+        """ Deletes the file and its emptied directories, only inside the temp directory """
+        if not path:
+            # no file to delete, the audio is only marked as not downloaded
+            return True
+        if not path.startswith(root + os.sep):
+            return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning('Unable to delete temp file %s: %s', path, e)
+            return False
+        parent = os.path.dirname(path)
+        while parent.startswith(root + os.sep):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+        return True
+
+    def _update_entries(self, audios):
+        """ Updates the state of the entries of the evicted audio """
+        db, api = self.plugin.db, self.plugin.api
+        for audio in audios:
+            entry = db.entry_lookup_by_location(to_location(api.hash, audio.chat_id, audio.message_id, audio.id))
+            if entry:
+                set_entry_state(db, entry, audio.get_state())
+        db.commit()
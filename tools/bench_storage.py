@@ -0,0 +1,118 @@
+# rhythmbox-telegram
+# Copyright (C) 2023-2026 Andrey Izman <izmanw@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the storage lookups and writes.
+
+Compares the audio lookup by a bound-parameter statement with the %-formatted SQL used before,
+and the writes with the connection profile against the sqlite defaults. Needs the Rhythmbox
+GObject introspection data, like the plugin itself:
+
+    python3 tools/bench_storage.py [--rows 50000] [--lookups 20000] [--dir /tmp]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import Storage, CONNECTION_PROFILE  # noqa: E402
+
+SQL_INSERT_BENCH_AUDIO = """
+    INSERT INTO `audio` (chat_id, message_id, mime_type, title, artist, file_name, `date`, created_at, size, duration)
+    VALUES (?, ?, 'audio/mpeg', ?, 'artist', 'file.mp3', 1, 1, 1, 1)
+"""
+
+CHATS = 5   # number of chats the rows are spread over
+
+
+class BenchApi:
+    hash = 'bench'
+
+
+def open_storage(root, rows, profile):
+    """ Create a storage in a new directory and fill it with audio rows """
+    files_dir = tempfile.mkdtemp(dir=root)
+    storage = Storage(BenchApi(), files_dir, profile)
+    storage.db.executemany(SQL_INSERT_BENCH_AUDIO,
+                           [(-100 - i % CHATS, i, 'title %d' % i) for i in range(rows)])
+    storage.db.commit()
+    return storage, files_dir
+
+
+def rate(count, fn):
+    """ Runs fn count times, returns the number of calls per second """
+    started = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return count / (time.perf_counter() - started)
+
+
+def bench_reads(storage, rows, lookups):
+    keys = [(str(-100 - i % CHATS), str(i)) for i in random.sample(range(rows), min(lookups, rows))]
+
+    def formatted(i):
+        # the lookup before the statement cache, every query is a new SQL string
+        chat_id, message_id = keys[i]
+        storage.db.execute("SELECT * FROM `audio` WHERE chat_id = %s AND message_id = %s LIMIT 1"
+                           % (chat_id, message_id)).fetchone()
+
+    return {
+        'get_audio, formatted SQL': rate(len(keys), formatted),
+        'get_audio, bound parameters': rate(len(keys), lambda i: storage.get_audio(*keys[i], convert=False)),
+        'select, limit 1': rate(len(keys), lambda i: storage.select('audio', {'chat_id': -101, 'message_id': i})),
+    }
+
+
+def bench_writes(storage, count):
+    def update(i):
+        storage.update('audio', {'play_count': i}, {'id': i + 1})
+        storage.flush()
+
+    return rate(count, update)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage micro-benchmark')
+    parser.add_argument('--rows', type=int, default=50000, help='number of audio rows')
+    parser.add_argument('--lookups', type=int, default=20000, help='number of lookups of every kind')
+    parser.add_argument('--commits', type=int, default=300, help='number of committed updates')
+    parser.add_argument('--dir', default=None, help='directory of the test databases, the disk matters for commits')
+    args = parser.parse_args()
+
+    results = {}
+    for name, profile in (('sqlite defaults', {}), ('connection profile', CONNECTION_PROFILE)):
+        storage, files_dir = open_storage(args.dir, args.rows, profile)
+        try:
+            if not results:
+                results.update(bench_reads(storage, args.rows, args.lookups))
+            results['update + commit, %s' % name] = bench_writes(storage, args.commits)
+        finally:
+            storage.db.close()
+            shutil.rmtree(files_dir)
+
+    print('%d rows, %d lookups, %d commits' % (args.rows, args.lookups, args.commits))
+    for name, value in results.items():
+        print('  %-40s %10.0f/s' % (name, value))
+
+
+if __name__ == '__main__':
+    main()